@@ -0,0 +1,132 @@
+"""
+Benchmark decoding fileMetadata pages: BaseModel objects vs TypedDict columns.
+
+The BaseModel path is the one make_query used before: the page is validated
+into one object per file and aliquot, then flattened into columns. The
+TypedDict path validates into plain dicts with a TypeAdapter and builds the
+columnar _FileMetadata that main.py now uses. Both include the flattening,
+since that is what the pipeline needs.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_decode --files 25000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+from pydantic import BaseModel
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pdc_discovery_scripts'))
+
+from pdc_api.utils.cache import _adapter
+from pdc_api.all_file_metadata import _QueryResponse
+from pdc_api.all_file_metadata import _FileMetadata
+
+
+class _ModelAliquot(BaseModel):
+    sample_id: str
+    case_id: str
+
+
+class _ModelFileMetadatum(BaseModel):
+    file_id: str
+    file_name: str
+    file_location: str
+    file_size: int | None = None
+    md5sum: str | None = None
+    aliquots: list[_ModelAliquot]
+
+
+class _ModelData(BaseModel):
+    fileMetadata: list[_ModelFileMetadatum]
+
+
+class _ModelQueryResponse(BaseModel):
+    data: _ModelData
+
+
+def synthetic_page(num_files, seed=0):
+    """
+    A fileMetadata response of num_files files with 1-3 aliquots each, as bytes.
+    """
+    rng = random.Random(seed)
+    records = [
+        {
+            'file_id': f'{rng.getrandbits(128):032x}',
+            'file_name': f'file{i}.mzid.gz',
+            'file_location': f'studies/{rng.randrange(200)}/file{i}.mzid.gz',
+            'file_size': rng.randrange(10 ** 6, 10 ** 9),
+            'md5sum': f'{rng.getrandbits(128):032x}',
+            'aliquots': [
+                {'sample_id': f'{rng.getrandbits(128):032x}', 'case_id': f'{rng.getrandbits(128):032x}'}
+                for _ in range(rng.randrange(1, 4))
+            ],
+        }
+        for i in range(num_files)
+    ]
+    return json.dumps({'data': {'fileMetadata': records}}).encode('utf-8')
+
+def decode_models(content):
+    response = _ModelQueryResponse.model_validate_json(content)
+    files = response.data.fileMetadata
+    return (
+        [f.file_id for f in files],
+        [-1 if f.file_size is None else f.file_size for f in files],
+        [f.md5sum for f in files],
+        [len(f.aliquots) for f in files],
+        [a.sample_id for f in files for a in f.aliquots],
+        [a.case_id for f in files for a in f.aliquots],
+    )
+
+def decode_columns(content):
+    response = _adapter(_QueryResponse).validate_json(content)
+    columns = _FileMetadata.from_records(response['data']['fileMetadata'])
+    return (
+        columns.file_id.tolist(),
+        columns.file_size.tolist(),
+        columns.md5sum.tolist(),
+        columns.num_aliquots.tolist(),
+        columns.aliquot_sample_id.tolist(),
+        columns.aliquot_case_id.tolist(),
+    )
+
+def _measure(repeat, func, *args):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=25000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    content = synthetic_page(args.files)
+    print(f"synthetic page: {args.files} files, {len(content) / 1e6:.1f} MB of JSON")
+
+    results = {}
+    for label, func in [('BaseModel', decode_models), ('TypedDict columns', decode_columns)]:
+        seconds, peak, result = _measure(args.repeat, func, content)
+        results[label] = result
+        print(f"{label:>18}: {seconds * 1000:8.1f} ms  {args.files / seconds:10.0f} files/s  "
+              f"peak {peak / 1e6:6.1f} MB")
+
+    if results['BaseModel'] != results['TypedDict columns']:
+        raise SystemExit('decoded columns differ')
+    print('decoded columns are identical')
+
+
+if __name__ == '__main__':
+    main()
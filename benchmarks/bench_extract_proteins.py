@@ -0,0 +1,69 @@
+"""
+Benchmark the iterparse protein extractor against the pyteomics path.
+
+Both parsers are timed the way process_manifest_file runs them on a
+downloaded .mzid.gz: pyteomics on an extracted copy (extraction included),
+iterparse straight from the gzip stream. The PSM-level reader
+(mzid_extract.read_psms) is timed on the same stream for comparison.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_extract_proteins --spectra 20000
+"""
+import os
+import time
+import argparse
+import tempfile
+
+from process_manifest_file import parse_mzid_gz
+from mzid_extract import extract_proteins_iterparse
+from mzid_extract import read_psms
+from benchmarks.synthetic_mzid import write_synthetic_mzid
+
+
+def _best_of(repeat, func, *args, **kwargs):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--proteins', type=int, default=2000)
+    parser.add_argument('--peptides', type=int, default=10000)
+    parser.add_argument('--spectra', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        gz_path = write_synthetic_mzid(
+            os.path.join(tmp, 'synthetic.mzid.gz'),
+            num_proteins=args.proteins,
+            num_peptides=args.peptides,
+            num_spectra=args.spectra,
+        )
+        print(f"synthetic file: {args.spectra} spectra, {os.path.getsize(gz_path) / 1e6:.1f} MB compressed")
+
+        cases = [
+            ('pyteomics', parse_mzid_gz, (gz_path, tmp, 'pyteomics'), {}),
+            ('iterparse', parse_mzid_gz, (gz_path, tmp, 'iterparse'), {}),
+            ('iterparse (all evidence)', extract_proteins_iterparse, (gz_path,), {'all_evidence': True}),
+            ('read_psms', lambda path: read_psms(path).protein_set(), (gz_path,), {}),
+        ]
+        results = {}
+        for label, func, func_args, kwargs in cases:
+            seconds, proteins = _best_of(args.repeat, func, *func_args, **kwargs)
+            results[label] = proteins
+            print(f"{label:>26}: {seconds:8.3f} s  {args.spectra / seconds:10.0f} spectra/s  "
+                  f"{len(proteins)} proteins")
+
+        if not results['pyteomics'] == results['iterparse'] == results['read_psms']:
+            raise SystemExit('protein sets differ between the parsers')
+        print('protein sets are identical')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+"""
+Recorded PDC GraphQL data for offline benchmarks.
+
+A fixture holds the data of each top-level field the pipeline queries:
+
+    {
+        "studyCatalog": [...],
+        "fileMetadata": [...all records, in offset order...],
+        "clinicalPerStudy": {pdc_study_id: [...]},
+        "filesPerStudy": {pdc_study_id: [...]}
+    }
+
+Because it is stored per field rather than per query document, the replay
+handler answers any page size and any alias batching of the same data.
+Fixtures are recorded from the live API with RecordingTransport, or
+generated with synthetic_fixture. replay_handler serves one through an
+httpx.MockTransport.
+
+    python -m benchmarks.pdc_fixture synthetic fixture.json.gz --files 20000
+    python -m benchmarks.pdc_fixture record fixture.json.gz
+"""
+import os
+import re
+import sys
+import gzip
+import json
+import random
+import asyncio
+import argparse
+import tempfile
+
+import httpx
+
+FIELDS = ['studyCatalog', 'fileMetadata', 'clinicalPerStudy', 'filesPerStudy']
+
+# a top-level selection, optionally aliased: `s0: filesPerStudy(pdc_study_id: "...")`
+_FIELD_PATTERN = re.compile(r'(?:(\w+)\s*:\s*)?\b(' + '|'.join(FIELDS) + r')\b\s*(?:\(([^)]*)\))?')
+_ARGUMENT_PATTERN = re.compile(r'(\w+)\s*:\s*(?:"([^"]*)"|([^\s,)]+))')
+
+STAGES = ['Stage I', 'Stage1', 'Stage IA', 'Stage II', 'Stage IIIA', 'Stage IIIB', 'Stage IIIC',
+          'Not Reported', 'Stage IV']
+DISEASES = ['Ovarian Serous Cystadenocarcinoma', 'Colon Adenocarcinoma', 'Breast Invasive Carcinoma',
+            'Lung Adenocarcinoma']
+
+
+def parse_fields(query):
+    """
+    (alias or field name, field name, {argument: value}) of each top-level
+    field of a query document.
+    """
+    return [
+        (alias or name, name, {
+            key: quoted if quoted or not bare else bare
+            for key, quoted, bare in _ARGUMENT_PATTERN.findall(arguments)
+        })
+        for alias, name, arguments in _FIELD_PATTERN.findall(query)
+    ]
+
+def empty_fixture():
+    return {'studyCatalog': [], 'fileMetadata': [], 'clinicalPerStudy': {}, 'filesPerStudy': {}}
+
+def resolve(fixture, name, arguments):
+    """
+    The data of one field selection, as the API would return it.
+    """
+    if name == 'studyCatalog':
+        return fixture['studyCatalog']
+    if name == 'fileMetadata':
+        offset = int(arguments.get('offset', 0))
+        limit = int(arguments.get('limit', len(fixture['fileMetadata'])))
+        return fixture['fileMetadata'][offset:offset + limit]
+    return fixture[name].get(arguments.get('pdc_study_id'), [])
+
+def replay_handler(fixture, latency=0.0):
+    """
+    An httpx.MockTransport handler answering GraphQL queries from fixture,
+    after latency seconds per request. handler.requests counts the requests.
+    """
+    async def handler(request):
+        handler.requests += 1
+        if latency:
+            await asyncio.sleep(latency)
+        query = json.loads(request.content)['query']
+        fields = parse_fields(query)
+        if not fields:
+            return httpx.Response(400, json={'errors': [{'message': 'no known field in query'}]})
+        return httpx.Response(200, json={'data': {
+            alias: resolve(fixture, name, arguments)
+            for alias, name, arguments in fields
+        }})
+
+    handler.requests = 0
+    return handler
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """
+    Passes requests on to transport and records the data of every answered
+    field into fixture.
+    """
+
+    def __init__(self, transport, fixture):
+        self.transport = transport
+        self.fixture = fixture
+
+    async def handle_async_request(self, request):
+        response = await self.transport.handle_async_request(request)
+        if response.status_code != 200:
+            return response
+
+        content = await response.aread()
+        data = json.loads(content).get('data') or {}
+        for alias, name, arguments in parse_fields(json.loads(request.content)['query']):
+            value = data.get(alias)
+            if value is None:
+                continue
+            if name == 'studyCatalog':
+                self.fixture['studyCatalog'] = value
+            elif name == 'fileMetadata':
+                records = self.fixture['fileMetadata']
+                offset = int(arguments.get('offset', 0))
+                if len(records) < offset + len(value):
+                    records.extend([None] * (offset + len(value) - len(records)))
+                records[offset:offset + len(value)] = value
+            else:
+                self.fixture[name][arguments['pdc_study_id']] = value
+
+        return httpx.Response(response.status_code, headers=response.headers, content=content)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def synthetic_fixture(num_studies=30, num_files=5000, cases_per_study=40, seed=0):
+    """
+    A fixture with the shape of PDC's data: cases with samples per study,
+    and files whose aliquots mostly map to one case, sometimes to several,
+    to cases of other studies or to nothing.
+    """
+    rng = random.Random(seed)
+    studies = [f'PDC{index:06d}' for index in range(num_studies)]
+
+    clinical = {}
+    for study in studies:
+        clinical[study] = [
+            {
+                'case_id': f'{study}-case{index}',
+                'disease_type': rng.choice(DISEASES),
+                'tumor_stage': rng.choice(STAGES),
+                'samples': [{'sample_id': f'{study}-case{index}-sample{k}'} for k in range(rng.randrange(1, 4))],
+            }
+            for index in range(cases_per_study)
+        ]
+
+    file_metadata = []
+    files_per_study = {study: [] for study in studies}
+    for index in range(num_files):
+        study = rng.choice(studies)
+        case = rng.choice(clinical[study])
+        draw = rng.random()
+        if draw < 0.6:
+            aliquots = [{'sample_id': case['samples'][0]['sample_id'], 'case_id': case['case_id']}]
+        elif draw < 0.75:
+            aliquots = [{'sample_id': case['samples'][-1]['sample_id'], 'case_id': 'unknown'}]
+        elif draw < 0.9:
+            other = rng.choice(clinical[rng.choice(studies)])
+            aliquots = [
+                {'sample_id': 'unknown', 'case_id': case['case_id']},
+                {'sample_id': other['samples'][0]['sample_id'], 'case_id': 'unknown'},
+            ]
+        else:
+            aliquots = [{'sample_id': 'unknown', 'case_id': 'unknown'}]
+
+        file_id = f'{rng.getrandbits(128):032x}'
+        file_name = f'file{index}.mzid.gz'
+        file_size = rng.randrange(10 ** 6, 10 ** 9)
+        md5sum = f'{rng.getrandbits(128):032x}'
+        file_metadata.append({
+            'file_id': file_id,
+            'file_name': file_name,
+            'file_location': f'studies/{study}/{file_name}',
+            'file_size': file_size,
+            'md5sum': md5sum,
+            'aliquots': aliquots,
+        })
+        files_per_study[study].append({
+            'file_id': file_id,
+            'file_size': file_size,
+            'md5sum': md5sum,
+            'signedUrl': {'url': f'https://example.invalid/{file_name}?signature={index}'},
+        })
+
+    return {
+        'studyCatalog': [{'pdc_study_id': study} for study in studies],
+        'fileMetadata': file_metadata,
+        'clinicalPerStudy': clinical,
+        'filesPerStudy': files_per_study,
+    }
+
+def save_fixture(fixture, path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt', encoding='utf-8') as f:
+        json.dump(fixture, f)
+
+def load_fixture(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+def record_fixture(path):
+    """
+    Run discovery (main.py stages 1 to 5) against the live PDC API,
+    bypassing the query cache, and save every answered field as a fixture.
+    """
+    sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                 'pdc_discovery_scripts'))
+    with tempfile.TemporaryDirectory() as tmp:
+        # a fresh query cache, so that every query reaches the API
+        os.environ['PDC_CACHE_DIR'] = tmp
+
+        from pdc_api.utils.waiter import Waiter
+        from main import discover
+        from main import files_with_urls
+
+        fixture = empty_fixture()
+
+        async def run():
+            transport = RecordingTransport(httpx.AsyncHTTPTransport(retries=5), fixture)
+            async with httpx.AsyncClient(timeout=60, transport=transport) as client:
+                waiter = Waiter()
+                view = await discover(client=client, waiter=waiter)
+                async for _ in files_with_urls(client=client, waiter=waiter, view=view):
+                    pass
+
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            asyncio.run(run())
+        finally:
+            os.chdir(cwd)
+
+    save_fixture(fixture, path)
+    return fixture
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record or generate a PDC fixture for the benchmarks.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    synthetic_parser = subparsers.add_parser('synthetic')
+    synthetic_parser.add_argument('path')
+    synthetic_parser.add_argument('--studies', type=int, default=30)
+    synthetic_parser.add_argument('--files', type=int, default=5000)
+    synthetic_parser.add_argument('--cases-per-study', type=int, default=40)
+    synthetic_parser.add_argument('--seed', type=int, default=0)
+    record_parser = subparsers.add_parser('record')
+    record_parser.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'synthetic':
+        fixture = synthetic_fixture(args.studies, args.files, args.cases_per_study, args.seed)
+        save_fixture(fixture, args.path)
+    else:
+        fixture = record_fixture(args.path)
+    print(f"{args.path}: {len(fixture['studyCatalog'])} studies, {len(fixture['fileMetadata'])} files")
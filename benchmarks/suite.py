@@ -0,0 +1,348 @@
+"""
+Benchmark every pipeline stage offline, against a stored baseline.
+
+PDC queries are answered from a fixture (see benchmarks.pdc_fixture) through
+an httpx.MockTransport with a fixed latency per request, and mzIdentML files
+and protein lists are synthetic, so runs are repeatable without network
+access. Each stage runs alone in a fresh process, once per repeat, with a
+cold query cache; the best time and the highest peak RSS (of the process and
+of the workers it started) are reported.
+
+Run from the repository root:
+
+    python -m benchmarks.suite
+    python -m benchmarks.suite --save-baseline
+    python -m benchmarks.suite --fixture recorded.json.gz --stages all_file_metadata stage4_mapping
+
+Once a baseline is saved (benchmarks/baseline.json by default), every run is
+compared with it; stages slower or larger than the baseline by more than
+--tolerance are reported as regressions and the run exits with status 1.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.pdc_fixture import load_fixture
+from benchmarks.pdc_fixture import replay_handler
+from benchmarks.pdc_fixture import save_fixture
+from benchmarks.pdc_fixture import synthetic_fixture
+from benchmarks.synthetic_mzid import write_synthetic_mzid
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(REPOSITORY, 'benchmarks', 'baseline.json')
+
+
+def _peak_rss_mb():
+    """
+    Peak RSS of this process and of its largest finished child, in MB.
+    """
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own * unit / 1e6, children * unit / 1e6
+
+def _import_discovery(cache_dir):
+    """
+    Import the pdc_api modules with their query cache in cache_dir. The cache
+    location is read at import, which is why every stage runs in its own
+    process.
+    """
+    os.environ['PDC_CACHE_DIR'] = cache_dir
+    path = os.path.join(REPOSITORY, 'pdc_discovery_scripts')
+    if path not in sys.path:
+        sys.path.append(path)
+
+def _replay_client(fixture, latency):
+    import httpx
+    handler = replay_handler(fixture, latency=latency)
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler)), handler
+
+def _unthrottled_waiter():
+    from pdc_api.utils.waiter import Waiter
+    # the replay latency stands in for the API; only the in-flight bound stays
+    return Waiter(rate=1e6, burst=10 ** 6)
+
+
+def stage_all_file_metadata(options, tmp):
+    _import_discovery(tmp)
+    from pdc_api.all_file_metadata import all_file_metadata
+
+    fixture = load_fixture(options['fixture'])
+    client, handler = _replay_client(fixture, options['latency'])
+
+    async def run():
+        async with client:
+            return await all_file_metadata(client=client, waiter=_unthrottled_waiter())
+
+    start = time.perf_counter()
+    metadata = asyncio.run(run())
+    seconds = time.perf_counter() - start
+    return seconds, len(metadata), 'files', {'requests': handler.requests}
+
+def stage_clinicals_per_study(options, tmp):
+    _import_discovery(tmp)
+    from pdc_api.clinicals_per_study import clinicals_per_studies
+
+    fixture = load_fixture(options['fixture'])
+    pdc_study_ids = [study['pdc_study_id'] for study in fixture['studyCatalog']]
+    client, handler = _replay_client(fixture, options['latency'])
+
+    async def run():
+        async with client:
+            return await clinicals_per_studies(
+                client=client,
+                waiter=_unthrottled_waiter(),
+                pdc_study_ids=pdc_study_ids,
+            )
+
+    start = time.perf_counter()
+    results = asyncio.run(run())
+    seconds = time.perf_counter() - start
+    return seconds, len(pdc_study_ids), 'studies', {
+        'requests': handler.requests,
+        'cases': sum(len(result) for result in results),
+    }
+
+def stage4_mapping(options, tmp):
+    _import_discovery(tmp)
+    from main import _map_files_to_cases
+    from pdc_api.all_file_metadata import _FileMetadata
+    from pdc_api.clinicals_per_study import _ClinicalDatum
+
+    fixture = load_fixture(options['fixture'])
+    metadata = _FileMetadata.from_records(fixture['fileMetadata'])
+    clinical_data = [
+        _ClinicalDatum.model_validate({**datum, 'pdc_study_id': pdc_study_id})
+        for pdc_study_id, data in fixture['clinicalPerStudy'].items()
+        for datum in data
+    ]
+
+    start = time.perf_counter()
+    _, num_not_mapped, num_unique, num_ambiguous = _map_files_to_cases(metadata, clinical_data)
+    seconds = time.perf_counter() - start
+    return seconds, len(metadata), 'files', {
+        'not_mapped': num_not_mapped,
+        'unique': num_unique,
+        'ambiguous': num_ambiguous,
+    }
+
+def stage_extract_proteins(options, tmp):
+    from process_manifest_file import parse_mzid_gz
+
+    gz_path = write_synthetic_mzid(
+        os.path.join(tmp, 'synthetic.mzid.gz'),
+        num_proteins=options['proteins'],
+        num_spectra=options['spectra'],
+        num_peptides=options['spectra'] // 2,
+    )
+
+    start = time.perf_counter()
+    proteins = parse_mzid_gz(gz_path, tmp, options['parser'])
+    seconds = time.perf_counter() - start
+    return seconds, options['spectra'], 'spectra', {
+        'proteins': len(proteins),
+        'megabytes': round(os.path.getsize(gz_path) / 1e6, 1),
+    }
+
+def _write_protein_lists(folder, num_lists, num_proteins, proteins_per_list, seed=0):
+    """
+    Protein lists as process_manifest_file writes them, one protein
+    description per line, drawing proteins with a skewed frequency so that
+    some appear in nearly every list and most in few.
+    """
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(num_proteins)]
+    os.makedirs(folder, exist_ok=True)
+    for index in range(num_lists):
+        drawn = set(rng.choices(range(num_proteins), weights=weights, k=proteins_per_list))
+        with open(os.path.join(folder, f'file{index}.txt'), 'w', encoding='utf-8') as f:
+            for protein in drawn:
+                f.write(f'sp|P{protein:05d}|PROT{protein}_HUMAN Synthetic protein {protein}\n')
+
+def stage_process_txt(options, tmp):
+    from write_to_csv import process_txt
+
+    folder = os.path.join(tmp, 'protein_list')
+    _write_protein_lists(folder, options['protein_lists'], options['proteins'], options['proteins_per_list'])
+
+    start = time.perf_counter()
+    counts, num_files = process_txt(folder)
+    seconds = time.perf_counter() - start
+    return seconds, num_files, 'files', {'proteins': len(counts)}
+
+def stage_write_to_csv(options, tmp):
+    from write_to_csv import write_to_csv
+
+    rng = random.Random(0)
+    num_files = options['protein_lists']
+    proteins = [f'PROT{index}' for index in range(options['proteins'])]
+    invasive = {protein: rng.randrange(1, num_files) for protein in proteins if rng.random() < 0.9}
+    non_invasive = {protein: rng.randrange(1, num_files) for protein in proteins if rng.random() < 0.9}
+    output = os.path.join(tmp, 'protein_summary.csv')
+
+    start = time.perf_counter()
+    write_to_csv(invasive, num_files, non_invasive, num_files, output)
+    seconds = time.perf_counter() - start
+    with open(output, newline='') as f:
+        rows = sum(1 for _ in csv.reader(f)) - 1
+    return seconds, rows, 'proteins', {}
+
+
+STAGES = {
+    'all_file_metadata': stage_all_file_metadata,
+    'clinicals_per_study': stage_clinicals_per_study,
+    'stage4_mapping': stage4_mapping,
+    'extract_proteins': stage_extract_proteins,
+    'process_txt': stage_process_txt,
+    'write_to_csv': stage_write_to_csv,
+}
+
+
+def _run_stage(name, options):
+    """
+    Run one stage once, in the current (fresh) process.
+    """
+    sys.path.insert(0, REPOSITORY)
+    with tempfile.TemporaryDirectory() as tmp:
+        seconds, items, unit, extra = STAGES[name](options, tmp)
+        own_rss, children_rss = _peak_rss_mb()
+    return {
+        'seconds': seconds,
+        'items': items,
+        'unit': unit,
+        'peak_rss_mb': max(own_rss, children_rss),
+        'extra': extra,
+    }
+
+def run_stage(name, options, repeat):
+    """
+    Run a stage repeat times, each in a new process. Returns the best time,
+    the throughput at that time and the highest peak RSS.
+    """
+    context = multiprocessing.get_context('spawn')
+    runs = []
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            runs.append(executor.submit(_run_stage, name, options).result())
+
+    best = min(runs, key=lambda run: run['seconds'])
+    return {
+        'seconds': best['seconds'],
+        'items': best['items'],
+        'throughput': best['items'] / best['seconds'] if best['seconds'] > 0 else float('inf'),
+        'unit': best['unit'],
+        'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+        'extra': best['extra'],
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print each stage's time and peak RSS relative to the baseline. Returns
+    the names of the stages that regressed by more than tolerance.
+    """
+    if baseline['parameters'] != results['parameters']:
+        print('warning: the baseline was recorded with different parameters')
+    if baseline.get('machine') != results['machine']:
+        print('warning: the baseline was recorded on a different machine')
+
+    regressions = []
+    print(f"\n{'stage':<22}{'time':>10}{'baseline':>10}{'ratio':>8}{'rss':>10}{'baseline':>10}{'ratio':>8}")
+    for name, stage in results['stages'].items():
+        reference = baseline['stages'].get(name)
+        if reference is None:
+            print(f"{name:<22}{'(not in baseline)':>20}")
+            continue
+        time_ratio = stage['seconds'] / reference['seconds']
+        rss_ratio = stage['peak_rss_mb'] / reference['peak_rss_mb']
+        regressed = time_ratio > 1 + tolerance or rss_ratio > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<22}{stage['seconds']:>9.3f}s{reference['seconds']:>9.3f}s{time_ratio:>8.2f}"
+              f"{stage['peak_rss_mb']:>8.0f}MB{reference['peak_rss_mb']:>8.0f}MB{rss_ratio:>8.2f}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--fixture', default=None,
+                        help='PDC fixture to replay (default: a synthetic one of --studies/--files)')
+    parser.add_argument('--studies', type=int, default=60)
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--cases-per-study', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per replayed request')
+    parser.add_argument('--spectra', type=int, default=20000)
+    parser.add_argument('--proteins', type=int, default=5000)
+    parser.add_argument('--parser', choices=['iterparse', 'pyteomics'], default='iterparse')
+    parser.add_argument('--protein-lists', type=int, default=2000)
+    parser.add_argument('--proteins-per-list', type=int, default=1500)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown or RSS growth reported as a regression')
+    args = parser.parse_args()
+
+    parameters = {
+        'fixture': os.path.basename(args.fixture) if args.fixture else
+        f'synthetic:{args.studies}x{args.files}x{args.cases_per_study}',
+        'latency': args.latency,
+        'spectra': args.spectra,
+        'proteins': args.proteins,
+        'parser': args.parser,
+        'protein_lists': args.protein_lists,
+        'proteins_per_list': args.proteins_per_list,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fixture_path = args.fixture
+        if fixture_path is None:
+            fixture_path = os.path.join(tmp, 'fixture.json.gz')
+            save_fixture(synthetic_fixture(args.studies, args.files, args.cases_per_study), fixture_path)
+        options = {**parameters, 'fixture': os.path.abspath(fixture_path)}
+
+        results = {
+            'parameters': parameters,
+            'machine': f'{platform.node()} {platform.machine()} {os.cpu_count()} cpus',
+            'python': platform.python_version(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'stages': {},
+        }
+        for name in args.stages:
+            stage = run_stage(name, options, args.repeat)
+            results['stages'][name] = stage
+            extra = ', '.join(f'{key} {value}' for key, value in stage['extra'].items())
+            print(f"{name:>22}: {stage['seconds']:8.3f} s  {stage['throughput']:10.0f} {stage['unit']}/s  "
+                  f"peak {stage['peak_rss_mb']:6.0f} MB  ({stage['items']} {stage['unit']}{', ' if extra else ''}{extra})")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            raise SystemExit(f"regressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Synthetic mzIdentML files of controlled size for benchmarks.
+
+The layout follows what MS-GF+ writes for PDC: DBSequences, Peptides and
+PeptideEvidences in the SequenceCollection, followed by one
+SpectrumIdentificationResult per spectrum with ranked items.
+"""
+import gzip
+import random
+
+_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<MzIdentML id="synthetic" version="1.1.0" xmlns="http://psidev.info/psi/pi/mzIdentML/1.1">
+<cvList>
+<cv id="PSI-MS" fullName="PSI-MS" uri="https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo"/>
+</cvList>
+<SequenceCollection>
+'''
+
+_AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def write_synthetic_mzid(path, num_proteins=2000, num_peptides=10000, num_spectra=20000,
+                         items_per_spectrum=2, evidences_per_peptide=2, seed=0):
+    """
+    Write a synthetic mzIdentML file to path (gzip-compressed if path ends in .gz).
+    Every tenth DBSequence is a decoy without a protein description, so the
+    extractors' skipping of unresolvable evidences is exercised as well.
+    """
+    rng = random.Random(seed)
+    opener = gzip.open if path.endswith('.gz') else open
+
+    with opener(path, 'wt', encoding='utf-8') as f:
+        f.write(_HEADER)
+
+        for i in range(num_proteins):
+            f.write(f'<DBSequence id="DBSeq{i}" accession="sp|P{i:05d}|PROT{i}_HUMAN" '
+                    f'searchDatabase_ref="SearchDB_1" length="300">\n')
+            if i % 10 != 9:
+                f.write(f'<cvParam cvRef="PSI-MS" accession="MS:1001088" name="protein description" '
+                        f'value="sp|P{i:05d}|PROT{i}_HUMAN Synthetic protein {i}"/>\n')
+            f.write('</DBSequence>\n')
+
+        for j in range(num_peptides):
+            sequence = ''.join(rng.choice(_AMINO_ACIDS) for _ in range(rng.randint(7, 20)))
+            f.write(f'<Peptide id="Pep{j}"><PeptideSequence>{sequence}</PeptideSequence></Peptide>\n')
+
+        for j in range(num_peptides):
+            for k in range(evidences_per_peptide):
+                protein = rng.randrange(num_proteins)
+                f.write(f'<PeptideEvidence id="PE{j}_{k}" peptide_ref="Pep{j}" '
+                        f'dBSequence_ref="DBSeq{protein}" isDecoy="false" start="1" end="10"/>\n')
+
+        f.write('</SequenceCollection>\n')
+        f.write('<DataCollection>\n<Inputs>\n')
+        f.write('<SearchDatabase id="SearchDB_1" location="synthetic.fasta"/>\n')
+        f.write('<SpectraData id="SID_1" location="synthetic.mzML"/>\n')
+        f.write('</Inputs>\n<AnalysisData>\n<SpectrumIdentificationList id="SIL_1">\n')
+
+        for s in range(num_spectra):
+            f.write(f'<SpectrumIdentificationResult id="SIR_{s}" spectrumID="index={s}" '
+                    f'spectraData_ref="SID_1">\n')
+            for rank in range(1, items_per_spectrum + 1):
+                peptide = rng.randrange(num_peptides)
+                evalue = rng.uniform(1e-15, 1e-5) * rank
+                qvalue = rng.uniform(0.0, 0.05) * rank
+                f.write(f'<SpectrumIdentificationItem id="SII_{s}_{rank}" rank="{rank}" chargeState="2" '
+                        f'experimentalMassToCharge="500.0" calculatedMassToCharge="500.0" '
+                        f'peptide_ref="Pep{peptide}" passThreshold="true">\n')
+                for k in range(evidences_per_peptide):
+                    f.write(f'<PeptideEvidenceRef peptideEvidence_ref="PE{peptide}_{k}"/>\n')
+                f.write(f'<cvParam cvRef="PSI-MS" accession="MS:1002052" name="MS-GF:SpecEValue" '
+                        f'value="{evalue:.6g}"/>\n')
+                f.write(f'<cvParam cvRef="PSI-MS" accession="MS:1002054" name="MS-GF:QValue" '
+                        f'value="{qvalue:.6g}"/>\n')
+                f.write('</SpectrumIdentificationItem>\n')
+            f.write('</SpectrumIdentificationResult>\n')
+
+        f.write('</SpectrumIdentificationList>\n</AnalysisData>\n</DataCollection>\n</MzIdentML>\n')
+
+    return path
@@ -0,0 +1,314 @@
+"""
+Protein statistics for any number of cohorts, with significance tests.
+
+For every cohort (see cohorts.py) the number and fraction of its files that
+contain each protein are column sums of the protein matrix over the
+cohort's row mask; all cohorts are summed in one sparse product. Each
+comparison of two cohorts (A vs B, or A vs the rest of the files) tests
+every protein at once:
+
+    Fisher's exact test   two-sided, on the 2x2 table of files with/without
+                          the protein in A and B. Proteins with the same
+                          table margins share one hypergeometric
+                          distribution, computed once per margin.
+    chi-square test       with Yates' correction, as scipy's chi2_contingency
+    Benjamini-Hochberg    q-values of both tests over the proteins of the
+                          comparison
+
+With disjoint cohorts a chi-square test of independence over all cohorts
+(N - 1 degrees of freedom) is added per protein. Comparisons are spread
+over a process pool. The results are written as Parquet tables into the
+output folder: counts.parquet (cohort, protein, files, count, fraction),
+tests.parquet (one row per comparison and protein) and, for disjoint
+cohorts, omnibus.parquet.
+
+    python cohort_stats.py
+    python cohort_stats.py --definitions cohorts.json --compare pairs
+    python cohort_stats.py --split-by disease_type stage_group --compare rest
+"""
+import os
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy import stats
+
+from cohorts import CohortTable
+from cohorts import DEFAULT_COHORTS
+from cohorts import DEFAULT_TABLE
+from cohorts import cohort_masks
+from cohorts import load_definitions
+from protein_store import load_matrix
+
+# relative tolerance for tables as likely as the observed one (as in R's fisher.test)
+_FISHER_TOLERANCE = 1 + 1e-7
+
+
+def fisher_exact_many(a, n_a, c, n_b):
+    """
+    Two-sided Fisher exact p-values of the 2x2 tables
+    [[a, n_a - a], [c, n_b - c]] for arrays a and c of counts in cohorts of
+    n_a and n_b files. Tables with the same margin a + c are evaluated
+    against one hypergeometric distribution.
+    """
+    a = np.asarray(a, dtype=np.int64)
+    c = np.asarray(c, dtype=np.int64)
+    margins = a + c
+    p = np.ones(len(a))
+
+    for margin in np.unique(margins):
+        rows = np.flatnonzero(margins == margin)
+        low = max(0, margin - n_b)
+        high = min(margin, n_a)
+        pmf = stats.hypergeom.pmf(np.arange(low, high + 1), n_a + n_b, n_a, margin)
+        # the p-value of a table sums the tables at most as likely as it
+        ascending = np.sort(pmf)
+        cumulative = np.cumsum(ascending)
+        observed = pmf[a[rows] - low]
+        at_most = np.searchsorted(ascending, observed * _FISHER_TOLERANCE, side='right')
+        p[rows] = np.minimum(cumulative[at_most - 1], 1.0)
+    return p
+
+def chi_square_2x2(a, n_a, c, n_b, correction=True):
+    """
+    Chi-square statistics and p-values of the same 2x2 tables as
+    fisher_exact_many, with Yates' correction by default. Tables with an
+    empty row or column have no statistic (NaN).
+    """
+    observed = np.stack([a, n_a - a, c, n_b - c]).astype(float)
+    present = a + c
+    n = n_a + n_b
+    expected = np.stack([
+        n_a * present / n, n_a * (n - present) / n,
+        n_b * present / n, n_b * (n - present) / n,
+    ])
+    difference = np.abs(observed - expected)
+    if correction:
+        # move each observed count at most 0.5 towards its expected count
+        difference = difference - np.minimum(0.5, difference)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chi2 = (difference ** 2 / expected).sum(axis=0)
+    chi2[(expected == 0).any(axis=0)] = np.nan
+    return chi2, stats.chi2.sf(chi2, 1)
+
+def chi_square_independence(counts, sizes):
+    """
+    Chi-square test of independence of protein presence and cohort, per
+    protein: counts is cohorts x proteins, sizes the files per cohort.
+    Yates' correction is applied for two cohorts, as chi2_contingency does.
+    """
+    counts = np.asarray(counts, dtype=float)
+    sizes = np.asarray(sizes, dtype=float)[:, None]
+    if len(counts) == 2:
+        return chi_square_2x2(counts[0], sizes[0, 0], counts[1], sizes[1, 0])
+
+    n = sizes.sum()
+    present = counts.sum(axis=0)
+    expected_present = sizes * present / n
+    expected_absent = sizes * (n - present) / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chi2 = (
+            (counts - expected_present) ** 2 / expected_present
+            + (sizes - counts - expected_absent) ** 2 / expected_absent
+        ).sum(axis=0)
+    chi2[(present == 0) | (present == n)] = np.nan
+    return chi2, stats.chi2.sf(chi2, len(counts) - 1)
+
+def fdr_bh(p):
+    """
+    Benjamini-Hochberg q-values; NaN p-values are left out and stay NaN.
+    """
+    p = np.asarray(p, dtype=float)
+    q = np.full(len(p), np.nan)
+    tested = np.flatnonzero(~np.isnan(p))
+    if len(tested) == 0:
+        return q
+    order = tested[np.argsort(p[tested], kind='stable')]
+    ranked = p[order] * len(order) / np.arange(1, len(order) + 1)
+    q[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1.0)
+    return q
+
+
+def cohort_counts(matrix, masks):
+    """
+    (cohorts x proteins counts, files per cohort) for {name: row mask}, in
+    one product of the cohort membership and the presence matrix.
+    """
+    membership = sparse.csr_matrix(np.column_stack(list(masks.values())).astype(np.int64)) \
+        if masks else sparse.csr_matrix((matrix.num_files, 0), dtype=np.int64)
+    counts = np.asarray((membership.T @ matrix.presence.astype(np.int64)).todense())
+    sizes = np.asarray(membership.sum(axis=0)).ravel()
+    return counts, sizes
+
+def comparisons(names, compare='pairs'):
+    """
+    The cohort comparisons to test: 'pairs' (every two cohorts) or 'rest'
+    (each cohort against all other files). 'rest' is written as None.
+    """
+    if compare == 'pairs':
+        return list(itertools.combinations(names, 2))
+    if compare == 'rest':
+        return [(name, None) for name in names]
+    raise ValueError(f"Unknown comparison mode: {compare}")
+
+def compare_cohorts(a, n_a, c, n_b):
+    """
+    The test columns of one comparison; runs in a worker process.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction_a = a / n_a if n_a else np.zeros(len(a))
+        fraction_b = c / n_b if n_b else np.zeros(len(c))
+        odds_ratio = (a * (n_b - c)) / ((n_a - a) * c)
+        log2_fold_change = np.log2(fraction_a / fraction_b)
+    fisher_p = fisher_exact_many(a, n_a, c, n_b)
+    chi2, chi2_p = chi_square_2x2(a, n_a, c, n_b)
+    return {
+        'count_a': a,
+        'count_b': c,
+        'fraction_a': fraction_a,
+        'fraction_b': fraction_b,
+        'odds_ratio': odds_ratio,
+        'log2_fold_change': log2_fold_change,
+        'fisher_p': fisher_p,
+        'fisher_q': fdr_bh(fisher_p),
+        'chi2': chi2,
+        'chi2_p': chi2_p,
+        'chi2_q': fdr_bh(chi2_p),
+    }
+
+def cohort_statistics(matrix, masks, compare='pairs', workers=None):
+    """
+    The counts, tests and (for disjoint cohorts) omnibus tables of the
+    cohorts {name: row mask over matrix}; see the module docstring.
+    """
+    names = list(masks)
+    counts, sizes = cohort_counts(matrix, masks)
+    proteins = matrix.proteins
+    index = {name: i for i, name in enumerate(names)}
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fractions = np.where(sizes[:, None] > 0, counts / sizes[:, None], 0.0)
+    counts_table = pd.DataFrame({
+        'cohort': np.repeat(names, len(proteins)),
+        'protein': np.tile(proteins, len(names)),
+        'files': np.repeat(sizes, len(proteins)),
+        'count': counts.ravel(),
+        'fraction': fractions.ravel(),
+    })
+
+    all_counts = matrix.counts()
+    tasks = []
+    pairs = comparisons(names, compare)
+    for name_a, name_b in pairs:
+        i = index[name_a]
+        if name_b is None:
+            tasks.append((counts[i], sizes[i], all_counts - counts[i], matrix.num_files - sizes[i]))
+        else:
+            j = index[name_b]
+            tasks.append((counts[i], sizes[i], counts[j], sizes[j]))
+
+    if len(tasks) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(compare_cohorts, *zip(*tasks)))
+    else:
+        results = [compare_cohorts(*task) for task in tasks]
+
+    tests = [
+        pd.DataFrame({
+            'cohort_a': name_a,
+            'cohort_b': 'rest' if name_b is None else name_b,
+            'protein': proteins,
+            **columns,
+        })
+        for (name_a, name_b), columns in zip(pairs, results)
+    ]
+    tests_table = pd.concat(tests, ignore_index=True) if tests else pd.DataFrame()
+
+    omnibus_table = None
+    disjoint = len(names) > 1 and np.column_stack(list(masks.values())).sum(axis=1).max() <= 1
+    if disjoint:
+        chi2, chi2_p = chi_square_independence(counts, sizes)
+        omnibus_table = pd.DataFrame({
+            'protein': proteins,
+            'chi2': chi2,
+            'chi2_p': chi2_p,
+            'chi2_q': fdr_bh(chi2_p),
+        })
+
+    return counts_table, tests_table, omnibus_table
+
+def split_definitions(cohort_table, columns):
+    """
+    One cohort per combination of values of columns that occurs in the
+    file table, e.g. every disease type and stage group.
+    """
+    values = pd.DataFrame({column: cohort_table.column(column) for column in columns}).dropna()
+    definitions = []
+    for key in values.drop_duplicates().itertuples(index=False):
+        where = dict(zip(columns, (str(value) for value in key)))
+        definitions.append({'name': '/'.join(where.values()), 'where': where})
+    return definitions
+
+def write_statistics(output, counts_table, tests_table, omnibus_table):
+    os.makedirs(output, exist_ok=True)
+    counts_table.to_parquet(os.path.join(output, 'counts.parquet'), index=False)
+    tests_table.to_parquet(os.path.join(output, 'tests.parquet'), index=False)
+    if omnibus_table is not None:
+        omnibus_table.to_parquet(os.path.join(output, 'omnibus.parquet'), index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-protein statistics and tests for any number of cohorts.')
+    parser.add_argument('--store', default='protein_store')
+    parser.add_argument('--table', default=DEFAULT_TABLE)
+    parser.add_argument('--definitions', default=None,
+                        help='JSON list of cohort definitions (default: noninvasive and invasive)')
+    parser.add_argument('--split-by', nargs='+', default=None, metavar='COLUMN',
+                        help='one cohort per value combination of these file table columns')
+    parser.add_argument('--compare', choices=['pairs', 'rest'], default='pairs',
+                        help='test every two cohorts, or each cohort against all other files')
+    parser.add_argument('--min-files', type=int, default=1,
+                        help='leave out cohorts with fewer files in the store')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes for the comparisons (default: number of CPUs)')
+    parser.add_argument('--output', default='protein_stats')
+    args = parser.parse_args()
+
+    matrix, file_ids = load_matrix(args.store)
+    if matrix is None:
+        raise SystemExit(f"No protein store at {args.store}")
+
+    if args.split_by:
+        if not os.path.exists(args.table):
+            raise SystemExit(f"--split-by needs the file table {args.table} (python cohorts.py build)")
+        definitions = split_definitions(CohortTable(args.table), args.split_by)
+    elif args.definitions:
+        definitions = load_definitions(args.definitions)
+    else:
+        definitions = DEFAULT_COHORTS
+
+    # cohorts come from the file table if there is one, else from the download keywords
+    masks = cohort_masks(matrix, file_ids, definitions, args.table, include_all=False)
+    small = [name for name, mask in masks.items() if mask.sum() < args.min_files]
+    for name in small:
+        del masks[name]
+    if small:
+        print(f"Left out {len(small)} cohorts with fewer than {args.min_files} files: {', '.join(small)}")
+
+    counts_table, tests_table, omnibus_table = cohort_statistics(
+        matrix, masks, compare=args.compare, workers=args.workers,
+    )
+    write_statistics(args.output, counts_table, tests_table, omnibus_table)
+
+    print(f"{len(masks)} cohorts of {matrix.num_files} files, {len(matrix.proteins)} proteins")
+    for name, mask in masks.items():
+        print(f"\t{name}: {int(mask.sum())} files")
+    if len(tests_table):
+        significant = tests_table.assign(significant=tests_table['fisher_q'] < 0.05) \
+            .groupby(['cohort_a', 'cohort_b'], sort=False)['significant'].sum()
+        for (name_a, name_b), number in significant.items():
+            print(f"\t{name_a} vs {name_b}: {number} proteins with Fisher q < 0.05")
+    print(f"Statistics written to {args.output}")
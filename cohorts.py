@@ -0,0 +1,287 @@
+"""
+Cohorts as row masks over one shared file table.
+
+The stage 5 table (wd/unambiguous_file_metadata_with_urls.csv) is written
+once as a Parquet file, wd/files.parquet, with the tumor stage spellings
+normalized ('Stage1', 'stage i' -> 'Stage I') into a `stage` column, the
+major stage in `stage_group` ('I' to 'IV') and the low-cardinality columns
+stored as categoricals. A cohort is a declarative predicate over its
+columns,
+
+    {"name": "late_breast",
+     "where": {"disease_type": "Breast Invasive Carcinoma", "stage_group": ["III", "IV"]}}
+
+and evaluates to a boolean mask over the table rows. A condition is a value
+(equality), a list (membership) or a dict of operators: in, not_in,
+startswith, matches (regular expression) and is_null. The conditions of a
+`where` must all hold; `any` (a list of wheres, one of which must hold) and
+`not` (a where that must not hold) combine them further.
+
+Only the columns a predicate mentions are read, memory-mapped, and each
+condition is evaluated once per category instead of once per row, so any
+number of cohorts share the same table. Counting applies the masks to the
+protein matrix directly (see align and write_to_csv.py); a cohort only
+needs a manifest (`python cohorts.py manifest NAME`) if its files still
+have to be downloaded.
+
+    python cohorts.py build
+    python cohorts.py --definitions cohorts.json count
+"""
+import os
+import re
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+DEFAULT_TABLE = 'wd/files.parquet'
+DEFAULT_SOURCE = 'wd/unambiguous_file_metadata_with_urls.csv'
+
+CATEGORICAL_COLUMNS = ['pdc_study_id', 'disease_type', 'tumor_stage', 'stage', 'stage_group']
+
+# names that may be used in predicates for the columns of the table
+ALIASES = {'study': 'pdc_study_id'}
+
+# the manifests of process_manifest_file.py, with the original predicates
+# of filter_by_stage.py over the raw tumor_stage (not the normalized stage),
+# so the default counts do not change
+DEFAULT_COHORTS = [
+    {'name': 'noninvasive', 'where': {'tumor_stage': ['Stage I', 'Stage1']}},
+    {'name': 'invasive', 'where': {'tumor_stage': {'startswith': 'Stage III'}}},
+]
+
+_STAGE_PATTERN = re.compile(r'^stage\s*(iv|i{1,3}|[1-4])\s*([abc][0-9]?)?$', re.IGNORECASE)
+_ARABIC_STAGES = {'1': 'I', '2': 'II', '3': 'III', '4': 'IV'}
+
+
+def normalize_stage(tumor_stage):
+    """
+    The canonical spelling of a tumor stage: 'Stage ' followed by the
+    roman stage and the substage, e.g. 'Stage1' -> 'Stage I' and
+    'stage 3a' -> 'Stage IIIA'. Other values (e.g. 'Not Reported') are
+    returned stripped, missing ones as None.
+    """
+    if not isinstance(tumor_stage, str) or not tumor_stage.strip():
+        return None
+    tumor_stage = ' '.join(tumor_stage.split())
+    match = _STAGE_PATTERN.match(tumor_stage)
+    if match is None:
+        return tumor_stage
+    stage, substage = match.groups()
+    stage = _ARABIC_STAGES.get(stage, stage.upper())
+    return f"Stage {stage}{(substage or '').upper()}"
+
+def stage_group(stage):
+    """
+    The major stage ('I', 'II', 'III' or 'IV') of a normalized stage, or None.
+    """
+    if not isinstance(stage, str):
+        return None
+    match = _STAGE_PATTERN.match(stage)
+    if match is None:
+        return None
+    return _ARABIC_STAGES.get(match.group(1), match.group(1).upper())
+
+def build_table(df):
+    """
+    The file table of a stage 5 DataFrame: stages normalized into `stage`
+    and `stage_group`, and the low-cardinality columns as categoricals.
+    Each distinct spelling is normalized once.
+    """
+    df = df.reset_index(drop=df.index.name is None)
+    # mapping a categorical maps its categories, not its rows
+    df['tumor_stage'] = df['tumor_stage'].astype('category')
+    df['stage'] = df['tumor_stage'].map(normalize_stage).astype('category')
+    df['stage_group'] = df['stage'].map(stage_group).astype('category')
+    for column in CATEGORICAL_COLUMNS:
+        if column in df:
+            df[column] = df[column].astype('category')
+    return df
+
+def write_table(df, path=DEFAULT_TABLE):
+    """
+    Write a file table (see build_table) as Parquet.
+    """
+    df.to_parquet(path, index=False)
+    return path
+
+
+def _condition_mask(values, condition):
+    """
+    Evaluate one condition over an array of values (not categorical).
+    """
+    values = pd.Series(values)
+    if not isinstance(condition, dict):
+        condition = {'in': condition if isinstance(condition, list) else [condition]}
+
+    mask = np.ones(len(values), dtype=bool)
+    for operator, argument in condition.items():
+        if operator == 'in':
+            mask &= values.isin(argument).to_numpy()
+        elif operator == 'not_in':
+            mask &= ~values.isin(argument).to_numpy() & values.notna().to_numpy()
+        elif operator == 'startswith':
+            prefixes = tuple(argument) if isinstance(argument, list) else argument
+            mask &= values.map(lambda value: isinstance(value, str) and value.startswith(prefixes)).to_numpy(bool)
+        elif operator == 'matches':
+            pattern = re.compile(argument)
+            mask &= values.map(lambda value: isinstance(value, str) and bool(pattern.search(value))).to_numpy(bool)
+        elif operator == 'is_null':
+            mask &= values.isna().to_numpy() == bool(argument)
+        else:
+            raise ValueError(f"Unknown cohort condition operator: {operator}")
+    return mask
+
+
+class CohortTable:
+    """
+    The file table at path (see build_table), read lazily one column at a time.
+    """
+
+    def __init__(self, path=DEFAULT_TABLE):
+        self.path = path
+        self.num_rows = pq.ParquetFile(path).metadata.num_rows
+        self._columns = {}
+
+    def __len__(self):
+        return self.num_rows
+
+    def column(self, name):
+        """
+        One column as a pandas Series, read on first use.
+        """
+        name = ALIASES.get(name, name)
+        if name not in self._columns:
+            table = pq.read_table(self.path, columns=[name], memory_map=True)
+            self._columns[name] = table.column(name).to_pandas()
+        return self._columns[name]
+
+    def _match(self, name, condition):
+        column = self.column(name)
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            # evaluate the condition over the categories, then look the rows up by code
+            codes = column.cat.codes.to_numpy()
+            by_category = _condition_mask(column.cat.categories, condition)
+            null = _condition_mask([None], condition)[0]
+            return np.where(codes >= 0, by_category[np.maximum(codes, 0)], null)
+        return _condition_mask(column, condition)
+
+    def mask(self, where):
+        """
+        Boolean mask of the rows matching a `where` predicate.
+        """
+        mask = np.ones(self.num_rows, dtype=bool)
+        for key, condition in where.items():
+            if key == 'any':
+                mask &= np.logical_or.reduce([self.mask(clause) for clause in condition]) \
+                    if condition else False
+            elif key == 'not':
+                mask &= ~self.mask(condition)
+            else:
+                mask &= self._match(key, condition)
+        return mask
+
+    def masks(self, definitions=DEFAULT_COHORTS):
+        """
+        {cohort name: boolean row mask} for a list of cohort definitions.
+        """
+        return {definition['name']: self.mask(definition['where']) for definition in definitions}
+
+    def rows(self, mask, columns=None):
+        """
+        The rows selected by mask as a DataFrame, with all or the given columns.
+        """
+        table = pq.read_table(self.path, columns=columns, memory_map=True)
+        return table.filter(mask).to_pandas()
+
+    def positions(self, keys, on='file_id'):
+        """
+        The table row of each of keys (values of column on), -1 for keys
+        not in the table.
+        """
+        return pd.Index(self.column(on)).get_indexer(pd.Index(keys))
+
+    def align(self, masks, keys, on='file_id'):
+        """
+        Carry row masks over to another list of files, e.g. the rows of a
+        protein matrix: {name: mask over keys}. Files missing from the
+        table belong to no cohort.
+        """
+        positions = self.positions(keys, on)
+        found = positions >= 0
+        return {
+            name: found & mask[np.maximum(positions, 0)] if len(positions) else np.zeros(0, dtype=bool)
+            for name, mask in masks.items()
+        }
+
+
+def load_definitions(path):
+    """
+    Cohort definitions from a JSON file: a list of {"name": ..., "where": {...}}.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        definitions = json.load(f)
+    names = [definition['name'] for definition in definitions]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Cohort names in {path} are not unique")
+    return definitions
+
+
+def cohort_masks(matrix, file_ids, definitions=DEFAULT_COHORTS, table_path=DEFAULT_TABLE, include_all=True):
+    """
+    {cohort name: boolean mask over the rows of a protein matrix} of the
+    files with file_ids, from the file table at table_path if there is one,
+    else from the matrix groups (the download keywords) named like the
+    cohorts. With include_all, 'all' selects every row.
+    """
+    if file_ids is not None and os.path.exists(table_path):
+        cohort_table = CohortTable(table_path)
+        masks = cohort_table.align(cohort_table.masks(definitions), file_ids)
+    else:
+        masks = {definition['name']: matrix.group_mask(definition['name']) for definition in definitions}
+    if include_all:
+        masks['all'] = np.ones(matrix.num_files, dtype=bool)
+    return masks
+
+def output_name(name):
+    """
+    A cohort name as used in output file names.
+    """
+    return name.replace('/', '_')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the file table and evaluate cohorts over it.')
+    parser.add_argument('--table', default=DEFAULT_TABLE)
+    parser.add_argument('--definitions', default=None,
+                        help='JSON list of cohort definitions (default: noninvasive and invasive)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='write the file table from a stage 5 CSV')
+    build_parser.add_argument('--input', default=DEFAULT_SOURCE)
+    subparsers.add_parser('count', help='print the number of files of each cohort')
+    manifest_parser = subparsers.add_parser(
+        'manifest', help='write data_<name>.csv, the process_manifest_file.py manifest of a cohort')
+    manifest_parser.add_argument('name')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        df = build_table(pd.read_csv(args.input))
+        write_table(df, args.table)
+        print(f"Wrote {len(df)} files to {args.table}")
+        print("Stages:", ', '.join(map(str, df['stage'].cat.categories)))
+    else:
+        definitions = load_definitions(args.definitions) if args.definitions else DEFAULT_COHORTS
+        cohort_table = CohortTable(args.table)
+        masks = cohort_table.masks(definitions)
+        if args.command == 'count':
+            for name, mask in masks.items():
+                print(f"{name}: {int(mask.sum())} of {len(cohort_table)} files")
+        else:
+            if args.name not in masks:
+                raise SystemExit(f"No cohort named {args.name}")
+            rows = cohort_table.rows(masks[args.name])
+            rows = rows.drop(columns=['stage', 'stage_group'])
+            rows.to_csv(f'data_{args.name}.csv', index=False)
+            print(f"Wrote {len(rows)} files to data_{args.name}.csv")
@@ -0,0 +1,221 @@
+"""
+Resumable, verified downloads of the .mzid.gz files.
+
+Transfers go to "<file>.part" and are resumed with HTTP Range requests when
+they break off, so an interrupted multi-GB download continues where it
+stopped instead of starting over. The finished file is checked against the
+size and MD5 reported by PDC before it is renamed into place. All downloads
+share one connection-pooled requests.Session. Signed URLs that have expired
+(403) are refreshed through files_per_study(update=True).
+"""
+import os
+import sys
+import time
+import asyncio
+import hashlib
+import threading
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+_PDC_SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdc_discovery_scripts')
+if _PDC_SCRIPTS_DIR not in sys.path:
+    sys.path.append(_PDC_SCRIPTS_DIR)
+
+from pdc_api.utils import telemetry
+
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_TIMEOUT = (20, 300)  # (connect, read) seconds
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class DownloadError(Exception):
+    """
+    A download failed for good, or did not match the expected size or MD5.
+    """
+
+
+def get_session(pool_size=16):
+    """
+    The requests.Session shared by all downloads of this process, with a
+    connection pool of pool_size connections per host.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def is_complete(path, expected_size=None, expected_md5=None):
+    """
+    Whether path holds a finished download. Without an expected size or MD5
+    there is nothing to check against, so the file is not trusted.
+    """
+    if not os.path.isfile(path) or (expected_size is None and not expected_md5):
+        return False
+    if expected_size is not None and os.path.getsize(path) != expected_size:
+        return False
+    if expected_md5 and file_md5(path) != expected_md5.lower():
+        return False
+    return True
+
+def download_file(url, local_filename, expected_size=None, expected_md5=None, refresh_url=None,
+                  max_attempts=5, timeout=DEFAULT_TIMEOUT):
+    """
+    Download url to local_filename, resuming from local_filename + '.part'.
+
+    expected_size and expected_md5 (from PDC file metadata) are checked
+    before the file is moved into place; a file that already passes the
+    check is not downloaded again. refresh_url() is called for a new URL when
+    the server answers 401/403, i.e. the signed URL has expired. Connection
+    errors, timeouts, 429/5xx answers and short transfers are retried up to
+    max_attempts times with exponential backoff.
+
+    Each call is recorded as a `download` telemetry event with the bytes
+    transferred, the attempts taken and the offset it resumed from.
+    """
+    with telemetry.span('download', file=os.path.basename(local_filename)) as event:
+        return _download_file(url, local_filename, expected_size, expected_md5, refresh_url,
+                              max_attempts, timeout, event)
+
+def _download_file(url, local_filename, expected_size, expected_md5, refresh_url, max_attempts, timeout,
+                   event):
+    event.update(bytes=0, attempts=0, resumed_from=0, refreshed=0)
+    if is_complete(local_filename, expected_size, expected_md5):
+        event['complete'] = True
+        return local_filename
+
+    part_path = local_filename + '.part'
+    session = get_session()
+    last_error = None
+
+    for attempt in range(1, max_attempts + 1):
+        if attempt > 1:
+            time.sleep(min(60, 2 ** (attempt - 2)))
+        event['attempts'] = attempt
+
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if expected_size is not None and offset > expected_size:
+            os.remove(part_path)
+            offset = 0
+        if attempt == 1:
+            event['resumed_from'] = offset
+
+        if expected_size is None or offset < expected_size:
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+            expired = False
+            try:
+                with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                    if response.status_code in (401, 403) and refresh_url is not None:
+                        last_error = DownloadError(f"{response.status_code} for {local_filename}; signed URL expired")
+                        expired = True
+                    elif response.status_code == 429 or response.status_code >= 500:
+                        last_error = DownloadError(f"{response.status_code} for {local_filename}")
+                        continue
+                    elif response.status_code == 416:
+                        # nothing left to send: the part file is already complete
+                        pass
+                    else:
+                        response.raise_for_status()
+                        if offset and response.status_code != 206:
+                            # the server ignored the Range header and sends everything
+                            offset = 0
+                        with open(part_path, 'ab' if offset else 'wb') as out_file:
+                            # raw bytes: the .gz must not be decoded by a Content-Encoding
+                            for chunk in response.raw.stream(CHUNK_SIZE, decode_content=False):
+                                out_file.write(chunk)
+                                event['bytes'] += len(chunk)
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError,
+                    # reading response.raw directly raises urllib3's own errors
+                    urllib3.exceptions.HTTPError) as e:
+                last_error = e
+                continue
+            if expired:
+                # refreshed after the response is closed, so its connection
+                # goes back to the pool while PDC is queried
+                url = refresh_url()
+                event['refreshed'] += 1
+                continue
+
+        size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if expected_size is not None and size < expected_size:
+            last_error = DownloadError(f"{local_filename}: got {size} of {expected_size} bytes")
+            continue
+        if (expected_size is not None and size > expected_size) or \
+                (expected_md5 and file_md5(part_path) != expected_md5.lower()):
+            os.remove(part_path)
+            last_error = DownloadError(f"{local_filename} does not match the size/MD5 from PDC")
+            continue
+
+        os.replace(part_path, local_filename)
+        return local_filename
+
+    raise DownloadError(f"Failed to download {local_filename} after {max_attempts} attempts: {last_error}")
+
+
+def _fetch_signed_urls(pdc_study_id):
+    """
+    {file_id: fresh signed URL} for every file of a study.
+    """
+    import httpx
+    from pdc_api.utils.waiter import Waiter
+    from pdc_api.files_per_study import files_per_study
+
+    async def fetch():
+        async with httpx.AsyncClient(
+            timeout=httpx.Timeout(60.0, connect=20.0),
+            transport=httpx.AsyncHTTPTransport(retries=5),
+        ) as client:
+            files = await files_per_study(
+                client=client,
+                waiter=Waiter(),
+                pdc_study_id=pdc_study_id,
+                update=True,
+            )
+        return {file['file_id']: file['signedUrl']['url'] for file in files}
+
+    return asyncio.run(fetch())
+
+
+class SignedUrlRefresher:
+    """
+    Re-fetches expired signed URLs, one files_per_study(update=True) query
+    per study. Threads that hit an expired URL of the same study within
+    max_age seconds reuse the result instead of querying again; studies are
+    refreshed independently of each other.
+    """
+
+    def __init__(self, max_age=600):
+        self.max_age = max_age
+        self._lock = threading.Lock()  # guards _study_locks
+        self._study_locks = {}  # pdc_study_id -> lock of its refresh
+        self._urls = {}  # pdc_study_id -> (fetched at, {file_id: url})
+
+    def _study_lock(self, pdc_study_id):
+        with self._lock:
+            return self._study_locks.setdefault(pdc_study_id, threading.Lock())
+
+    def __call__(self, pdc_study_id, file_id):
+        with self._study_lock(pdc_study_id):
+            fetched_at, urls = self._urls.get(pdc_study_id, (None, None))
+            if fetched_at is None or time.monotonic() - fetched_at > self.max_age:
+                urls = _fetch_signed_urls(pdc_study_id)
+                self._urls[pdc_study_id] = (time.monotonic(), urls)
+        if file_id not in urls:
+            raise DownloadError(f"PDC returned no download URL for {file_id} in {pdc_study_id}")
+        return urls[file_id]
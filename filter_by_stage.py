@@ -1,17 +1,52 @@
 import pandas as pd
 
+from cohorts import build_table
+from cohorts import write_table
+from cohorts import DEFAULT_TABLE
 
-df = pd.read_csv('./wd/unambiguous_file_metadata_with_urls.csv')
 
-# Print unique values from the "tumor_stage" column
-print("Unique values in 'tumor_stage':", df['tumor_stage'].unique())
+def stage_keyword(tumor_stage):
+    """
+    Return the manifest keyword ('noninvasive' or 'invasive') of a tumor stage,
+    or None if the stage belongs to neither group. Matches the default
+    cohorts of cohorts.py, which keep the original predicates on the raw
+    tumor_stage: 'Stage I' or 'Stage1', and anything starting with 'Stage III'
+    (e.g. 'Stage III/IV').
+    """
+    # non-invasive tumors: stage I without a substage
+    if tumor_stage in ('Stage I', 'Stage1'):
+        return 'noninvasive'
+    # invasive tumors
+    if isinstance(tumor_stage, str) and tumor_stage.startswith('Stage III'):
+        return 'invasive'
+    return None
 
-# Filter rows for non-invasive tumors
-filtered_data = df[df['tumor_stage'].isin(['Stage I', 'Stage1'])]
-print(f"Found {len(filtered_data)} non-invasive datapoints")
-filtered_data.to_csv('data_noninvasive.csv', index=False)
+def filter_by_stage(df):
+    """
+    Split a file metadata table into {keyword: rows} by tumor stage.
+    """
+    keywords = df['tumor_stage'].map(stage_keyword)
+    return {
+        keyword: df[keywords == keyword]
+        for keyword in ('noninvasive', 'invasive')
+    }
 
-# Filter rows for invasive tumors
-filtered_data = df[df['tumor_stage'].str.startswith('Stage III', na=False)]
-filtered_data.to_csv('data_invasive.csv', index=False)
-print(f"Found {len(filtered_data)} invasive datapoints")
+
+if __name__ == '__main__':
+    df = pd.read_csv('./wd/unambiguous_file_metadata_with_urls.csv')
+
+    # Print unique values from the "tumor_stage" column
+    print("Unique values in 'tumor_stage':", df['tumor_stage'].unique())
+
+    filtered = filter_by_stage(df)
+
+    # the same files once, for cohorts.py and write_to_csv.py
+    write_table(build_table(df), DEFAULT_TABLE)
+
+    filtered_data = filtered['noninvasive']
+    print(f"Found {len(filtered_data)} non-invasive datapoints")
+    filtered_data.to_csv('data_noninvasive.csv', index=False)
+
+    filtered_data = filtered['invasive']
+    filtered_data.to_csv('data_invasive.csv', index=False)
+    print(f"Found {len(filtered_data)} invasive datapoints")
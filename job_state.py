@@ -0,0 +1,228 @@
+"""
+Persistent state of the download/parse jobs, one SQLite row per file_id.
+
+A job moves through
+
+    queued -> downloading -> downloaded -> parsed
+                   \\              \\
+                    `-> failed <---'
+
+and records its attempts, download/parse durations, size in bytes and
+protein count. A worker claims a job with one conditional UPDATE, so
+several workers (threads or processes) sharing the table never take the same
+job. A run that crashed leaves jobs in downloading/downloaded; recover()
+puts them back in the queue.
+"""
+import os
+import time
+import sqlite3
+import argparse
+import tempfile
+
+QUEUED = 'queued'
+DOWNLOADING = 'downloading'
+DOWNLOADED = 'downloaded'
+PARSED = 'parsed'
+FAILED = 'failed'
+
+STATES = [QUEUED, DOWNLOADING, DOWNLOADED, PARSED, FAILED]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    file_id TEXT PRIMARY KEY,
+    keyword TEXT NOT NULL DEFAULT '',
+    file_name TEXT NOT NULL DEFAULT '',
+    file_url TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    download_seconds REAL,
+    parse_seconds REAL,
+    bytes INTEGER,
+    protein_count INTEGER,
+    error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+"""
+
+
+def write_atomic(path, text):
+    """
+    Write text to path through a temporary file in the same directory and a
+    rename, so readers (and a rerun after a crash) see either the old or the
+    complete new file, never a partial one.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class JobState:
+    """
+    The job table in the SQLite database at path. Each thread gets its own
+    connection; transactions make every update atomic.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(_SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.execute('PRAGMA busy_timeout=30000')
+        return _Connection(db)
+
+    def claim(self, job):
+        """
+        Register job (a process_manifest_file job dict) and take it for
+        downloading. Returns False if the job is parsed already or another
+        worker is working on it.
+        """
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR IGNORE INTO jobs (file_id, keyword, file_name, file_url, state, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (job['file_id'], job['keyword'], job['file_name'], job['file_url'], QUEUED, now),
+            )
+            cursor = db.execute(
+                "UPDATE jobs SET state = ?, attempts = attempts + 1, error = NULL, file_url = ?, updated_at = ? "
+                "WHERE file_id = ? AND state IN (?, ?)",
+                (DOWNLOADING, job['file_url'], now, job['file_id'], QUEUED, FAILED),
+            )
+            return cursor.rowcount == 1
+
+    def downloaded(self, file_id, seconds, size):
+        self._update(file_id, state=DOWNLOADED, download_seconds=seconds, bytes=size)
+
+    def parsed(self, file_id, seconds, protein_count):
+        self._update(file_id, state=PARSED, parse_seconds=seconds, protein_count=protein_count)
+
+    def failed(self, file_id, error):
+        self._update(file_id, state=FAILED, error=str(error))
+
+    def mark_parsed(self, job, protein_count):
+        """
+        Record a job whose proteins reached the store without going through
+        claim(), e.g. a protein list imported from an older run.
+        """
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO jobs (file_id, keyword, file_name, file_url, state, protein_count, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (file_id) DO UPDATE SET state = excluded.state, "
+                "protein_count = excluded.protein_count, updated_at = excluded.updated_at",
+                (job['file_id'], job['keyword'], job['file_name'], job['file_url'], PARSED, protein_count,
+                 time.time()),
+            )
+
+    def _update(self, file_id, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f'{column} = ?' for column in fields)
+        with self._connect() as db:
+            db.execute(f"UPDATE jobs SET {assignments} WHERE file_id = ?", (*fields.values(), file_id))
+
+    def recover(self):
+        """
+        Put jobs left in downloading/downloaded by a crashed run back in the
+        queue. Only call this while no other worker uses the table. Returns
+        the number of jobs requeued.
+        """
+        with self._connect() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET state = ?, updated_at = ? WHERE state IN (?, ?)",
+                (QUEUED, time.time(), DOWNLOADING, DOWNLOADED),
+            )
+            return cursor.rowcount
+
+    def merge(self, path):
+        """
+        Copy in the jobs of another job table, e.g. a shard's, except those
+        this table has parsed already.
+        """
+        with self._connect() as db:
+            db.execute("ATTACH DATABASE ? AS other", (path,))
+            db.execute(
+                "INSERT OR REPLACE INTO jobs SELECT * FROM other.jobs "
+                "WHERE file_id NOT IN (SELECT file_id FROM main.jobs WHERE state = ?)",
+                (PARSED,),
+            )
+
+    def counts(self, keyword=None):
+        """
+        {state: number of jobs}, for one keyword or all of them.
+        """
+        query = "SELECT state, COUNT(*) FROM jobs"
+        params = ()
+        if keyword is not None:
+            query += " WHERE keyword = ?"
+            params = (keyword,)
+        with self._connect() as db:
+            found = dict(db.execute(query + " GROUP BY state", params).fetchall())
+        return {state: found.get(state, 0) for state in STATES}
+
+    def problematic(self, keyword, max_proteins):
+        """
+        (file_name, protein_count, file_url) of the parsed files of keyword
+        with fewer than max_proteins proteins, fewest first.
+        """
+        with self._connect() as db:
+            return db.execute(
+                "SELECT file_name, protein_count, file_url FROM jobs "
+                "WHERE keyword = ? AND state = ? AND protein_count < ? "
+                "ORDER BY protein_count, file_name",
+                (keyword, PARSED, max_proteins),
+            ).fetchall()
+
+    def totals(self):
+        """
+        Sums over the parsed jobs: files, bytes, download and parse seconds.
+        """
+        with self._connect() as db:
+            return db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0), COALESCE(SUM(download_seconds), 0), "
+                "COALESCE(SUM(parse_seconds), 0) FROM jobs WHERE state = ?",
+                (PARSED,),
+            ).fetchone()
+
+
+class _Connection:
+    """
+    A sqlite3 connection that is closed (not just committed) on exit.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, *exc_info):
+        self.db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the job table of a protein store.')
+    parser.add_argument('--jobs', default=os.path.join('protein_store', 'jobs.sqlite3'))
+    parser.add_argument('--keyword', default=None)
+    args = parser.parse_args()
+
+    state = JobState(args.jobs)
+    for name, count in state.counts(args.keyword).items():
+        print(f"{name}: {count}")
+    files, size, download_seconds, parse_seconds = state.totals()
+    print(f"parsed {files} files, {size / 1e9:.2f} GB, "
+          f"{download_seconds:.0f} s downloading, {parse_seconds:.0f} s parsing")
@@ -0,0 +1,315 @@
+"""
+Fast protein extraction from mzIdentML files.
+
+pyteomics builds a full nested dict for every spectrum, with every reference
+resolved, although the protein lists only need the 'protein description' of
+the DBSequence behind a PeptideEvidence. This module streams the file once
+with lxml.etree.iterparse instead. mzIdentML puts the SequenceCollection
+before the AnalysisData, so every PeptideEvidence -> DBSequence reference can
+be resolved before the first spectrum is seen, and the source never has to be
+rewound. It can therefore be a path, a gzip stream or an HTTP response body.
+
+read_psms keeps every peptide-spectrum match (PSM) instead of a set of
+proteins: one row per evidence of every SpectrumIdentificationItem, in
+typed arrays, from which protein_table derives spectral counts, distinct
+peptides and best scores per protein.
+"""
+import gzip
+from array import array
+
+import numpy as np
+import pandas as pd
+from lxml import etree
+
+PROTEIN_DESCRIPTION = 'protein description'
+PROTEIN_DESCRIPTION_ACCESSION = 'MS:1001088'
+
+# MS-GF+ scores of a SpectrumIdentificationItem; a lower E-value is better
+SCORE_ACCESSION = 'MS:1002052'
+# MS-GF:QValue, or the generic PSM-level q-value of other search engines
+Q_VALUE_ACCESSIONS = ('MS:1002054', 'MS:1002354')
+
+_DB_SEQUENCE = '{*}DBSequence'
+_PEPTIDE = '{*}Peptide'
+_PEPTIDE_SEQUENCE = '{*}PeptideSequence'
+_PEPTIDE_EVIDENCE = '{*}PeptideEvidence'
+_SPECTRUM_RESULT = '{*}SpectrumIdentificationResult'
+_SPECTRUM_ITEM = '{*}SpectrumIdentificationItem'
+_PEPTIDE_EVIDENCE_REF = '{*}PeptideEvidenceRef'
+_CV_PARAM = '{*}cvParam'
+
+
+def _local_name(tag):
+    return tag.rpartition('}')[2]
+
+def _protein_description(db_sequence):
+    for param in db_sequence.iterchildren(_CV_PARAM):
+        if (param.get('name') == PROTEIN_DESCRIPTION
+                or param.get('accession') == PROTEIN_DESCRIPTION_ACCESSION):
+            return param.get('value')
+    return None
+
+def _release(elem):
+    """
+    Free an element and every already parsed sibling before it.
+    """
+    elem.clear(keep_tail=True)
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+def iter_evidence_proteins(source, all_evidence=False):
+    """
+    Yield (spectrum_id, protein_description) for the identified spectra of an
+    mzIdentML file.
+
+    By default only the first PeptideEvidenceRef of the first
+    SpectrumIdentificationItem of each spectrum is used, like
+    process_manifest_file.extract_proteins. With all_evidence=True every
+    evidence of every item is yielded, like pytenomics.extract_proteins_frommzid.
+    Evidences whose DBSequence has no protein description are skipped.
+    Paths ending in .gz are decompressed on the fly.
+    """
+    if isinstance(source, str) and source.endswith('.gz'):
+        with gzip.open(source, 'rb') as f:
+            yield from iter_evidence_proteins(f, all_evidence=all_evidence)
+        return
+
+    # DBSequence id -> protein description, PeptideEvidence id -> DBSequence id
+    descriptions = {}
+    evidence_to_sequence = {}
+
+    events = etree.iterparse(
+        source,
+        events=('end',),
+        tag=(_DB_SEQUENCE, _PEPTIDE_EVIDENCE, _SPECTRUM_RESULT),
+        huge_tree=True,
+        remove_comments=True,
+    )
+    for _, elem in events:
+        name = _local_name(elem.tag)
+
+        if name == 'SpectrumIdentificationResult':
+            spectrum_id = elem.get('id')
+            for item in elem.iterchildren(_SPECTRUM_ITEM):
+                for ref in item.iterchildren(_PEPTIDE_EVIDENCE_REF):
+                    description = descriptions.get(
+                        evidence_to_sequence.get(ref.get('peptideEvidence_ref')))
+                    if description is not None:
+                        yield spectrum_id, description
+                    if not all_evidence:
+                        break
+                if not all_evidence:
+                    break
+
+        elif name == 'PeptideEvidence':
+            evidence_to_sequence[elem.get('id')] = elem.get('dBSequence_ref')
+
+        else:
+            description = _protein_description(elem)
+            if description is not None:
+                descriptions[elem.get('id')] = description
+
+        _release(elem)
+
+def extract_proteins_iterparse(source, all_evidence=False):
+    """
+    Extract protein names from an mzid file with a single forward pass.
+    source is a path or a binary file-like object, which does not need to be
+    seekable. Returns a set of protein names, identical to the one built by
+    process_manifest_file.extract_proteins (or pytenomics.extract_proteins_frommzid
+    with all_evidence=True).
+    """
+    return {
+        protein
+        for _, protein in iter_evidence_proteins(source, all_evidence=all_evidence)
+    }
+
+
+class PsmEvidence:
+    """
+    The peptide-spectrum matches of one mzIdentML file, one row per
+    PeptideEvidenceRef of every SpectrumIdentificationItem whose protein has
+    a description, as parallel typed arrays:
+
+    spectrum  -- number of the SpectrumIdentificationResult
+    item      -- number of the SpectrumIdentificationItem (the PSM)
+    rank      -- rank of the item within its spectrum
+    protein   -- code into proteins (protein descriptions)
+    peptide   -- code into peptides (peptide sequences)
+    score     -- MS-GF:SpecEValue of the item (NaN if missing)
+    q_value   -- PSM q-value of the item (NaN if missing)
+    first     -- the first evidence of the first item of its spectrum, the
+                 only one process_manifest_file.extract_proteins looks at
+    """
+    COLUMNS = ['spectrum', 'item', 'rank', 'protein', 'peptide', 'score', 'q_value', 'first']
+
+    def __init__(self, proteins, peptides, spectrum, item, rank, protein, peptide, score, q_value, first):
+        self.proteins = np.asarray(proteins, dtype=object)
+        self.peptides = np.asarray(peptides, dtype=object)
+        self.spectrum = np.asarray(spectrum, dtype=np.int32)
+        self.item = np.asarray(item, dtype=np.int32)
+        self.rank = np.asarray(rank, dtype=np.int16)
+        self.protein = np.asarray(protein, dtype=np.int32)
+        self.peptide = np.asarray(peptide, dtype=np.int32)
+        self.score = np.asarray(score, dtype=np.float64)
+        self.q_value = np.asarray(q_value, dtype=np.float64)
+        self.first = np.asarray(first, dtype=bool)
+
+    def __len__(self):
+        return len(self.protein)
+
+    def protein_set(self, all_evidence=False, max_q_value=None):
+        """
+        The protein names extract_proteins_iterparse returns for the file.
+        With max_q_value, only PSMs with a q-value at most that are used.
+        """
+        return set(self.proteins[protein_codes(self.protein, self.first, self.q_value,
+                                               all_evidence, max_q_value)].tolist())
+
+
+def protein_codes(protein, first, q_value, all_evidence=False, max_q_value=None):
+    """
+    The distinct protein codes selected from PSM rows by the protein list
+    rules (see PsmEvidence.protein_set).
+    """
+    rows = np.ones(len(protein), dtype=bool) if all_evidence else first.copy()
+    if max_q_value is not None:
+        rows &= q_value <= max_q_value
+    return np.unique(protein[rows])
+
+
+def _item_scores(item):
+    score = q_value = np.nan
+    for param in item.iterchildren(_CV_PARAM):
+        accession = param.get('accession')
+        if accession == SCORE_ACCESSION:
+            score = float(param.get('value'))
+        elif accession in Q_VALUE_ACCESSIONS:
+            q_value = float(param.get('value'))
+    return score, q_value
+
+def read_psms(source):
+    """
+    Read every peptide-spectrum match of an mzIdentML file into a
+    PsmEvidence, in one forward pass like iter_evidence_proteins. Evidences
+    whose DBSequence has no protein description are skipped. Paths ending in
+    .gz are decompressed on the fly.
+    """
+    if isinstance(source, str) and source.endswith('.gz'):
+        with gzip.open(source, 'rb') as f:
+            return read_psms(f)
+
+    # id -> code of the protein description / peptide sequence
+    protein_codes = {}
+    peptide_codes = {}
+    # DBSequence id -> protein code, Peptide id -> peptide code,
+    # PeptideEvidence id -> (protein code, peptide code)
+    sequence_to_protein = {}
+    peptide_to_code = {}
+    evidence_to_codes = {}
+
+    columns = {
+        'spectrum': array('i'), 'item': array('i'), 'rank': array('h'), 'protein': array('i'),
+        'peptide': array('i'), 'score': array('d'), 'q_value': array('d'), 'first': array('b'),
+    }
+    num_spectra = 0
+    num_items = 0
+
+    events = etree.iterparse(
+        source,
+        events=('end',),
+        tag=(_DB_SEQUENCE, _PEPTIDE, _PEPTIDE_EVIDENCE, _SPECTRUM_RESULT),
+        huge_tree=True,
+        remove_comments=True,
+    )
+    for _, elem in events:
+        name = _local_name(elem.tag)
+
+        if name == 'SpectrumIdentificationResult':
+            first_item = True
+            for item in elem.iterchildren(_SPECTRUM_ITEM):
+                score, q_value = _item_scores(item)
+                rank = int(item.get('rank', 0))
+                first_evidence = first_item
+                for ref in item.iterchildren(_PEPTIDE_EVIDENCE_REF):
+                    codes = evidence_to_codes.get(ref.get('peptideEvidence_ref'))
+                    if codes is not None and codes[0] is not None:
+                        columns['spectrum'].append(num_spectra)
+                        columns['item'].append(num_items)
+                        columns['rank'].append(rank)
+                        columns['protein'].append(codes[0])
+                        columns['peptide'].append(codes[1])
+                        columns['score'].append(score)
+                        columns['q_value'].append(q_value)
+                        columns['first'].append(first_evidence)
+                    first_evidence = False
+                first_item = False
+                num_items += 1
+            num_spectra += 1
+
+        elif name == 'PeptideEvidence':
+            evidence_to_codes[elem.get('id')] = (
+                sequence_to_protein.get(elem.get('dBSequence_ref')),
+                peptide_to_code.get(elem.get('peptide_ref'), -1),
+            )
+
+        elif name == 'Peptide':
+            sequence = elem.findtext(_PEPTIDE_SEQUENCE)
+            if sequence is not None:
+                peptide_to_code[elem.get('id')] = peptide_codes.setdefault(sequence, len(peptide_codes))
+
+        else:
+            description = _protein_description(elem)
+            if description is not None:
+                sequence_to_protein[elem.get('id')] = protein_codes.setdefault(description, len(protein_codes))
+
+        _release(elem)
+
+    return PsmEvidence(
+        list(protein_codes), list(peptide_codes),
+        **{column: np.frombuffer(values, dtype=values.typecode) for column, values in columns.items()},
+    )
+
+def protein_table(psms, max_q_value=None, rank=1):
+    """
+    Spectral counts of the proteins of a PsmEvidence: per protein the
+    number of PSMs (items of the given rank, None for all) it is evidenced
+    by, its distinct peptides and its best (lowest) score and q-value. With
+    max_q_value, only PSMs with a q-value at most that are counted.
+    """
+    rows = np.ones(len(psms), dtype=bool)
+    if rank is not None:
+        rows &= psms.rank == rank
+    if max_q_value is not None:
+        rows &= psms.q_value <= max_q_value
+    protein = psms.protein[rows]
+    num_proteins = len(psms.proteins)
+
+    # a PSM counts once per protein, however many of its evidences point there
+    psm_pairs = np.unique(np.stack([protein, psms.item[rows]]), axis=1)
+    peptide_pairs = np.unique(np.stack([protein, psms.peptide[rows]]), axis=1)
+    psm_count = np.bincount(psm_pairs[0], minlength=num_proteins)
+    peptide_count = np.bincount(peptide_pairs[0][peptide_pairs[1] >= 0], minlength=num_proteins)
+    best_score = np.full(num_proteins, np.nan)
+    best_q_value = np.full(num_proteins, np.nan)
+    np.fmin.at(best_score, protein, psms.score[rows])
+    np.fmin.at(best_q_value, protein, psms.q_value[rows])
+
+    found = np.flatnonzero(psm_count)
+    table = pd.DataFrame({
+        'protein': psms.proteins[found],
+        'psm_count': psm_count[found].astype(np.int32),
+        'peptides': peptide_count[found].astype(np.int32),
+        'best_score': best_score[found],
+        'best_q_value': best_q_value[found],
+    })
+    return table.sort_values(['psm_count', 'protein'], ascending=[False, True], ignore_index=True)
+
+def extract_protein_table(source, max_q_value=None, rank=1):
+    """
+    read_psms and protein_table in one call: the per-protein spectral
+    counts of an mzid file.
+    """
+    return protein_table(read_psms(source), max_q_value=max_q_value, rank=rank)
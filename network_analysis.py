@@ -0,0 +1,328 @@
+"""
+Graph analytics of the cohort networks written by protein_network.py.
+
+Each network (networks/<cohort>.parquet) is loaded into a symmetric CSR
+adjacency matrix over its proteins, and every measure works on the CSR
+arrays directly:
+
+    degree, strength  number and total weight of a protein's edges
+    pagerank          power iteration over the edge weights
+    betweenness       Brandes' algorithm over shortest paths (in edges),
+                      one breadth-first search per source, level by level
+                      with sparse products; exact for small networks, else
+                      estimated from a random sample of sources. The
+                      sources are split over a process pool.
+    community         label propagation over the edge weights
+
+Differential edges compare two cohorts over the union of their edges: the
+files sharing both proteins are counted in each cohort from the protein
+store, and tested with Fisher's exact test (see cohort_stats.py), with
+Benjamini-Hochberg q-values.
+
+The results are Parquet tables in the output folder, <cohort>_nodes.parquet
+per network and <a>_vs_<b>_edges.parquet per comparison.
+
+    python network_analysis.py
+    python network_analysis.py --cohorts invasive --samples 1000 --workers 8
+    python network_analysis.py --compare invasive noninvasive
+"""
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdc_discovery_scripts'))
+
+from pdc_api.utils import telemetry
+from cohort_stats import fdr_bh
+from cohort_stats import fisher_exact_many
+from cohorts import DEFAULT_COHORTS
+from cohorts import DEFAULT_TABLE
+from cohorts import cohort_masks
+from cohorts import output_name
+from cohorts import load_definitions
+from protein_store import load_matrix
+
+# the adjacency of the network, set once per worker process
+_adjacency = None
+
+
+def load_network(path):
+    """
+    (proteins, adjacency) of an edge table written by protein_network.py:
+    the proteins in order of first appearance and a symmetric CSR matrix of
+    the edge weights.
+    """
+    edges = pd.read_parquet(path, columns=['source', 'target', 'weight'])
+    codes, proteins = pd.factorize(pd.concat([edges['source'], edges['target']], ignore_index=True))
+    source, target = codes[:len(edges)], codes[len(edges):]
+    weights = edges['weight'].to_numpy(float)
+    adjacency = sparse.csr_matrix(
+        (np.concatenate([weights, weights]), (np.concatenate([source, target]), np.concatenate([target, source]))),
+        shape=(len(proteins), len(proteins)),
+    )
+    adjacency.sort_indices()
+    return np.asarray(proteins, dtype=object), adjacency
+
+
+def pagerank(adjacency, damping=0.85, tolerance=1e-10, max_iterations=200):
+    """
+    PageRank of a weighted adjacency matrix; the rank of proteins without
+    edges is spread over all proteins.
+    """
+    n = adjacency.shape[0]
+    if n == 0:
+        return np.zeros(0)
+    strength = np.asarray(adjacency.sum(axis=1)).ravel()
+    dangling = strength == 0
+    inverse = np.divide(1.0, strength, out=np.zeros(n), where=~dangling)
+    transition = adjacency.T.tocsr()
+
+    rank = np.full(n, 1.0 / n)
+    for _ in range(max_iterations):
+        updated = damping * (transition @ (rank * inverse) + rank[dangling].sum() / n) + (1 - damping) / n
+        converged = np.abs(updated - rank).sum() < n * tolerance
+        rank = updated
+        if converged:
+            break
+    return rank / rank.sum()
+
+
+def _init_worker(adjacency):
+    global _adjacency
+    _adjacency = adjacency
+
+def _source_dependencies(sources):
+    """
+    The summed dependencies of all proteins on the shortest paths from
+    sources (Brandes), each search run a whole level at a time.
+    """
+    adjacency = _adjacency
+    n = adjacency.shape[0]
+    total = np.zeros(n)
+    for source in sources:
+        distance = np.full(n, -1)
+        distance[source] = 0
+        paths = np.zeros(n)
+        paths[source] = 1
+        levels = [np.array([source])]
+        while True:
+            frontier = levels[-1]
+            reached = adjacency[frontier].T @ paths[frontier]
+            new = np.flatnonzero((reached > 0) & (distance < 0))
+            if len(new) == 0:
+                break
+            paths[new] = reached[new]
+            distance[new] = len(levels)
+            levels.append(new)
+
+        dependency = np.zeros(n)
+        for depth in range(len(levels) - 2, -1, -1):
+            below = levels[depth + 1]
+            coefficient = np.zeros(n)
+            coefficient[below] = (1 + dependency[below]) / paths[below]
+            level = levels[depth]
+            dependency[level] = paths[level] * (adjacency[level] @ coefficient)
+        dependency[source] = 0
+        total += dependency
+    return total
+
+def betweenness(adjacency, samples=None, seed=0, workers=None, chunk_size=16):
+    """
+    Normalized betweenness centrality over unweighted shortest paths. With
+    samples (fewer than the proteins), only that many random sources are
+    searched and the result is scaled up. Sources are searched by a pool of
+    workers processes in chunks of chunk_size.
+    """
+    n = adjacency.shape[0]
+    if n < 3:
+        return np.zeros(n)
+    structure = adjacency.astype(bool).astype(np.float64)
+    if samples is not None and samples < n:
+        sources = np.sort(np.random.default_rng(seed).choice(n, samples, replace=False))
+        scale = n / samples
+    else:
+        sources = np.arange(n)
+        scale = 1.0
+    chunks = [sources[i:i + chunk_size] for i in range(0, len(sources), chunk_size)]
+
+    if workers == 1 or len(chunks) <= 1:
+        _init_worker(structure)
+        total = sum(map(_source_dependencies, chunks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(structure,)) as executor:
+            total = sum(executor.map(_source_dependencies, chunks))
+    # every path of an undirected network is found from both of its ends
+    return total * scale / ((n - 1) * (n - 2))
+
+
+def label_propagation(adjacency, max_iterations=100, seed=0):
+    """
+    Communities by label propagation: every protein repeatedly takes the
+    label with the largest total edge weight among its neighbours, keeping
+    its own on ties. A random half of the proteins is updated per round, so
+    labels do not oscillate. Returns community numbers, 0 the largest.
+    """
+    n = adjacency.shape[0]
+    rng = np.random.default_rng(seed)
+    labels = np.arange(n)
+    rows = np.arange(n)
+    smallest = adjacency.data.min() if adjacency.nnz else 1.0
+    for _ in range(max_iterations):
+        current = sparse.csr_matrix((np.ones(n), (rows, labels)), shape=(n, n))
+        votes = (adjacency @ current + current * (smallest * 1e-6)).tocsr()
+        candidates = np.asarray(votes.argmax(axis=1)).ravel()
+        changed = candidates != labels
+        if not changed.any():
+            break
+        update = changed & (rng.random(n) < 0.5)
+        labels = np.where(update, candidates, labels)
+
+    _, communities, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+    # renumber by size, largest first
+    order = np.argsort(-sizes, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return rank[communities]
+
+
+def node_table(proteins, adjacency, samples=None, seed=0, workers=None):
+    """
+    The per-protein measures of one network as a DataFrame.
+    """
+    return pd.DataFrame({
+        'protein': proteins,
+        'degree': np.diff(adjacency.indptr),
+        'strength': np.asarray(adjacency.sum(axis=1)).ravel(),
+        'pagerank': pagerank(adjacency),
+        'betweenness': betweenness(adjacency, samples=samples, seed=seed, workers=workers),
+        'community': label_propagation(adjacency, seed=seed),
+    })
+
+
+def _shared_files(presence, first, second, chunk_size=100000):
+    """
+    The number of rows of a CSC presence matrix containing both columns
+    first[k] and second[k], for each k.
+    """
+    shared = np.zeros(len(first), dtype=np.int64)
+    for start in range(0, len(first), chunk_size):
+        stop = start + chunk_size
+        both = presence[:, first[start:stop]].multiply(presence[:, second[start:stop]])
+        shared[start:stop] = np.asarray(both.sum(axis=0)).ravel()
+    return shared
+
+def differential_edges(matrix, rows_a, rows_b, edges_a, edges_b):
+    """
+    Compare the union of the edges of two cohort networks: the number of
+    files with both proteins in each cohort (rows_a and rows_b of the
+    ProteinMatrix), their Jaccard indices, and Fisher's exact test of the
+    shared-file fractions with q-values.
+    """
+    pairs = []
+    for edges in (edges_a, edges_b):
+        source = edges['source'].to_numpy(str)
+        target = edges['target'].to_numpy(str)
+        # the same pair may be written either way round in the two networks
+        swap = source > target
+        pairs.append(pd.DataFrame({'source': np.where(swap, target, source), 'target': np.where(swap, source, target)}))
+    union = pd.concat(pairs, ignore_index=True).drop_duplicates(ignore_index=True)
+    in_a = pd.MultiIndex.from_frame(union).isin(pd.MultiIndex.from_frame(pairs[0]))
+    in_b = pd.MultiIndex.from_frame(union).isin(pd.MultiIndex.from_frame(pairs[1]))
+
+    columns = pd.Index(matrix.proteins)
+    first = columns.get_indexer(union['source'])
+    second = columns.get_indexer(union['target'])
+    if (first < 0).any() or (second < 0).any():
+        raise ValueError("The networks contain proteins that are not in the protein store")
+
+    result = {}
+    for suffix, rows in (('a', rows_a), ('b', rows_b)):
+        presence = matrix.presence[np.flatnonzero(rows)].tocsc().astype(np.int32)
+        counts = np.asarray(presence.sum(axis=0)).ravel()
+        shared = _shared_files(presence, first, second)
+        either = counts[first] + counts[second] - shared
+        result[f'cooccurrence_{suffix}'] = shared
+        result[f'jaccard_{suffix}'] = np.divide(shared, either, out=np.zeros(len(shared)), where=either > 0)
+        result[f'files_{suffix}'] = presence.shape[0]
+
+    n_a, n_b = result.pop('files_a'), result.pop('files_b')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log2_ratio = np.log2((result['cooccurrence_a'] / n_a) / (result['cooccurrence_b'] / n_b))
+    fisher_p = fisher_exact_many(result['cooccurrence_a'], n_a, result['cooccurrence_b'], n_b)
+    table = union.assign(
+        in_a=in_a,
+        in_b=in_b,
+        **result,
+        delta_jaccard=result['jaccard_a'] - result['jaccard_b'],
+        log2_ratio=log2_ratio,
+        fisher_p=fisher_p,
+        fisher_q=fdr_bh(fisher_p),
+    )
+    return table.sort_values('fisher_p', kind='stable', ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Centralities, communities and differential edges of the cohort networks.')
+    parser.add_argument('--networks', default='networks', help='folder of protein_network.py Parquet edge tables')
+    parser.add_argument('--cohorts', nargs='+', default=None, metavar='NAME',
+                        help='networks to analyse (default: every Parquet table in --networks)')
+    parser.add_argument('--compare', nargs=2, default=None, metavar=('A', 'B'),
+                        help='differential edges of two cohorts (default: noninvasive and invasive, if both exist)')
+    parser.add_argument('--samples', type=int, default=500,
+                        help='betweenness sources of networks with more proteins (0: always exact)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes for betweenness (default: number of CPUs)')
+    parser.add_argument('--store', default='protein_store')
+    parser.add_argument('--table', default=DEFAULT_TABLE)
+    parser.add_argument('--definitions', default=None,
+                        help='JSON list of cohort definitions (default: noninvasive and invasive)')
+    parser.add_argument('--output', default='network_analysis')
+    args = parser.parse_args()
+
+    available = sorted(name[:-len('.parquet')] for name in os.listdir(args.networks) if name.endswith('.parquet'))
+    names = [output_name(name) for name in args.cohorts] if args.cohorts else available
+    missing = [name for name in names if name not in available]
+    if missing:
+        raise SystemExit(f"No network for {', '.join(missing)} in {args.networks}")
+    os.makedirs(args.output, exist_ok=True)
+
+    for name in names:
+        with telemetry.span('network_analysis', cohort=name) as event:
+            proteins, adjacency = load_network(os.path.join(args.networks, f'{name}.parquet'))
+            samples = args.samples if args.samples and args.samples < len(proteins) else None
+            nodes = node_table(proteins, adjacency, samples=samples, seed=args.seed, workers=args.workers)
+            nodes.to_parquet(os.path.join(args.output, f'{name}_nodes.parquet'), index=False)
+            event.update(proteins=len(proteins), edges=adjacency.nnz // 2, samples=samples)
+        print(f"{name}: {len(proteins)} proteins, {adjacency.nnz // 2} edges, "
+              f"{nodes['community'].nunique()} communities"
+              + (f", betweenness from {samples} sources" if samples else ""))
+
+    compare = args.compare
+    if compare is None and {'noninvasive', 'invasive'} <= set(available):
+        compare = ['noninvasive', 'invasive']
+    if compare:
+        name_a, name_b = compare
+        matrix, file_ids = load_matrix(args.store)
+        if matrix is None:
+            raise SystemExit(f"No protein store at {args.store}")
+        definitions = load_definitions(args.definitions) if args.definitions else DEFAULT_COHORTS
+        masks = cohort_masks(matrix, file_ids, definitions, args.table)
+        for name in compare:
+            if name not in masks:
+                raise SystemExit(f"No cohort named {name}")
+
+        edges = differential_edges(
+            matrix, masks[name_a], masks[name_b],
+            pd.read_parquet(os.path.join(args.networks, f'{output_name(name_a)}.parquet'), columns=['source', 'target']),
+            pd.read_parquet(os.path.join(args.networks, f'{output_name(name_b)}.parquet'), columns=['source', 'target']),
+        )
+        edges.to_parquet(
+            os.path.join(args.output, f'{output_name(name_a)}_vs_{output_name(name_b)}_edges.parquet'), index=False)
+        print(f"{name_a} vs {name_b}: {len(edges)} edges, {int((edges['fisher_q'] < 0.05).sum())} with Fisher q < 0.05")
+    print(f"Results written to {args.output}")
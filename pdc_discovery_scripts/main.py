@@ -5,48 +5,306 @@ main entry point
 import os
 import itertools
 import asyncio
-from typing import TypeVar
-from typing import Awaitable
+
+from typing import AsyncIterator
 
 import httpx
 
+import numpy as np
 import pandas as pd
 
 from pdc_api.utils.waiter import Waiter
 
 from pdc_api.all_studies import all_studies
 from pdc_api.all_file_metadata import all_file_metadata
-from pdc_api.clinicals_per_study import clinicals_per_study
+from pdc_api.all_file_metadata import _FileMetadata
+from pdc_api.clinicals_per_study import clinicals_per_studies
 from pdc_api.clinicals_per_study import _ClinicalDatum
-from pdc_api.files_per_study import files_per_study
+from pdc_api.files_per_study import files_per_studies
 from pdc_api.files_per_study import _File
 
-T = TypeVar('T')
 
+CASE_INFO = ['pdc_study_id', 'disease_type', 'tumor_stage']
+
+
+def _nullable_sizes(file_size: np.ndarray) -> pd.arrays.IntegerArray:
+    '''
+    File sizes as a nullable integer array, unknown (-1) sizes as NA.
+    '''
+    return pd.arrays.IntegerArray(np.maximum(file_size, 0), file_size < 0)
+
+
+def _map_files_to_cases(
+    metadata: _FileMetadata,
+    clinical_data: list[_ClinicalDatum],
+) -> tuple[pd.DataFrame, int, int, int]:
+    '''
+    Map each file to the case information (study, disease type, tumor
+    stage) of its cases, with array joins instead of per-file lookups.
+
+    A file's cases are the case_ids of its aliquots plus the cases their
+    sample_ids belong to. Where clinical data lists a sample or case more
+    than once, the last one counts. Returns the files with exactly one
+    distinct case information, indexed by file_id in metadata order, and
+    the number of files mapped to none, one and several case informations.
+    '''
+    # the aliquots as a long table; files are identified by their position in metadata
+    aliquot_rows = np.repeat(np.arange(len(metadata)), metadata.num_aliquots)
+    sample_pairs = [
+        (sample.sample_id, datum.case_id)
+        for datum in clinical_data
+        for sample in datum.samples
+    ]
+
+    # intern sample and case IDs to integer codes, the join keys below
+    sample_codes, _ = pd.factorize(np.concatenate([
+        metadata.aliquot_sample_id,
+        np.array([sample_id for sample_id, _ in sample_pairs], dtype=object),
+    ]))
+    case_codes, case_ids = pd.factorize(np.concatenate([
+        metadata.aliquot_case_id,
+        np.array([case_id for _, case_id in sample_pairs], dtype=object),
+        np.array([datum.case_id for datum in clinical_data], dtype=object),
+    ]))
+    num_aliquots = len(aliquot_rows)
+    num_samples = len(sample_pairs)
+    aliquot_samples = sample_codes[:num_aliquots]
+    aliquot_cases = case_codes[:num_aliquots]
+
+    # sample -> case, the last listing winning
+    sample_to_case = np.full(sample_codes.max(initial=-1) + 1, -1, dtype=np.int64)
+    samples = pd.DataFrame({
+        'sample': sample_codes[num_aliquots:],
+        'case': case_codes[num_aliquots:num_aliquots + num_samples],
+    }).drop_duplicates('sample', keep='last')
+    sample_to_case[samples['sample'].to_numpy()] = samples['case'].to_numpy()
+
+    # case -> code of its (study, disease type, tumor stage), the last listing winning
+    cases = pd.DataFrame.from_records(
+        [
+            (datum.pdc_study_id, datum.disease_type, datum.tumor_stage)
+            for datum in clinical_data
+        ],
+        columns=CASE_INFO,
+    )
+    cases['case'] = case_codes[num_aliquots + num_samples:]
+    cases = cases.drop_duplicates('case', keep='last')
+    cases['info'] = cases.groupby(CASE_INFO, sort=False, dropna=False).ngroup()
+    case_to_info = np.full(len(case_ids), -1, dtype=np.int64)
+    case_to_info[cases['case'].to_numpy()] = cases['info'].to_numpy()
+    infos = cases.drop_duplicates('info').set_index('info')[CASE_INFO]
+
+    # (file, case) through aliquot case_ids and through sample_ids, then (file, info)
+    sample_cases = sample_to_case[aliquot_samples]
+    found = sample_cases >= 0
+    file_rows = np.concatenate([aliquot_rows, aliquot_rows[found]])
+    file_infos = case_to_info[np.concatenate([aliquot_cases, sample_cases[found]])]
+    known = file_infos >= 0
+
+    # distinct (file, info) pairs, sorted by file
+    pairs = np.unique(file_rows[known] * len(infos) + file_infos[known])
+    pair_rows = pairs // max(len(infos), 1)
+    pair_infos = pairs % max(len(infos), 1)
+
+    num_infos = np.bincount(pair_rows, minlength=len(metadata))
+    unique = num_infos[pair_rows] == 1
+
+    unique_rows = pair_rows[unique]
+    df = pd.DataFrame({
+        'file_id': metadata.file_id[unique_rows],
+        'file_name': metadata.file_name[unique_rows],
+        'file_location': metadata.file_location[unique_rows],
+        'file_size': _nullable_sizes(metadata.file_size[unique_rows]),
+        'md5sum': metadata.md5sum[unique_rows],
+    })
+    df[CASE_INFO] = infos.loc[pair_infos[unique]].to_numpy()
+    df = df.set_index('file_id')
+
+    return (
+        df,
+        int((num_infos == 0).sum()),
+        int((num_infos == 1).sum()),
+        int((num_infos > 1).sum()),
+    )
+
+
+async def discover(
+    *,
+    client: httpx.AsyncClient,
+    waiter: Waiter,
+) -> pd.DataFrame:
+    '''
+    Stages 1 to 4: find the files that map to exactly one case and have
+    tumor stage information. Intermediate tables are written to `wd`.
+    '''
+    os.makedirs('wd', exist_ok=True)
+
+    # ------------------- 1 -------------------
+    print('retrieving all pdc_study_ids')
+    pdc_study_ids = await all_studies(
+        client=client,
+        waiter=waiter,
+    )
 
-async def _resolve_all_tasks(
-    coroutines: list[Awaitable[T]],
-):
-    tasks: list[asyncio.Task[T]] = []
+    df = pd.DataFrame.from_records(
+        [
+            {'pdc_study_id': pdc_study_id}
+            for pdc_study_id in pdc_study_ids
+        ],
+        index='pdc_study_id',
+    )
+    df.to_csv('wd/pdc_study_ids.csv')
+
+    # ------------------- 2 -------------------
+    print('retrieving all file metadata with specified formats')
+    metadata = await all_file_metadata(
+        client=client,
+        waiter=waiter,
+    )
+    df = pd.DataFrame(
+        {
+            'file_id': metadata.file_id,
+            'file_name': metadata.file_name,
+            'file_location': metadata.file_location,
+            'file_size': _nullable_sizes(metadata.file_size),
+            'md5sum': metadata.md5sum,
+            'num_aliquots': metadata.num_aliquots,
+        },
+    ).set_index('file_id')
+    df.to_csv('wd/file_metadata.csv')
+
+    # ------------------- 3 -------------------
+    print('retrieving all clinical data for each pdc_study_id')
+    results: list[list[_ClinicalDatum]] = await clinicals_per_studies(
+        client=client,
+        waiter=waiter,
+        pdc_study_ids=pdc_study_ids,
+    )
+    clinical_data = list(itertools.chain.from_iterable(results))
+    df = pd.DataFrame.from_records(
+        [
+            {
+                'case_id': datum.case_id,
+                'pdc_study_id': datum.pdc_study_id,
+                'disease_type': datum.disease_type,
+                'tumor_stage': datum.tumor_stage,
+                'num_samples': len(datum.samples),
+            }
+            for datum in clinical_data
+        ],
+        index='case_id',
+    )
+    df.to_csv('wd/clinical_data.csv')
+
+    # ------------------- 4 -------------------
+    print('identifying files that can be uniquely mapped to a case_id')
+
+    df, num_not_mapped, num_uniquely_mapped, num_nonuniquely_mapped = _map_files_to_cases(
+        metadata,
+        clinical_data,
+    )
+    df.to_csv('wd/unambiguous_file_metadata.csv')
+
+    print(
+        f'\tnum files not mapped to any case information: {num_not_mapped}',
+    )
+    print(
+        f'\tnum files mapped to a unique case information: {num_uniquely_mapped}',
+    )
+    print(
+        f'\tnum files mapped to ambiguous case information: {num_nonuniquely_mapped}',
+    )
+
+    view = df.loc[df['tumor_stage'] != 'Not Reported']
+    useful_pdc_study_ids = view['pdc_study_id'].unique()
+    print(
+        f'\tdisease types with tumor stage information: {view["disease_type"].unique()}',
+    )
+    print(
+        f'\tstudies with tumor stage information: {useful_pdc_study_ids}')
+
+    return view
+
+
+async def files_with_urls(
+    *,
+    client: httpx.AsyncClient,
+    waiter: Waiter,
+    view: pd.DataFrame,
+    update: bool = False,
+    batch_size: int = 10,
+) -> AsyncIterator[pd.DataFrame]:
+    '''
+    Stage 5: add download URL, file size and MD5 to the files found by
+    `discover`. Sizes and checksums missing from filesPerStudy are kept
+    from fileMetadata.
+
+    Studies are queried `batch_size` at a time, and files are yielded as
+    soon as the batch of studies listing them resolves, so downstream work
+    can start before every study has been queried. A file can be listed by
+    another study than its own; files no study lists come last, without
+    URL. Every file of `view` is yielded exactly once.
+    '''
+    pdc_study_ids = list(view['pdc_study_id'].unique())
 
-    async with asyncio.TaskGroup() as tg:
-        for coroutine in coroutines:
-            tasks.append(tg.create_task(coroutine))
+    async def fetch(batch: list[str]) -> list[list[_File]]:
+        return await files_per_studies(
+            client=client,
+            waiter=waiter,
+            pdc_study_ids=batch,
+            update=update,
+            batch_size=batch_size,
+        )
 
-    results = [
-        task.result()
-        for task in tasks
+    tasks = [
+        asyncio.create_task(fetch(pdc_study_ids[start:start + batch_size]))
+        for start in range(0, len(pdc_study_ids), batch_size)
     ]
 
-    return results
+    remaining = view
+
+    try:
+        for task in asyncio.as_completed(tasks):
+            results = await task
+
+            download_urls: dict[str, str] = {}
+            file_sizes: dict[str, int | None] = {}
+            md5sums: dict[str, str | None] = {}
+            for files in results:
+                for file in files:
+                    download_urls[file['file_id']] = file['signedUrl']['url']
+                    file_sizes[file['file_id']] = file.get('file_size')
+                    md5sums[file['file_id']] = file.get('md5sum')
+
+            found = remaining.index.isin(list(download_urls))
+            df = remaining.loc[found].copy()
+            remaining = remaining.loc[~found]
+
+            if len(df) == 0:
+                continue
+
+            # filesPerStudy and fileMetadata should agree; the latter fills
+            # in what the former leaves out
+            df['download_url'] = df.index.map(download_urls)
+            sizes = pd.Series(df.index.map(file_sizes), index=df.index, dtype='Int64')
+            checksums = pd.Series(df.index.map(md5sums), index=df.index, dtype=object)
+            df['file_size'] = sizes.fillna(df['file_size'])
+            df['md5sum'] = checksums.where(checksums.notna(), df['md5sum'])
+            yield df
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if len(remaining) > 0:
+        df = remaining.copy()
+        df['download_url'] = None
+        yield df
 
 
 async def main():
     '''
     main entry point
     '''
-    os.makedirs('wd', exist_ok=True)
-
     transport = httpx.AsyncHTTPTransport(retries=5)
     waiter = Waiter()
 
@@ -54,176 +312,26 @@ async def main():
         timeout=10,
         transport=transport,
     ) as client:
-        # ------------------- 1 -------------------
-        print('retrieving all pdc_study_ids')
-        pdc_study_ids = await all_studies(
+        view = await discover(
             client=client,
             waiter=waiter,
         )
 
-        df = pd.DataFrame.from_records(
-            [
-                {'pdc_study_id': pdc_study_id}
-                for pdc_study_id in pdc_study_ids
-            ],
-            index='pdc_study_id',
-        )
-        df.to_csv('wd/pdc_study_ids.csv')
-
-        # ------------------- 2 -------------------
-        print('retrieving all file metadata with specified formats')
-        metadata = await all_file_metadata(
-            client=client,
-            waiter=waiter,
-        )
-        df = pd.DataFrame.from_records(
-            [
-                {
-                    'file_id': file_metadata.file_id,
-                    'file_name': file_metadata.file_name,
-                    'file_location': file_metadata.file_location,
-                    'num_aliquots': len(file_metadata.aliquots),
-                }
-                for file_metadata in metadata
-            ],
-            index='file_id',
-        )
-        df.to_csv('wd/file_metadata.csv')
-
-        # ------------------- 3 -------------------
-        print('retrieving all clinical data for each pdc_study_id')
-        tasks = [
-            clinicals_per_study(
-                client=client,
-                waiter=waiter,
-                pdc_study_id=pdc_study_id,
-            )
-            for pdc_study_id in pdc_study_ids
-        ]
-        results: list[list[_ClinicalDatum]] = await _resolve_all_tasks(tasks)
-        clinical_data = list(itertools.chain.from_iterable(results))
-        df = pd.DataFrame.from_records(
-            [
-                {
-                    'case_id': datum.case_id,
-                    'pdc_study_id': datum.pdc_study_id,
-                    'disease_type': datum.disease_type,
-                    'tumor_stage': datum.tumor_stage,
-                    'num_samples': len(datum.samples),
-                }
-                for datum in clinical_data
-            ],
-            index='case_id',
-        )
-        df.to_csv('wd/clinical_data.csv')
-
-        sample_id_to_case_id = {}
-        for datum in clinical_data:
-            for sample in datum.samples:
-                sample_id_to_case_id[sample.sample_id] = datum.case_id
-
-        case_id_to_case_info = {
-            datum.case_id: (
-                datum.pdc_study_id,
-                datum.disease_type,
-                datum.tumor_stage,
-            )
-            for datum in clinical_data
-        }
-
-        # ------------------- 4 -------------------
-        print('identifying files that can be uniquely mapped to a case_id')
-
-        num_not_mapped = 0
-        num_uniquely_mapped = 0
-        num_nonuniquely_mapped = 0
-
-        unambiguous = []
-
-        for file_metadata in metadata:
-            mapped_case_ids = {
-                aliquot.case_id for aliquot in file_metadata.aliquots}
-            mapped_sample_ids = {
-                aliquot.sample_id for aliquot in file_metadata.aliquots}
-
-            for sample_id in mapped_sample_ids:
-                if sample_id in sample_id_to_case_id:
-                    mapped_case_ids.add(sample_id_to_case_id[sample_id])
-                # else:
-                #     print(
-                #         f'WARNING: sample_id {sample_id} not found in clinical data'
-                #     )
-
-            case_infos: set[tuple[str, str, str]] = set()
-            for case_id in mapped_case_ids:
-                if case_id in case_id_to_case_info:
-                    case_infos.add(case_id_to_case_info[case_id])
-                # else:
-                #     print(
-                #         f'WARNING: case_id {case_id} not found in clinical data',
-                #     )
-
-            if len(case_infos) == 0:
-                num_not_mapped += 1
-            elif len(case_infos) == 1:
-                num_uniquely_mapped += 1
-                case_info = case_infos.pop()
-                unambiguous.append({
-                    'file_id': file_metadata.file_id,
-                    'file_name': file_metadata.file_name,
-                    'file_location': file_metadata.file_location,
-                    'pdc_study_id': case_info[0],
-                    'disease_type': case_info[1],
-                    'tumor_stage': case_info[2],
-                })
-            else:
-                num_nonuniquely_mapped += 1
-
-        df = pd.DataFrame.from_records(
-            unambiguous,
-            index='file_id',
-        )
-        df.to_csv('wd/unambiguous_file_metadata.csv')
-
-        print(
-            f'\tnum files not mapped to any case information: {num_not_mapped}',
-        )
-        print(
-            f'\tnum files mapped to a unique case information: {num_uniquely_mapped}',
-        )
-        print(
-            f'\tnum files mapped to ambiguous case information: {num_nonuniquely_mapped}',
-        )
-
-        view = df.loc[df['tumor_stage'] != 'Not Reported']
-        useful_pdc_study_ids = view['pdc_study_id'].unique()
-        print(
-            f'\tdisease types with tumor stage information: {view["disease_type"].unique()}',
-        )
-        print(
-            f'\tstudies with tumor stage information: {useful_pdc_study_ids}')
-
         # ------------------- 5 -------------------
         print('retrieving download URLs for each file')
-        tasks = [
-            files_per_study(
+        chunks = [
+            df
+            async for df in files_with_urls(
                 client=client,
                 waiter=waiter,
-                pdc_study_id=pdc_study_id,
+                view=view,
                 # update=True, # uncomment to update download URLs
             )
-            for pdc_study_id in useful_pdc_study_ids
         ]
-
-        results: list[list[_File]] = await _resolve_all_tasks(tasks)
-        download_urls: dict[str, str] = {}
-        for files in results:
-            for file in files:
-                download_urls[file.file_id] = file.signedUrl.url
-
-        df = view.copy()
-        df['download_url'] = df.index.map(download_urls)
+        # back to the order of `view`, as the batches resolve in any order
+        df = pd.concat(chunks).loc[view.index] if chunks else view.copy()
         df.to_csv('wd/unambiguous_file_metadata_with_urls.csv')
 
+
 if __name__ == '__main__':
     asyncio.run(main())
@@ -3,34 +3,98 @@ documentation:
 https://proteomic.datacommons.cancer.gov/pdc/publicapi-documentation/#!/Files/fileMetadata
 '''
 
+import asyncio
+from dataclasses import dataclass
+
+import numpy as np
+
 from httpx import AsyncClient
-from pydantic import BaseModel
+from typing_extensions import NotRequired
+from typing_extensions import TypedDict
 
 from .utils.make_query import make_query
 from .utils.waiter import Waiter
 
 
-class _Aliquot(BaseModel):
+# Pages hold up to 25000 records, so they are validated into plain dicts
+# (TypedDict) rather than one BaseModel object per file and aliquot.
+
+class _Aliquot(TypedDict):
     sample_id: str
     case_id: str
 
 
-class _FileMetadatum(BaseModel):
+class _FileMetadatum(TypedDict):
     file_id: str
     file_name: str
     file_location: str
+    file_size: NotRequired[int | None]
+    md5sum: NotRequired[str | None]
     aliquots: list[_Aliquot]
 
 
-class _Data(BaseModel):
+class _Data(TypedDict):
     fileMetadata: list[_FileMetadatum]
 
 
-class _QueryResponse(BaseModel):
+class _QueryResponse(TypedDict):
     data: _Data
 
 
-def _query(offset: int) -> str:
+@dataclass
+class _FileMetadata:
+    '''
+    All file metadata as columns (object arrays of strings). `file_size` is
+    an int64 array, -1 where PDC reports no size, and `md5sum` is None where
+    it reports no checksum. The aliquots of file `i` are
+    `aliquot_*[aliquot_offsets[i]:aliquot_offsets[i + 1]]`.
+    '''
+    file_id: np.ndarray
+    file_name: np.ndarray
+    file_location: np.ndarray
+    file_size: np.ndarray
+    md5sum: np.ndarray
+    aliquot_offsets: np.ndarray
+    aliquot_sample_id: np.ndarray
+    aliquot_case_id: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.file_id)
+
+    @property
+    def num_aliquots(self) -> np.ndarray:
+        return np.diff(self.aliquot_offsets)
+
+    @classmethod
+    def from_records(cls, records: list[_FileMetadatum]) -> '_FileMetadata':
+        aliquots = [
+            aliquot
+            for record in records
+            for aliquot in record['aliquots']
+        ]
+        num_aliquots = np.fromiter(
+            (len(record['aliquots']) for record in records),
+            dtype=np.int64,
+            count=len(records),
+        )
+
+        return cls(
+            file_id=np.array([record['file_id'] for record in records], dtype=object),
+            file_name=np.array([record['file_name'] for record in records], dtype=object),
+            file_location=np.array([record['file_location'] for record in records], dtype=object),
+            file_size=np.fromiter(
+                (-1 if record.get('file_size') is None else record['file_size'] for record in records),
+                dtype=np.int64,
+                count=len(records),
+            ),
+            md5sum=np.array([record.get('md5sum') for record in records], dtype=object),
+            aliquot_offsets=np.concatenate([[0], np.cumsum(num_aliquots)]),
+            aliquot_sample_id=np.array([aliquot['sample_id'] for aliquot in aliquots], dtype=object),
+            aliquot_case_id=np.array([aliquot['case_id'] for aliquot in aliquots], dtype=object),
+        )
+
+
+def _query(offset: int, limit: int) -> str:
     return f'''
         query {{
             fileMetadata(
@@ -38,11 +102,13 @@ def _query(offset: int) -> str:
                 file_type: "Open Standard"
                 file_format: "mzIdentML"
                 offset: {offset}
-                limit: 25000
+                limit: {limit}
             ) {{
                 file_id
                 file_name
                 file_location
+                file_size
+                md5sum
                 aliquots {{
                     sample_id
                     case_id
@@ -56,24 +122,62 @@ async def all_file_metadata(
     *,
     client: AsyncClient,
     waiter: Waiter,
-):
+    page_size: int = 25000,
+    concurrency: int = 4,
+) -> _FileMetadata:
     '''
     Get all file metadata from the PDC API.
-    '''
-
-    metadata: list[_FileMetadatum] = []
-    num_retrieved_prev_iter = -1
 
-    while num_retrieved_prev_iter != 0:
-        query = _query(len(metadata))
-        response = await make_query(
-            client=client,
-            waiter=waiter,
-            query=query,
-            model=_QueryResponse,
-        )
-
-        metadata.extend(response.data.fileMetadata)
-        num_retrieved_prev_iter = len(response.data.fileMetadata)
+    Offset pages of `page_size` records are requested `concurrency` at a time
+    and validated as they arrive. The first page shorter than `page_size` is
+    the last one. If a page after it has data, the short page may be a
+    cache entry from before the API gained records, so it and the pages
+    after it are fetched again without the cache. The result is columnar,
+    see `_FileMetadata`.
+    '''
 
-    return metadata
+    pages: list[list[_FileMetadatum]] = []
+    last_page = None
+    update = False
+
+    while last_page is None:
+        offsets = [
+            (len(pages) + i) * page_size
+            for i in range(concurrency)
+        ]
+        responses = await asyncio.gather(*(
+            make_query(
+                client=client,
+                waiter=waiter,
+                query=_query(offset, page_size),
+                model=_QueryResponse,
+                update=update,
+            )
+            for offset in offsets
+        ))
+
+        for response in responses:
+            page = response['data']['fileMetadata']
+
+            if last_page is None:
+                if len(page) < page_size:
+                    last_page = len(pages)
+                pages.append(page)
+            elif len(page) != 0:
+                if not update:
+                    del pages[last_page:]
+                    last_page = None
+                    update = True
+                    break
+                # a short page followed by more data means the API capped the
+                # page size; the offsets in between would have been skipped
+                raise RuntimeError(
+                    f'fileMetadata returned a short page before the end of the data; '
+                    f'page_size={page_size} is probably above the API limit',
+                )
+
+    return _FileMetadata.from_records([
+        file_metadata
+        for page in pages
+        for file_metadata in page
+    ])
@@ -6,6 +6,8 @@ https://proteomic.datacommons.cancer.gov/pdc/publicapi-documentation/#!/Clinical
 from httpx import AsyncClient
 from pydantic import BaseModel
 from .utils.make_query import make_query
+from .utils.make_query import make_batched_query
+from .utils.make_query import single_query
 from .utils.waiter import Waiter
 
 
@@ -29,6 +31,32 @@ class _QueryResponse(BaseModel):
     data: _Data
 
 
+def _field(pdc_study_id: str) -> str:
+    return f'''
+        clinicalPerStudy(
+            pdc_study_id: "{pdc_study_id}"
+        ) {{
+            case_id
+            disease_type
+            tumor_stage
+            samples {{
+                sample_id
+            }}
+        }}
+    '''
+
+
+def _with_study(response: _QueryResponse, pdc_study_id: str) -> list[_ClinicalDatum]:
+    '''
+    Copies of the clinical data of a response, labelled with their study;
+    the memoized response itself is shared and left unchanged.
+    '''
+    return [
+        datum.model_copy(update={'pdc_study_id': pdc_study_id})
+        for datum in response.data.clinicalPerStudy
+    ]
+
+
 async def clinicals_per_study(
     *,
     client: AsyncClient,
@@ -39,30 +67,37 @@ async def clinicals_per_study(
     Get all clinical data for a given pdc_study_id.
     '''
 
-    query = f'''
-        query {{
-            clinicalPerStudy(
-                pdc_study_id: "{pdc_study_id}"
-            ) {{
-                case_id
-                disease_type
-                tumor_stage
-                samples {{
-                    sample_id
-                }}
-            }}
-        }}
-    '''
-
     response = await make_query(
         client=client,
         waiter=waiter,
-        query=query,
+        query=single_query(_field(pdc_study_id)),
         model=_QueryResponse,
     )
 
-    clinical_data = response.data.clinicalPerStudy
-    for datum in clinical_data:
-        datum.pdc_study_id = pdc_study_id
+    return _with_study(response, pdc_study_id)
+
+
+async def clinicals_per_studies(
+    *,
+    client: AsyncClient,
+    waiter: Waiter,
+    pdc_study_ids: list[str],
+    batch_size: int = 20,
+):
+    '''
+    Get all clinical data for each of the given pdc_study_ids, querying
+    `batch_size` studies per request.
+    '''
+
+    responses = await make_batched_query(
+        client=client,
+        waiter=waiter,
+        fields=[_field(pdc_study_id) for pdc_study_id in pdc_study_ids],
+        model=_QueryResponse,
+        batch_size=batch_size,
+    )
 
-    return clinical_data
+    return [
+        _with_study(response, pdc_study_id)
+        for pdc_study_id, response in zip(pdc_study_ids, responses)
+    ]
@@ -4,29 +4,56 @@ https://proteomic.datacommons.cancer.gov/pdc/publicapi-documentation/#!/Files/fi
 '''
 
 from httpx import AsyncClient
-from pydantic import BaseModel
+from typing_extensions import NotRequired
+from typing_extensions import TypedDict
 
 from .utils.make_query import make_query
+from .utils.make_query import make_batched_query
+from .utils.make_query import single_query
 from .utils.waiter import Waiter
 
 
-class _SignedUrl(BaseModel):
+# Studies list thousands of files, so responses are validated into plain
+# dicts (TypedDict) rather than one BaseModel object per file.
+
+class _SignedUrl(TypedDict):
     url: str
 
 
-class _File(BaseModel):
+class _File(TypedDict):
     file_id: str
+    file_size: NotRequired[int | None]
+    md5sum: NotRequired[str | None]
     signedUrl: _SignedUrl
 
 
-class _Data(BaseModel):
+class _Data(TypedDict):
     filesPerStudy: list[_File]
 
 
-class _QueryResponse(BaseModel):
+class _QueryResponse(TypedDict):
     data: _Data
 
 
+def _field(pdc_study_id: str) -> str:
+    return f'''
+        filesPerStudy(
+            pdc_study_id: "{pdc_study_id}"
+            data_category: "Peptide Spectral Matches"
+            file_type: "Open Standard"
+            file_format: "mzIdentML"
+            limit: 25000
+        ) {{
+            file_id
+            file_size
+            md5sum
+            signedUrl {{
+                url
+            }}
+        }}
+    '''
+
+
 async def files_per_study(
     *,
     client: AsyncClient,
@@ -38,29 +65,40 @@ async def files_per_study(
     Get all file data for a given pdc_study_id.
     '''
 
-    query = f'''
-        query {{
-            filesPerStudy(
-                pdc_study_id: "{pdc_study_id}"
-                data_category: "Peptide Spectral Matches"
-                file_type: "Open Standard"
-                file_format: "mzIdentML"
-                limit: 25000
-            ) {{
-                file_id
-                signedUrl {{
-                    url
-                }}
-            }}
-        }}
+    response = await make_query(
+        client=client,
+        waiter=waiter,
+        query=single_query(_field(pdc_study_id)),
+        model=_QueryResponse,
+        update=update,
+    )
+
+    return response['data']['filesPerStudy']
+
+
+async def files_per_studies(
+    *,
+    client: AsyncClient,
+    waiter: Waiter,
+    pdc_study_ids: list[str],
+    update: bool = False,
+    batch_size: int = 10,
+):
+    '''
+    Get all file data for each of the given pdc_study_ids, querying
+    `batch_size` studies per request.
     '''
 
-    response = await make_query(
+    responses = await make_batched_query(
         client=client,
         waiter=waiter,
-        query=query,
+        fields=[_field(pdc_study_id) for pdc_study_id in pdc_study_ids],
         model=_QueryResponse,
         update=update,
+        batch_size=batch_size,
     )
 
-    return response.data.filesPerStudy
+    return [
+        response['data']['filesPerStudy']
+        for response in responses
+    ]
@@ -1,25 +1,215 @@
 '''
 A cache for query results.
+
+All entries live in a single SQLite database holding the validated response
+JSON, so several runs on one host can share it: SQLite serializes the
+writers and WAL mode lets readers proceed meanwhile. Entries expire after a
+TTL that depends on the query family (the top-level GraphQL field), and the
+least recently used entries are evicted once the database outgrows
+`_MAX_SIZE_BYTES`.
+
+Each process keeps one connection, shared by its threads under a lock. The
+`Cache` methods block; async code runs them with `asyncio.to_thread`.
 '''
 
 import os
-import pickle
+import json
+import time
+import sqlite3
+import hashlib
+import functools
+import threading
+from contextlib import contextmanager
 
+from typing import Any
 from typing import Type
 from typing import TypeVar
 from typing import Generic
 
-from pydantic import BaseModel
+from pydantic import TypeAdapter
 
 
-T = TypeVar('T', bound=BaseModel)
+T = TypeVar('T')
 
-_CACHE_LOCATION = os.path.expanduser('~/.cache/btc4200_project/pdc')
+_CACHE_LOCATION = os.environ.get(
+    'PDC_CACHE_DIR',
+    os.path.expanduser('~/.cache/btc4200_project'),
+)
 os.makedirs(_CACHE_LOCATION, exist_ok=True)
 
+_DB_PATH = os.path.join(_CACHE_LOCATION, 'pdc.sqlite3')
+
+# location of the one-pickle-per-query cache used before the database
+_LEGACY_LOCATION = os.path.join(_CACHE_LOCATION, 'pdc')
+
+# bump when the table layout or the payload encoding changes
+_SCHEMA_VERSION = 1
+
+_MAX_SIZE_BYTES = 2 * 1024 ** 3
+
+_HOUR = 60 * 60
+_DAY = 24 * _HOUR
+
+_DEFAULT_TTL = 7 * _DAY
+_TTLS = {
+    # signed download URLs expire, so they are only reused for a short while
+    'filesPerStudy': 1 * _HOUR,
+    'fileMetadata': 7 * _DAY,
+    'clinicalPerStudy': 7 * _DAY,
+    'studyCatalog': 30 * _DAY,
+    'programsProjectsStudies': 30 * _DAY,
+}
+
+
+def _ttl(family: str) -> float:
+    return _TTLS.get(family, _DEFAULT_TTL)
+
+
+@functools.cache
+def _adapter(model: Any) -> TypeAdapter:
+    '''
+    The validator/serializer of a response model: a `BaseModel` subclass, or
+    a `TypedDict` (from `typing_extensions`) that is validated straight into
+    plain dicts and lists without building an object per record.
+    '''
+    return TypeAdapter(model)
+
+
+@functools.cache
+def _fingerprint(model: Any) -> str:
+    '''
+    Identify the shape of a model, so entries written for an older version of
+    a model are treated as misses instead of failing validation.
+    '''
+    schema = json.dumps(_adapter(model).json_schema(), sort_keys=True)
+    return hashlib.sha256(schema.encode('utf-8')).hexdigest()[:16]
+
+
+def _initialize(connection: sqlite3.Connection):
+    version = connection.execute('PRAGMA user_version').fetchone()[0]
+    if version == _SCHEMA_VERSION:
+        return
+
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != _SCHEMA_VERSION:
+            connection.execute('DROP TABLE IF EXISTS entries')
+            connection.execute('DROP TABLE IF EXISTS stats')
+            connection.execute('''
+                CREATE TABLE entries (
+                    key TEXT PRIMARY KEY,
+                    family TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    payload BLOB NOT NULL
+                )
+            ''')
+            connection.execute(
+                'CREATE INDEX entries_last_access ON entries (last_access)',
+            )
+            connection.execute('''
+                CREATE TABLE stats (
+                    family TEXT PRIMARY KEY,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    misses INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            connection.execute(f'PRAGMA user_version = {_SCHEMA_VERSION}')
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+
+
+_lock = threading.Lock()
+
+# this process's connection, and the pid it was opened in
+_connection: sqlite3.Connection | None = None
+_connection_pid: int | None = None
+
+# bytes stored in the database as far as this process knows: read when the
+# connection is opened and counted up by `Cache.update`, so the table is
+# only scanned for eviction once it may have outgrown `_MAX_SIZE_BYTES`
+_stored_bytes = 0
+
+
+@contextmanager
+def _connect():
+    '''
+    This process's connection, used by one thread at a time. A forked child
+    opens its own instead of using its parent's.
+    '''
+    global _connection, _connection_pid, _stored_bytes
+
+    with _lock:
+        if _connection is None or _connection_pid != os.getpid():
+            connection = sqlite3.connect(
+                _DB_PATH,
+                timeout=60,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA busy_timeout = 60000')
+            _initialize(connection)
+            _stored_bytes = connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM entries',
+            ).fetchone()[0]
+            _connection = connection
+            _connection_pid = os.getpid()
 
-def _path(key: str) -> str:
-    return os.path.join(_CACHE_LOCATION, f'{key}.pickle')
+        yield _connection
+
+
+def _count(connection: sqlite3.Connection, family: str, column: str):
+    connection.execute(
+        f'''
+            INSERT INTO stats (family, {column}) VALUES (?, 1)
+            ON CONFLICT (family) DO UPDATE SET {column} = {column} + 1
+        ''',
+        (family,),
+    )
+
+
+def _evict(connection: sqlite3.Connection, now: float) -> int:
+    '''
+    Drop expired entries, then least recently used ones until the cache fits.
+    Returns the bytes left.
+    '''
+    for family, ttl in _TTLS.items():
+        connection.execute(
+            'DELETE FROM entries WHERE family = ? AND created < ?',
+            (family, now - ttl),
+        )
+    connection.execute(
+        f'''
+            DELETE FROM entries
+            WHERE family NOT IN ({', '.join('?' * len(_TTLS))}) AND created < ?
+        ''',
+        (*_TTLS, now - _DEFAULT_TTL),
+    )
+
+    total = connection.execute(
+        'SELECT COALESCE(SUM(size), 0) FROM entries',
+    ).fetchone()[0]
+    if total <= _MAX_SIZE_BYTES:
+        return total
+
+    excess = total - _MAX_SIZE_BYTES
+    evicted = []
+    for key, size in connection.execute(
+        'SELECT key, size FROM entries ORDER BY last_access',
+    ):
+        if excess <= 0:
+            break
+        evicted.append((key,))
+        excess -= size
+
+    connection.executemany('DELETE FROM entries WHERE key = ?', evicted)
+    return _MAX_SIZE_BYTES + excess
 
 
 class Cache(Generic[T]):
@@ -28,46 +218,155 @@ class Cache(Generic[T]):
     '''
     key: str
     model: Type[T]
+    family: str
     data: T | None
+    created: float | None
 
-    def __init__(self, key: str, model: Type[T]):
+    def __init__(self, key: str, model: Type[T], family: str = ''):
         self.key = key
         self.model = model
+        self.family = family
         self.data = None
+        self.created = None
 
-    @property
-    def exists(self) -> bool:
+    def lookup(self) -> tuple[bytes, float] | None:
         '''
-        Check if the cache exists.
+        The payload of the fresh cache entry and when it was created, or
+        None (counted as a miss) if there is none.
         '''
-        return os.path.isfile(_path(self.key))
+        now = time.time()
+
+        with _connect() as connection:
+            row = connection.execute(
+                '''
+                    SELECT payload, created FROM entries
+                    WHERE key = ? AND fingerprint = ? AND created >= ?
+                ''',
+                (self.key, _fingerprint(self.model), now - _ttl(self.family)),
+            ).fetchone()
+
+            if row is None:
+                _count(connection, self.family, 'misses')
+
+        return row
 
     def load(self) -> T:
         '''
         Load the cache data.
         '''
+        row = self.lookup()
+        if row is None:
+            raise FileNotFoundError(f'Cache entry {self.key} does not exist.')
+
+        return self._decode(*row)
+
+    def load_if_fresh(self) -> T | None:
+        '''
+        Load the cache data if a fresh entry exists, else None.
+        '''
+        row = self.lookup()
+        if row is None:
+            return None
 
-        if not self.exists:
-            raise FileNotFoundError(f'Cache file {self.key} does not exist.')
+        return self._decode(*row)
 
-        with open(_path(self.key), 'rb') as f:
-            self.data = pickle.load(f)
+    def _decode(self, payload: bytes, created: float) -> T:
+        '''
+        Validate the payload of an entry and count the hit.
+        '''
+        self.data = _adapter(self.model).validate_json(payload)
+        self.created = created
+
+        with _connect() as connection:
+            connection.execute(
+                'UPDATE entries SET last_access = ? WHERE key = ?',
+                (time.time(), self.key),
+            )
+            _count(connection, self.family, 'hits')
 
         return self.data
 
     def update(self, data: T):
         '''
-        Update the cache with the given data.
+        Update the cache with the given data. Entries are evicted only once
+        the database may have outgrown `_MAX_SIZE_BYTES`.
         '''
+        global _stored_bytes
+
         self.data = data
 
-        with open(_path(self.key), 'wb') as f:
-            pickle.dump(data, f)
+        payload = _adapter(self.model).dump_json(data)
+        now = time.time()
+        self.created = now
+
+        with _connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                replaced = connection.execute(
+                    'SELECT size FROM entries WHERE key = ?',
+                    (self.key,),
+                ).fetchone()
+                connection.execute(
+                    '''
+                        INSERT OR REPLACE INTO entries
+                        (key, family, fingerprint, created, last_access, size, payload)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''',
+                    (
+                        self.key,
+                        self.family,
+                        _fingerprint(self.model),
+                        now,
+                        now,
+                        len(payload),
+                        payload,
+                    ),
+                )
+                _stored_bytes += len(payload) - (replaced[0] if replaced else 0)
+                if _stored_bytes > _MAX_SIZE_BYTES:
+                    _stored_bytes = _evict(connection, now)
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+    @staticmethod
+    def stats() -> dict[str, dict[str, int]]:
+        '''
+        Hit/miss counts, number of entries and bytes stored per query family.
+        '''
+        with _connect() as connection:
+            stats = {
+                family: {'hits': hits, 'misses': misses, 'entries': 0, 'bytes': 0}
+                for family, hits, misses in connection.execute(
+                    'SELECT family, hits, misses FROM stats',
+                )
+            }
+            for family, entries, size in connection.execute(
+                'SELECT family, COUNT(*), SUM(size) FROM entries GROUP BY family',
+            ):
+                family_stats = stats.setdefault(
+                    family,
+                    {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0},
+                )
+                family_stats['entries'] = entries
+                family_stats['bytes'] = size
+
+        return stats
 
     @staticmethod
     def clear_all():
         '''
-        Clear all cache files.
+        Clear all cache entries.
         '''
-        for filename in os.listdir(_CACHE_LOCATION):
-            os.remove(os.path.join(_CACHE_LOCATION, filename))
+        global _stored_bytes
+
+        with _connect() as connection:
+            _stored_bytes = 0
+            connection.execute('DELETE FROM entries')
+            connection.execute('DELETE FROM stats')
+            connection.execute('VACUUM')
+
+        if os.path.isdir(_LEGACY_LOCATION):
+            for filename in os.listdir(_LEGACY_LOCATION):
+                os.remove(os.path.join(_LEGACY_LOCATION, filename))
@@ -2,26 +2,86 @@
 unified query function for querying the PDC GrapyhQL API
 '''
 
+import re
+import json
+import asyncio
 import hashlib
+from time import monotonic
 
+from typing import Any
 from typing import Type
 from typing import TypeVar
 
 from httpx import AsyncClient
 from httpx import HTTPStatusError
+from httpx import Response
 
-from pydantic import BaseModel
 from pydantic import ValidationError
 
+from . import telemetry
 from .waiter import Waiter
 from .cache import Cache
+from .cache import _ttl
+from .cache import _adapter
+from .memo import Memo
 
 
 def _cache_key(query: str) -> str:
     return hashlib.sha256(query.encode('utf-8')).hexdigest()[:16]
 
 
-T = TypeVar('T', bound=BaseModel)
+_FAMILY_PATTERN = re.compile(r'\{\s*(?:\w+\s*:\s*)?(\w+)')
+
+
+def _query_family(query: str) -> str:
+    '''
+    The top-level field queried, e.g. `filesPerStudy`; selects the cache TTL.
+    '''
+    match = _FAMILY_PATTERN.search(query)
+    return match.group(1) if match else ''
+
+
+def single_query(field: str) -> str:
+    '''
+    The query document for a single top-level field selection.
+    '''
+    return f'query {{\n{field}\n}}'
+
+
+def _is_overloaded(response: Response) -> bool:
+    return response.status_code == 429 or response.status_code >= 500
+
+
+def _retry_after(response: Response) -> float | None:
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return None
+
+
+def _errors_by_field(response: dict[str, Any]) -> dict[str | None, list[str]]:
+    '''
+    The messages of a GraphQL response's `errors`, by the top-level field
+    (or alias) they belong to; None for errors of the whole document.
+    '''
+    errors: dict[str | None, list[str]] = {}
+    for error in response.get('errors') or []:
+        path = error.get('path') or [None]
+        errors.setdefault(path[0], []).append(error.get('message', str(error)))
+    return errors
+
+
+def _raise_for_errors(query: str, errors: list[str]):
+    raise RuntimeError(
+        f'The PDC API answered with errors: {"; ".join(errors)}\nQuery: {query.strip()}',
+    )
+
+
+# a BaseModel subclass, or a TypedDict for large responses (see cache._adapter)
+T = TypeVar('T')
+
+
+_memo = Memo()
 
 
 async def make_query(
@@ -31,9 +91,233 @@ async def make_query(
     query: str,
     model: Type[T],
     update: bool = False,
+    max_attempts: int = 5,
 ) -> T:
     '''
     Query the PDC API with a given query.
+
+    Results are memoized in-process, and identical queries running at the
+    same time share one lookup. Results are shared between callers and must
+    not be mutated. Requests rejected with 429 or 5xx are retried up to
+    `max_attempts` times, after the waiter has backed off.
+
+    With `update=True` the API is queried and the disk cache refreshed
+    without going through the memo, which belongs to one thread: refreshes
+    may run in other threads, each with an event loop of its own (see
+    downloader.SignedUrlRefresher).
+    '''
+
+    if update:
+        data, _ = await _load_or_fetch(
+            client=client,
+            waiter=waiter,
+            query=query,
+            model=model,
+            update=True,
+            max_attempts=max_attempts,
+        )
+        return data
+
+    key = _cache_key(query)
+    family = _query_family(query)
+    memo_key = (key, model)
+
+    data = _memo.get(memo_key, _ttl(family))
+    if data is not None:
+        telemetry.emit('query_cache', family=family, source='memo')
+        return data
+
+    async def fetch() -> T:
+        data, created = await _load_or_fetch(
+            client=client,
+            waiter=waiter,
+            query=query,
+            model=model,
+            update=False,
+            max_attempts=max_attempts,
+        )
+        _memo.put(memo_key, data, created)
+        return data
+
+    return await _memo.coalesce(memo_key, fetch)
+
+
+async def make_batched_query(
+    *,
+    client: AsyncClient,
+    waiter: Waiter,
+    fields: list[str],
+    model: Type[T],
+    update: bool = False,
+    batch_size: int = 20,
+    max_attempts: int = 5,
+) -> list[T]:
+    '''
+    Query the PDC API for many selections of the same top-level field at once.
+
+    Each of `fields` is a complete selection such as
+    `clinicalPerStudy(pdc_study_id: "...") { ... }`, and `model` is the
+    response model of querying one of them on its own. The selections that
+    are not cached yet are packed `batch_size` at a time into one document
+    using field aliases (`s0: clinicalPerStudy(...) s1: ...`). The answer is
+    split back up and cached per selection, exactly as if `make_query` had
+    been called with `single_query(field)`, so both paths share the cache.
+
+    A selection the API reports an error for (in the response's `errors`)
+    and answers with null is queried again on its own; if that fails too,
+    the server's message is raised. The other selections of its batch are
+    kept. As in `make_query`, `update=True` leaves the memo alone.
+    '''
+
+    results: list[T | None] = [None] * len(fields)
+    missing: list[int] = []
+
+    for i, field in enumerate(fields):
+        query = single_query(field)
+        key = _cache_key(query)
+        family = _query_family(query)
+
+        if not update:
+            source = 'memo'
+            data = _memo.get((key, model), _ttl(family))
+            if data is None:
+                source = 'cache'
+                query_cache = Cache(key, model, family)
+                data = await asyncio.to_thread(query_cache.load_if_fresh)
+                if data is not None:
+                    _memo.put((key, model), data, query_cache.created)
+
+            if data is not None:
+                telemetry.emit('query_cache', family=family, source=source)
+                results[i] = data
+                continue
+
+        telemetry.emit('query_cache', family=family, source='api')
+        missing.append(i)
+
+    async def fetch_batch(batch: list[int]):
+        aliases = {
+            f's{j}': i
+            for j, i in enumerate(batch)
+        }
+        document = '\n'.join([
+            'query {',
+            *(
+                f'{alias}: {fields[i]}'
+                for alias, i in aliases.items()
+            ),
+            '}',
+        ])
+
+        content = await _post(
+            client=client,
+            waiter=waiter,
+            query=document,
+            max_attempts=max_attempts,
+        )
+        response = json.loads(content)
+        batch_data = response.get('data') or {}
+        errors = _errors_by_field(response)
+        if None in errors and not batch_data:
+            _raise_for_errors(document, errors[None])
+
+        for alias, i in aliases.items():
+            query = single_query(fields[i])
+            family = _query_family(query)
+
+            if alias in errors and batch_data.get(alias) is None:
+                # only this selection failed; it gets a query of its own
+                data, _ = await _load_or_fetch(
+                    client=client,
+                    waiter=waiter,
+                    query=query,
+                    model=model,
+                    update=True,
+                    max_attempts=max_attempts,
+                )
+                if not update:
+                    _memo.put((_cache_key(query), model), data)
+                results[i] = data
+                continue
+
+            # the family is the top-level field name the single query returns
+            data = _validate(
+                model,
+                {'data': {family: batch_data.get(alias)}},
+            )
+
+            key = _cache_key(query)
+            await asyncio.to_thread(Cache(key, model, family).update, data)
+            if not update:
+                _memo.put((key, model), data)
+            results[i] = data
+
+    await asyncio.gather(*(
+        fetch_batch(missing[start:start + batch_size])
+        for start in range(0, len(missing), batch_size)
+    ))
+
+    return results
+
+
+async def _load_or_fetch(
+    *,
+    client: AsyncClient,
+    waiter: Waiter,
+    query: str,
+    model: Type[T],
+    update: bool,
+    max_attempts: int,
+) -> tuple[T, float]:
+    '''
+    The result of a query from the cache or the API, and when it was
+    fetched from the API.
+    '''
+    family = _query_family(query)
+    query_cache = Cache(_cache_key(query), model, family)
+
+    if not update:
+        data = await asyncio.to_thread(query_cache.load_if_fresh)
+        if data is not None:
+            telemetry.emit('query_cache', family=family, source='cache')
+            return data, query_cache.created
+
+    telemetry.emit('query_cache', family=family, source='api')
+
+    # cache does not exist, fetch data and update cache
+    content = await _post(
+        client=client,
+        waiter=waiter,
+        query=query,
+        max_attempts=max_attempts,
+    )
+    # decoded twice only if there are errors, which leave the data null
+    if b'"errors"' in content:
+        response = json.loads(content)
+        if (response.get('data') or {}).get(family) is None:
+            _raise_for_errors(query, [
+                message
+                for messages in _errors_by_field(response).values()
+                for message in messages
+            ])
+    data = _validate(model, content)
+
+    await asyncio.to_thread(query_cache.update, data)
+
+    return data, query_cache.created
+
+
+async def _post(
+    *,
+    client: AsyncClient,
+    waiter: Waiter,
+    query: str,
+    max_attempts: int,
+) -> bytes:
+    '''
+    POST a query, retrying with backoff while the API is overloaded.
+    Each call is recorded as a `query` telemetry event, with the time spent
+    waiting for the rate limiter and the rate it allowed.
     '''
 
     payload = {
@@ -44,45 +328,69 @@ async def make_query(
         'Content-Type': 'application/json',
     }
 
-    query_cache = Cache(_cache_key(query), model)
+    with telemetry.span('query', family=_query_family(query)) as event:
+        wait_seconds = 0.0
+        for attempt in range(1, max_attempts + 1):
+            wait_start = monotonic()
+            async with waiter.when_ready():
+                wait_seconds += monotonic() - wait_start
+                response = await client.post(
+                    'https://proteomic.datacommons.cancer.gov/graphql',
+                    json=payload,
+                    headers=headers,
+                )
+
+            if not _is_overloaded(response):
+                waiter.succeeded()
+                break
 
-    if (not update) and query_cache.exists:
-        return query_cache.load()
+            if attempt < max_attempts:
+                waiter.backoff(_retry_after(response))
 
-    # cache does not exist, fetch data and update cache
-    async with waiter.when_ready():
-        response = await client.post(
-            'https://proteomic.datacommons.cancer.gov/graphql',
-            json=payload,
-            headers=headers,
+        event.update(
+            attempts=attempt,
+            status=response.status_code,
+            bytes=len(response.content),
+            wait_seconds=wait_seconds,
+            rate=waiter.current_rate,
         )
 
-        try:
-            response.raise_for_status()
-        except HTTPStatusError as e:
-            with open('error.txt', 'wt', encoding='utf-8') as f:
-                f.write(f'{e.__class__.__name__}\n\n')
-                f.write(f'{e.args[0]}\n\n')
+    try:
+        response.raise_for_status()
+    except HTTPStatusError as e:
+        with open('error.txt', 'wt', encoding='utf-8') as f:
+            f.write(f'{e.__class__.__name__}\n\n')
+            f.write(f'{e.args[0]}\n\n')
+
+            f.write('Request:\n')
+            f.write(f'\t{e.request.method} {e.request.url}\n')
+            f.write(f'\theaders: {e.request.headers}\n')
+            f.write(f'\tcontent: {e.request.content.decode("utf-8")}\n')
 
-                f.write('Request:\n')
-                f.write(f'\t{e.request.method} {e.request.url}\n')
-                f.write(f'\theaders: {e.request.headers}\n')
-                f.write(f'\tcontent: {e.request.content.decode("utf-8")}\n')
+            f.write('\n')
 
-                f.write('\n')
+            f.write('Response:\n')
+            f.write(f'\tstatus: {e.response.status_code}\n')
+            f.write(
+                f'\tcontent:\n\n{e.response.content.decode("utf-8")}\n'
+            )
 
-                f.write('Response:\n')
-                f.write(f'\tstatus: {e.response.status_code}\n')
-                f.write(
-                    f'\tcontent:\n\n{e.response.content.decode("utf-8")}\n'
-                )
+        raise RuntimeError(
+            'HTTP error occurred while querying the PDC API. Content dumped to error.txt',
+        ) from e
 
-            raise RuntimeError(
-                'HTTP error occurred while querying the PDC API. Content dumped to error.txt',
-            ) from e
+    return response.content
+
+
+def _validate(model: Type[T], content: bytes | dict[str, Any]) -> T:
+    '''
+    Validate a response (raw JSON or already decoded) into `model`.
+    '''
 
     try:
-        data = model.model_validate_json(response.content)
+        if isinstance(content, dict):
+            return _adapter(model).validate_python(content)
+        return _adapter(model).validate_json(content)
     except ValidationError as e:
         with open('error.txt', 'wt', encoding='utf-8') as f:
             f.write(f'{e.error_count()} validation errors:\n')
@@ -98,7 +406,3 @@ async def make_query(
         raise RuntimeError(
             'Validation error occurred while parsing the PDC API response. Content dumped to error.txt',
         ) from e
-
-    query_cache.update(data)
-
-    return data
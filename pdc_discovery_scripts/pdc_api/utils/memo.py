@@ -0,0 +1,115 @@
+'''
+An in-process memo in front of the query cache.
+'''
+
+import asyncio
+import time
+from collections import OrderedDict
+
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Hashable
+from typing import TypeVar
+
+
+T = TypeVar('T')
+
+
+class _FetchCancelled(Exception):
+    '''
+    Set on a shared fetch whose caller was cancelled, so that the callers
+    waiting for it start a fetch of their own instead of being cancelled too.
+    '''
+
+
+class Memo():
+    '''
+    An in-process memo in front of the query cache.
+
+    Decoded results are held in a bounded LRU, so repeated queries skip the
+    disk cache. Identical queries that are issued while one of them is still
+    running share that one request instead of each hitting the cache or the
+    API. Results are shared between callers and must not be mutated.
+
+    Entries are timestamped in wall-clock time, so that a result loaded from
+    the disk cache keeps the age it has there.
+    '''
+    max_entries: int
+
+    entries: OrderedDict[Hashable, tuple[float, Any]]
+    in_flight: dict[Hashable, asyncio.Future]
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+
+        self.entries = OrderedDict()
+        self.in_flight = {}
+
+    def get(self, key: Hashable, ttl: float) -> Any | None:
+        '''
+        The memoized result for `key` if it is younger than `ttl` seconds.
+        '''
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        created, value = entry
+        if time.time() - created > ttl:
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any, created: float | None = None):
+        '''
+        Memoize a result, evicting the least recently used one if full.
+        `created` is when the result was fetched from the API (`time.time()`,
+        default now).
+        '''
+        self.entries[key] = (time.time() if created is None else created, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def coalesce(
+        self,
+        key: Hashable,
+        fetch: Callable[[], Awaitable[T]],
+    ) -> T:
+        '''
+        Run `fetch`, or wait for the identical call that is already running.
+        If the caller running it is cancelled, the waiters run it again.
+        '''
+        loop = asyncio.get_running_loop()
+
+        while True:
+            future = self.in_flight.get(key)
+            if future is None or future.get_loop() is not loop:
+                break
+            try:
+                return await asyncio.shield(future)
+            except _FetchCancelled:
+                continue
+
+        future = loop.create_future()
+        self.in_flight[key] = future
+
+        try:
+            result = await fetch()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.set_exception(_FetchCancelled())
+            else:
+                future.set_exception(e)
+            # mark as retrieved; the waiters (if any) re-raise it
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
@@ -0,0 +1,290 @@
+'''
+Structured telemetry of a pipeline run.
+
+Events are JSON objects written one per line to the file named by the
+`PDC_TELEMETRY` environment variable; without it nothing is recorded. Worker
+processes and shard subprocesses inherit the variable and report to the
+same file. Each event is one `write` to a file opened for appending, so the
+lines of concurrent writers do not interleave.
+
+Every event has `ts` (Unix time), `pid` and `event`, plus its own fields:
+
+    {"ts": 1760000000.0, "pid": 4242, "event": "download", "seconds": 12.3, "bytes": 80530636}
+
+Summarize a file of events from `pdc_discovery_scripts` with
+
+    python -m pdc_api.utils.telemetry events.jsonl
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from time import monotonic
+from contextlib import contextmanager
+
+from typing import Any
+from typing import Iterator
+
+
+ENV_VAR = 'PDC_TELEMETRY'
+
+_lock = threading.Lock()
+_fd: int | None = None
+_fd_path: str | None = None
+
+
+def _after_fork():
+    # a worker forked while another thread was writing must not inherit the held lock
+    global _lock
+    _lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def configure(path: str | None):
+    '''
+    Record events to `path` from now on, in this process and in the
+    processes it starts; None stops recording.
+    '''
+    if path is None:
+        os.environ.pop(ENV_VAR, None)
+    else:
+        os.environ[ENV_VAR] = os.path.abspath(path)
+
+
+def enabled() -> bool:
+    return bool(os.environ.get(ENV_VAR))
+
+
+def emit(event: str, **fields: Any):
+    '''
+    Record one event, if telemetry is enabled.
+    '''
+    global _fd, _fd_path
+
+    path = os.environ.get(ENV_VAR)
+    if not path:
+        return
+
+    line = json.dumps(
+        {'ts': time.time(), 'pid': os.getpid(), 'event': event, **fields},
+        default=str,
+    ) + '\n'
+
+    with _lock:
+        if _fd_path != path:
+            if _fd is not None:
+                os.close(_fd)
+            _fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            _fd_path = path
+        os.write(_fd, line.encode('utf-8'))
+
+
+@contextmanager
+def span(event: str, **fields: Any) -> Iterator[dict[str, Any]]:
+    '''
+    Time the body and record it as one event with `seconds`, and `error`
+    if it raised. The body can add fields (e.g. `bytes`) to the yielded dict.
+    '''
+    start = monotonic()
+    try:
+        yield fields
+    except BaseException as e:
+        fields['error'] = f'{e.__class__.__name__}: {e}'
+        raise
+    finally:
+        emit(event, seconds=monotonic() - start, **fields)
+
+
+def _duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+class Progress():
+    '''
+    Progress of a long-running loop: items and bytes done, rate, and ETA
+    when the total is known.
+
+    `update` counts finished items and `tick` reports at most every
+    `interval` seconds, as a `progress` event with the given gauges (e.g.
+    queue depths) and, with `live`, as a summary line on stderr. A loop that
+    stops making progress keeps reporting, so a stuck stage shows up.
+    '''
+    label: str
+    total: int | None
+    interval: float
+    live: bool
+
+    done: int
+    bytes: int
+    start_time: float
+    last_report_time: float
+
+    def __init__(
+        self,
+        label: str,
+        total: int | None = None,
+        interval: float = 30.0,
+        live: bool = False,
+    ):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.live = live
+
+        self.done = 0
+        self.bytes = 0
+        self.start_time = monotonic()
+        self.last_report_time = self.start_time
+
+    @property
+    def active(self) -> bool:
+        return self.live or enabled()
+
+    def update(self, items: int = 1, nbytes: int = 0):
+        self.done += items
+        self.bytes += nbytes
+
+    def tick(self, **gauges: Any):
+        '''
+        Report, if `interval` seconds have passed since the last report.
+        '''
+        if self.active and monotonic() - self.last_report_time >= self.interval:
+            self.report(**gauges)
+
+    def report(self, **gauges: Any):
+        now = monotonic()
+        self.last_report_time = now
+        elapsed = now - self.start_time
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        byte_rate = self.bytes / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = max(self.total - self.done, 0) / rate
+
+        emit(
+            'progress',
+            label=self.label,
+            done=self.done,
+            total=self.total,
+            bytes=self.bytes,
+            elapsed=elapsed,
+            rate=rate,
+            bytes_per_second=byte_rate,
+            eta_seconds=eta,
+            **gauges,
+        )
+
+        if self.live:
+            done = f'{self.done}/{self.total}' if self.total is not None else f'{self.done}'
+            line = f'[{self.label}] {done} done, {rate * 60:.1f}/min, {byte_rate / 1e6:.1f} MB/s'
+            if eta is not None:
+                line += f', ETA {_duration(eta)}'
+            if gauges:
+                line += ' (' + ', '.join(f'{key} {value}' for key, value in gauges.items()) + ')'
+            print(line, file=sys.stderr, flush=True)
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(path: str) -> str:
+    '''
+    A report of the events in `path`: per event type the count, errors,
+    time (total, median, 95th percentile), bytes and throughput, how long
+    ago it was last seen, the query cache hit rate per query family and the
+    latest progress of each loop.
+    '''
+    events = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                # a line cut short by a crash
+                continue
+    if not events:
+        return f'{path}: no events'
+
+    end = max(event['ts'] for event in events)
+    lines = [
+        f'{len(events)} events from {len({event["pid"] for event in events})} processes '
+        f'over {_duration(end - min(event["ts"] for event in events))}',
+        '',
+        f'{"event":<16}{"count":>8}{"errors":>8}{"total s":>11}{"p50 s":>9}{"p95 s":>9}'
+        f'{"GB":>9}{"MB/s":>8}{"last seen":>11}',
+    ]
+
+    by_event: dict[str, list[dict[str, Any]]] = {}
+    for event in events:
+        by_event.setdefault(event['event'], []).append(event)
+
+    for name, group in sorted(by_event.items()):
+        if name in ('progress', 'query_cache', 'queue'):
+            continue
+        seconds = [event['seconds'] for event in group if 'seconds' in event]
+        total_seconds = sum(seconds)
+        total_bytes = sum(event.get('bytes') or 0 for event in group)
+        errors = sum('error' in event for event in group)
+        line = f'{name:<16}{len(group):>8}{errors:>8}'
+        if seconds:
+            line += f'{total_seconds:>11.1f}{_percentile(seconds, 0.5):>9.2f}{_percentile(seconds, 0.95):>9.2f}'
+        else:
+            line += f'{"":>29}'
+        if total_bytes:
+            rate = total_bytes / total_seconds / 1e6 if total_seconds else 0.0
+            line += f'{total_bytes / 1e9:>9.2f}{rate:>8.1f}'
+        else:
+            line += f'{"":>17}'
+        line += f'{_duration(end - max(event["ts"] for event in group)):>11}'
+        lines.append(line)
+
+    cache_events = by_event.get('query_cache', [])
+    if cache_events:
+        lines += ['', 'query cache (memo / cache / api):']
+        families: dict[str, dict[str, int]] = {}
+        for event in cache_events:
+            counts = families.setdefault(event['family'], {'memo': 0, 'cache': 0, 'api': 0})
+            counts[event['source']] += 1
+        for family, counts in sorted(families.items()):
+            total = sum(counts.values())
+            hit_rate = (counts['memo'] + counts['cache']) / total
+            lines.append(
+                f'  {family:<24}{counts["memo"]:>7}{counts["cache"]:>7}{counts["api"]:>7}'
+                f'  hit rate {hit_rate:.0%}',
+            )
+
+    latest: dict[str, dict[str, Any]] = {}
+    for event in by_event.get('progress', []) + by_event.get('queue', []):
+        key = event.get('label') or event['event']
+        if key not in latest or event['ts'] >= latest[key]['ts']:
+            latest[key] = event
+    if latest:
+        lines += ['', 'latest progress and queue depths:']
+        for key, event in sorted(latest.items()):
+            fields = {
+                field: (round(value, 2) if isinstance(value, float) else value)
+                for field, value in event.items()
+                if field not in ('ts', 'pid', 'event', 'label')
+            }
+            lines.append(
+                f'  {key} ({_duration(end - event["ts"])} before the end): '
+                + ', '.join(f'{field} {value}' for field, value in fields.items()),
+            )
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize a telemetry file.')
+    parser.add_argument('path')
+    args = parser.parse_args()
+    print(summarize(args.path))
@@ -1,5 +1,5 @@
 '''
-A context manager that waits for a given interval between operations.
+A rate limiter for requests to the PDC API.
 '''
 
 from time import monotonic
@@ -9,33 +9,104 @@ from contextlib import asynccontextmanager
 
 class Waiter():
     '''
-    A context manager that waits for a given interval between operations.
+    A rate limiter for requests to the PDC API.
+
+    Request starts are spaced out by a token bucket (`rate` requests per
+    second, bursts of up to `burst`), and at most `max_in_flight` requests
+    run at the same time. Only the token bookkeeping is serialized; the
+    requests themselves overlap.
+
+    When the API pushes back (429 or 5xx), `backoff` pauses every request
+    and halves the rate; `succeeded` restores it step by step.
     '''
-    interval: float
+    rate: float
+    burst: int
+    max_in_flight: int
+    min_rate: float
+    max_backoff: float
+
+    current_rate: float
+    tokens: float
+    last_refill_time: float
+    paused_until: float
+    consecutive_failures: int
 
     lock: asyncio.Lock
-    last_execution_time: float
+    in_flight: asyncio.Semaphore
 
-    def __init__(self, interval: float = 0.5):
-        self.interval = interval
+    def __init__(
+        self,
+        rate: float = 2.0,
+        burst: int = 4,
+        max_in_flight: int = 8,
+        min_rate: float = 0.1,
+        max_backoff: float = 60.0,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.min_rate = min_rate
+        self.max_backoff = max_backoff
+
+        self.current_rate = rate
+        self.tokens = burst
+        self.last_refill_time = monotonic()
+        self.paused_until = 0
+        self.consecutive_failures = 0
 
         self.lock = asyncio.Lock()
-        self.last_execution_time = 0
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+    def _refill(self, now: float):
+        elapsed = now - self.last_refill_time
+        self.tokens = min(self.burst, self.tokens + elapsed * self.current_rate)
+        self.last_refill_time = now
+
+    async def _acquire_token(self):
+        async with self.lock:
+            while True:
+                now = monotonic()
+                self._refill(now)
+
+                delay = self.paused_until - now
+                if delay <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.current_rate
+
+                await asyncio.sleep(delay)
 
     @asynccontextmanager
     async def when_ready(self):
         '''
-        Wait until the interval has passed since the last operation.
+        Wait for a free request slot and a token from the bucket.
         '''
 
-        await self.lock.acquire()
-        try:
-            now = monotonic()
-            earliest = self.last_execution_time + self.interval
-            if now < earliest:
-                await asyncio.sleep(earliest - now)
-
+        async with self.in_flight:
+            await self._acquire_token()
             yield None
-        finally:
-            self.last_execution_time = monotonic()
-            self.lock.release()
+
+    def backoff(self, retry_after: float | None = None):
+        '''
+        Slow down after the API rejected a request as overloaded.
+
+        All requests are paused for `retry_after` seconds if the server sent
+        one, otherwise for an exponentially growing delay, and the rate is halved.
+        Either way the pause is at most `max_backoff` seconds.
+        '''
+        self.consecutive_failures += 1
+        if retry_after is None:
+            retry_after = 2 ** (self.consecutive_failures - 1) / self.rate
+        retry_after = min(retry_after, self.max_backoff)
+
+        self.current_rate = max(self.min_rate, self.current_rate / 2)
+        self.tokens = 0
+        self.paused_until = max(self.paused_until, monotonic() + retry_after)
+
+    def succeeded(self):
+        '''
+        Record a successful request, gradually restoring the configured rate.
+        '''
+        self.consecutive_failures = 0
+        self.current_rate = min(self.rate, self.current_rate + self.rate / 10)
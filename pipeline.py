@@ -0,0 +1,243 @@
+"""
+One streaming pipeline from PDC discovery to the protein store.
+
+Instead of running main.py, filter_by_stage.py and process_manifest_file.py
+one after the other with CSVs in between, discovery runs in a background
+thread and hands files to the download/parse engine of process_manifest_file
+as soon as the batch of studies listing them has download URLs. Files of a
+wanted tumor stage pass through a bounded queue; when downloads and parsing
+fall behind, the queue fills up and discovery pauses (backpressure).
+
+The protein store and its job table are the only state: files already in
+the store are skipped, so an interrupted run is resumed by running the
+pipeline again. Once discovery is done, the CSVs of the separate scripts
+(wd/*.csv and data_{keyword}.csv) are written as well, so those scripts can
+still be run on their own.
+"""
+import os
+import sys
+import time
+import queue
+import asyncio
+import argparse
+import threading
+
+import httpx
+import pandas as pd
+
+from filter_by_stage import stage_keyword
+from filter_by_stage import filter_by_stage
+from cohorts import build_table
+from cohorts import write_table
+from process_manifest_file import iter_manifest_jobs
+from process_manifest_file import open_job_state
+from process_manifest_file import run_jobs
+from process_manifest_file import parse_size
+from process_manifest_file import default_memory_budget
+from process_manifest_file import DEFAULT_MAX_TASKS_PER_CHILD
+from protein_store import ProteinStore
+from psm_cache import PsmCache
+from psm_cache import DEFAULT_CACHE
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdc_discovery_scripts'))
+
+from pdc_api.utils import telemetry
+from pdc_api.utils.waiter import Waiter
+from main import discover
+from main import files_with_urls
+
+# marks the end of the discovered rows
+_END = object()
+
+
+def manifest_rows(df, keywords):
+    """
+    Yield the rows of a stage 5 table (see main.files_with_urls) as manifest
+    rows, with the keyword of their tumor stage. Only rows of the given
+    keywords are yielded.
+    """
+    for row in df.reset_index().to_dict('records'):
+        keyword = stage_keyword(row['tumor_stage'])
+        if keyword not in keywords:
+            continue
+        # as read back from a CSV: missing values are empty strings
+        row = {key: ('' if pd.isna(value) else value) for key, value in row.items()}
+        row['keyword'] = keyword
+        yield row
+
+def put(rows, item, stop):
+    """
+    Put item into the rows queue, waiting while it is full. Returns False if
+    stop was set in the meantime.
+    """
+    while not stop.is_set():
+        try:
+            rows.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def iter_rows(rows):
+    """
+    Yield the rows put into the queue until the end marker. None is yielded
+    whenever no row is ready yet, so run_jobs can look after running
+    downloads in the meantime.
+    """
+    while True:
+        try:
+            row = rows.get(timeout=0.1)
+        except queue.Empty:
+            yield None
+            continue
+        if row is _END:
+            return
+        yield row
+
+async def discover_rows(rows, stop, keywords, update_urls=False):
+    """
+    Run discovery and put the manifest rows of the wanted keywords into the
+    rows queue as their download URLs arrive. Writes the CSVs of main.py and
+    filter_by_stage.py and the file table of cohorts.py at the end. The queue depth is recorded as a telemetry
+    event after each batch of studies.
+    """
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    num_rows = 0
+
+    async with httpx.AsyncClient(
+        timeout=10,
+        transport=httpx.AsyncHTTPTransport(retries=5),
+    ) as client:
+        waiter = Waiter()
+        view = await discover(client=client, waiter=waiter)
+
+        print('retrieving download URLs for each file')
+        chunks = []
+        async for df in files_with_urls(client=client, waiter=waiter, view=view, update=update_urls):
+            chunks.append(df)
+            # largest first within each batch, see process_manifest_file.largest_first
+            batch = df.sort_values('file_size', ascending=False, na_position='last', kind='stable')
+            for row in manifest_rows(batch, keywords):
+                if num_rows == 0:
+                    print(f"First file ready for download after {time.monotonic() - start:.1f} s")
+                num_rows += 1
+                # blocks while the queue is full, without stalling the event loop
+                if not await loop.run_in_executor(None, put, rows, row, stop):
+                    return
+            telemetry.emit('queue', label='discovered files', depth=rows.qsize(), maxsize=rows.maxsize,
+                           queued=num_rows)
+
+    print(f"Discovery finished after {time.monotonic() - start:.1f} s: {num_rows} files queued")
+
+    df = pd.concat(chunks).loc[view.index] if chunks else view.copy()
+    df.to_csv('wd/unambiguous_file_metadata_with_urls.csv')
+    for keyword, filtered_data in filter_by_stage(df.reset_index()).items():
+        filtered_data.to_csv(f'data_{keyword}.csv', index=False)
+    write_table(build_table(df))
+
+def run_pipeline(keywords=('noninvasive', 'invasive'), store_path='protein_store', queue_size=64,
+                 update_urls=False, **engine_options):
+    """
+    Discover, download and parse the files of the given keywords in one go.
+    At most queue_size discovered files wait for a download. engine_options
+    are passed on to process_manifest_file.run_jobs.
+    """
+    rows = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def produce():
+        try:
+            asyncio.run(discover_rows(rows, stop, keywords, update_urls=update_urls))
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            put(rows, _END, stop)
+
+    producer = threading.Thread(target=produce, name='discovery', daemon=True)
+    producer.start()
+
+    try:
+        with ProteinStore(store_path, writable=True) as store:
+            job_state = open_job_state(store)
+            jobs = iter_manifest_jobs(iter_rows(rows), store, job_state=job_state)
+            run_jobs(jobs, store, job_state, **engine_options)
+    finally:
+        stop.set()
+        producer.join()
+
+    if errors:
+        raise RuntimeError('PDC discovery failed') from errors[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Discover, download and extract protein lists in one streaming pipeline.')
+    parser.add_argument('keywords', nargs='*', default=['noninvasive', 'invasive'])
+    parser.add_argument('--download-workers', type=int, default=4,
+                        help='number of concurrent downloads (default: 4)')
+    parser.add_argument('--parse-workers', type=int, default=None,
+                        help='number of mzid parser processes (default: number of CPUs)')
+    parser.add_argument('--parser', choices=['iterparse', 'pyteomics'], default='iterparse',
+                        help='mzid parser to use (default: iterparse)')
+    parser.add_argument('--stream-downloads', action='store_true',
+                        help='parse files straight from the download stream without storing them')
+    parser.add_argument('--delete-downloaded-files', action='store_true')
+    parser.add_argument('--store', default='protein_store',
+                        help='protein store shared by all keywords (default: protein_store)')
+    parser.add_argument('--write-protein-lists', action='store_true',
+                        help='also write one {keyword}_protein_list/<file>.txt per file')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='discovered files waiting for a download at most (default: 64)')
+    parser.add_argument('--update-urls', action='store_true',
+                        help='query fresh download URLs instead of cached ones')
+    parser.add_argument('--psm-cache', default=DEFAULT_CACHE, metavar='DIR',
+                        help='cache of the parsed PSMs of every file (default: psm_cache)')
+    parser.add_argument('--no-psm-cache', action='store_true',
+                        help='neither read nor write the PSM cache')
+    parser.add_argument('--all-evidence', action='store_true',
+                        help='list the proteins of every evidence, not only the first of each spectrum')
+    parser.add_argument('--max-q-value', type=float, default=None,
+                        help='list only the proteins of PSMs with at most this q-value')
+    parser.add_argument('--memory-budget', type=parse_size, default=None, metavar='SIZE',
+                        help='memory the parses running at once may use, e.g. 16G '
+                             '(default: 75%% of the physical memory)')
+    parser.add_argument('--max-tasks-per-child', type=int, default=DEFAULT_MAX_TASKS_PER_CHILD, metavar='N',
+                        help='replace each parser process after N files, 0 to never replace them '
+                             f'(default: {DEFAULT_MAX_TASKS_PER_CHILD})')
+    parser.add_argument('--progress', action='store_true',
+                        help='print a progress summary every 30 seconds')
+    parser.add_argument('--telemetry', default=None, metavar='PATH',
+                        help='append JSON-lines telemetry events to PATH '
+                             '(summarize with python -m pdc_api.utils.telemetry PATH)')
+    args = parser.parse_args()
+
+    if args.telemetry:
+        telemetry.configure(args.telemetry)
+
+    protein_rules = {}
+    if args.all_evidence:
+        protein_rules['all_evidence'] = True
+    if args.max_q_value is not None:
+        protein_rules['max_q_value'] = args.max_q_value
+    if protein_rules and args.parser == 'pyteomics':
+        parser.error('--all-evidence and --max-q-value need the iterparse parser')
+
+    run_pipeline(
+        keywords=args.keywords,
+        store_path=args.store,
+        queue_size=args.queue_size,
+        update_urls=args.update_urls,
+        delete_downloaded_files=args.delete_downloaded_files,
+        download_workers=args.download_workers,
+        parse_workers=args.parse_workers,
+        parser=args.parser,
+        stream_downloads=args.stream_downloads,
+        write_protein_lists=args.write_protein_lists,
+        progress=args.progress,
+        psm_cache=None if args.no_psm_cache else PsmCache(args.psm_cache),
+        protein_rules=protein_rules,
+        memory_budget=args.memory_budget or default_memory_budget(),
+        max_tasks_per_child=args.max_tasks_per_child,
+    )
@@ -1,19 +1,103 @@
 import os
+import re
+import sys
 import csv
-import requests
+import time
+import subprocess
 import shutil
 import gzip
+import argparse
+import contextlib
+import functools
+import heapq
+import hashlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
 from pyteomics import mzid
 
-def download_file(url, local_filename):
+from mzid_extract import extract_proteins_iterparse
+from mzid_extract import read_psms
+from protein_store import ProteinStore
+from protein_store import manifest_file_id
+from protein_store import merge_stores
+from downloader import download_file
+from downloader import get_session
+from downloader import SignedUrlRefresher
+from downloader import DEFAULT_TIMEOUT
+from downloader import CHUNK_SIZE
+from downloader import DownloadError
+# importing downloader put pdc_discovery_scripts on sys.path
+from pdc_api.utils import telemetry
+from job_state import JobState
+from job_state import write_atomic
+from psm_cache import PsmCache
+from psm_cache import DEFAULT_CACHE
+from psm_cache import write_psm_file
+from psm_cache import read_protein_set
+from sharding import parse_shard
+from sharding import in_shard
+from sharding import shard_path
+from sharding import find_shard_paths
+
+# marks the end of a job source in run_jobs
+_END = object()
+
+# files with fewer proteins are recorded as problematic
+PROBLEMATIC_PROTEIN_COUNT = 300
+
+# The peak memory of one parse is estimated as the memory of an idle parser
+# process plus a multiple of the size of its input: the compressed .mzid.gz,
+# or the cache entry for 'psm_cache'. 'psms' is iterparse reading every PSM
+# (see extract_proteins_cached). Measured on synthetic files with
+# benchmarks.synthetic_mzid and rounded up; pyteomics, which resolves every
+# reference of a file, is given ample room above its synthetic measurement.
+PARSE_MEMORY_BASE = 256 * 2 ** 20
+PARSE_MEMORY_PER_BYTE = {
+    'iterparse': 8,
+    'psms': 10,
+    'pyteomics': 40,
+    'psm_cache': 4,
+}
+
+# parser processes are replaced after about this many files each, so the
+# memory a process keeps after parsing a large file is returned to the system
+DEFAULT_MAX_TASKS_PER_CHILD = 32
+
+_SIZE_UNITS = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+def parse_size(value):
+    """
+    Bytes of a size such as 512M, 16G or 16GB (powers of 1024), or a plain
+    number of bytes.
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d*)?)\s*([KMGT]?)B?\s*', value, re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size {value!r}, expected e.g. 512M or 16G")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+def default_memory_budget(fraction=0.75):
+    """
+    fraction of this machine's physical memory, or None where it is unknown.
+    """
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * fraction)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def parse_memory(kind, size):
+    """
+    The estimated peak memory of parsing an input of size bytes with kind
+    (a key of PARSE_MEMORY_PER_BYTE).
+    """
+    return PARSE_MEMORY_BASE + PARSE_MEMORY_PER_BYTE[kind] * size
+
+def largest_first(jobs):
     """
-    Download a file from the given URL and save it as local_filename.
+    jobs ordered by decreasing file_size, jobs of unknown size last. Large
+    files take longest to parse; started first, they do not end up as the
+    stragglers of a run.
     """
-    with requests.get(url, stream=True) as response:
-        response.raise_for_status()
-        with open(local_filename, 'wb') as out_file:
-            shutil.copyfileobj(response.raw, out_file)
-    return local_filename
+    return sorted(jobs, key=lambda job: (job['file_size'] is None, -(job['file_size'] or 0)))
 
 def extract_gz_file(gz_path, extracted_folder):
     """
@@ -26,18 +110,31 @@ def extract_gz_file(gz_path, extracted_folder):
     else:
         extracted_filename = base_filename
     extracted_path = os.path.join(extracted_folder, extracted_filename)
-    with gzip.open(gz_path, 'rb') as f_in, open(extracted_path, 'wb') as f_out:
-        shutil.copyfileobj(f_in, f_out)
+    with telemetry.span('extract_gz', file=base_filename) as event:
+        with gzip.open(gz_path, 'rb') as f_in, open(extracted_path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        event['bytes'] = os.path.getsize(extracted_path)
     return extracted_path
 
-def extract_proteins(mzid_path):
+def extract_proteins(source):
     """
     Extract protein names from an mzid file using pyteomics.
+    source is either a path or a binary file-like object. pyteomics seeks around
+    its source to resolve references, which is very slow inside a gzip stream;
+    use mzid_extract.extract_proteins_iterparse to parse compressed streams.
     Returns a set of protein names.
     """
+    if hasattr(source, 'read'):
+        # Random access into a compressed stream means re-decompressing it, so
+        # resolve references from an in-memory id cache instead of seeking.
+        reader_kwargs = {'build_id_cache': True}
+    else:
+        reader_kwargs = {}
+    name = getattr(source, 'name', source)
+
     proteins = set()
     try:
-        with mzid.MzIdentML(mzid_path) as reader:
+        with mzid.MzIdentML(source, **reader_kwargs) as reader:
             for spectrum in reader:
                 try:
                     protein = spectrum['SpectrumIdentificationItem'][0]['PeptideEvidenceRef'][0]['protein description']
@@ -46,115 +143,682 @@ def extract_proteins(mzid_path):
                     # Skip any spectrum that doesn't have the expected structure.
                     pass
     except Exception as e:
-        print(f"Error reading {mzid_path}: {e}")
+        print(f"Error reading {name}: {e}")
     return proteins
 
-def process_keyword(keyword, delete_downloaded_files=False):
-    
-    MANIFEST_FILE = f'data_{keyword}.csv'
-    DOWNLOAD_DIR = f'downloaded_files_{keyword}'
-    EXTRACTED_DIR = f'extracted_files_{keyword}'
-    PROTEIN_LIST_DIR = f'{keyword}_protein_list'
-
-    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-    os.makedirs(EXTRACTED_DIR, exist_ok=True)
-    os.makedirs(PROTEIN_LIST_DIR, exist_ok=True)
-
-    PROBLEMATIC_LIST_FILE = f'{keyword}_problematic_files.txt'
-
-    problematic_files = []
-
-    with open(MANIFEST_FILE, 'r', newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            file_url = row.get('File Download Link')
-            if not file_url:
-                print("No 'File Download Link' found; skipping row.")
-                continue
-
-            # Use 'File Name' if available; else derive from URL.
-            file_name = row.get('file_name') or os.path.basename(file_url.split('?')[0])
-            base_name = os.path.splitext(file_name)[0]  # removes extension (e.g., .mzid.gz)
-            print(f"Processing file_name: {file_name}")
-
-            # Check if protein list already exists (to avoid redoing work).
-            protein_list_file = os.path.join(PROTEIN_LIST_DIR, base_name + '.txt')
-            if os.path.exists(protein_list_file):
-                print(f"Protein list for {file_name} already exists; skipping processing.")
-                continue
-
-            # Download the .mzid.gz file into DOWNLOAD_DIR.
-            gz_path = os.path.join(DOWNLOAD_DIR, file_name)
-            try:
-                # print(f"Downloading {file_url} into {gz_path} ...")
-                download_file(file_url, gz_path)
-                # print("Download complete.")
-            except Exception as e:
-                print(f"Failed to download {file_url}: {e}")
-                continue
-
-            # Unzip the .gz file into EXTRACTED_DIR.
-            try:
-                extracted_path = extract_gz_file(gz_path, EXTRACTED_DIR)
-                # print(f"Extracted {gz_path} to {extracted_path}")
-            except Exception as e:
-                print(f"Failed to extract {gz_path}: {e}")
-                continue
-
-            # Extract protein names from the unzipped .mzid file.
-            protein_names = extract_proteins(extracted_path)
-            protein_count = len(protein_names)
-            print(f"Extracted {len(protein_names)} proteins from {extracted_path}")
-
-            # Save protein names to protein_list_file (one per line).
-            try:
-                with open(protein_list_file, 'w') as f:
-                    for protein in protein_names:
-                        f.write(protein + '\n')
-                # print(f"Saved protein names to {protein_list_file}")
-            except Exception as e:
-                print(f"Error writing to {protein_list_file}: {e}")
-
-            # If number of proteins < 300, record this file as problematic.
-            
-            is_problematic = protein_count < 300
-            if is_problematic:
-                print(f"Problematic file detected: {file_name} has only {protein_count} proteins.")
-                problematic_files.append((file_name, protein_count, file_url))
-                problematic_files.sort(key=lambda x: x[1])
-                print("Sorted problematic file list so far:")
-                for fname, count, url in problematic_files:
-                    print(f"{fname}: {count} proteins, {url}") 
-                with open(PROBLEMATIC_LIST_FILE, 'w') as pf:
-                    for fname, count, url in problematic_files:
-                        pf.write(f"{fname}: {count}\n, URL: {url}\n")
-            
-
-            # Delete the downloaded and extracted files.
+def extract_proteins_cached(source, cache_file=None, protein_rules=None, verify=None):
+    """
+    Extract protein names from an mzid stream with mzid_extract. With a
+    cache_file, every PSM is read and written there first (see psm_cache),
+    and the names are derived from the PSMs by protein_rules
+    (all_evidence, max_q_value; first evidence only by default). verify()
+    is called after the parse, before anything is cached, and raises if
+    the source turned out to be corrupt.
+    """
+    if cache_file is None and not protein_rules:
+        proteins = extract_proteins_iterparse(source)
+        if verify is not None:
+            verify()
+        return proteins
+    psms = read_psms(source)
+    if verify is not None:
+        verify()
+    if cache_file is not None:
+        write_psm_file(cache_file, psms, source=os.path.basename(getattr(source, 'name', '') or ''))
+    return psms.protein_set(**(protein_rules or {}))
+
+def parse_mzid_gz(gz_path, extracted_folder, parser='iterparse', cache_file=None, protein_rules=None):
+    """
+    Pull the protein names out of a downloaded .mzid.gz file. Runs inside a
+    parser worker process.
+
+    The default iterparse parser decompresses the file on the fly, and
+    caches its PSMs in cache_file (see extract_proteins_cached). The
+    pyteomics parser needs a seekable file, so the file is extracted into
+    extracted_folder first and the extracted copy is removed afterwards.
+    """
+    with telemetry.span('parse', file=os.path.basename(gz_path), parser=parser,
+                        bytes=os.path.getsize(gz_path)) as event:
+        if parser == 'pyteomics':
+            if protein_rules:
+                raise ValueError('protein list rules need the iterparse parser')
+            extracted_path = extract_gz_file(gz_path, extracted_folder)
             try:
-                if delete_downloaded_files:
-                    if os.path.exists(gz_path):
-                        os.remove(gz_path)
-                        print(f"Deleted downloaded file {gz_path}")
-                # Delete the extracted file only if not problematic.
-                if os.path.exists(extracted_path):
-                    os.remove(extracted_path)
-                    print(f"Deleted extracted file {extracted_path}")
-                
-                if not is_problematic and os.path.exists(extracted_path):
-                    os.remove(extracted_path)
-                    print(f"Deleted extracted file {extracted_path}")
-                elif is_problematic:
-                    print(f"Kept extracted file {extracted_path} for review (problematic file).")
-                
-            except Exception as e:
-                print(f"Error deleting files: {e}")
-
-            print("-" * 40)
-            
-            
+                proteins = extract_proteins(extracted_path)
+            finally:
+                os.remove(extracted_path)
+        else:
+            with gzip.open(gz_path, 'rb') as f:
+                proteins = extract_proteins_cached(f, cache_file, protein_rules)
+        event['proteins'] = len(proteins)
+        return proteins
+
+class _HashingReader:
+    """
+    A file-like view of a stream that hashes the bytes read through it.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.md5.update(data)
+        return data
+
+    def hexdigest(self):
+        # the parser can stop before the end of the body, e.g. at the gzip trailer
+        for _ in iter(lambda: self.read(CHUNK_SIZE), b''):
+            pass
+        return self.md5.hexdigest()
+
+def parse_mzid_url(url, cache_file=None, protein_rules=None, expected_md5=None):
+    """
+    Pull the protein names out of a remote .mzid.gz file straight from the
+    HTTP response body, without storing the file. Runs inside a parser worker process.
+
+    With an expected_md5 the body is hashed while it is parsed, and a body
+    that does not match fails with DownloadError before its PSMs are cached.
+    """
+    with telemetry.span('parse', file=url.split('?')[0].rsplit('/', 1)[-1], parser='iterparse',
+                        stream=True) as event:
+        with get_session().get(url, stream=True, timeout=DEFAULT_TIMEOUT) as response:
+            response.raise_for_status()
+            body = _HashingReader(response.raw)
+
+            def verify():
+                if expected_md5 and body.hexdigest() != expected_md5.lower():
+                    raise DownloadError(f"{url.split('?')[0]} does not match the MD5 from PDC")
+
+            with gzip.GzipFile(fileobj=body) as f:
+                proteins = extract_proteins_cached(f, cache_file, protein_rules, verify)
+        event['proteins'] = len(proteins)
+        return proteins
+
+def proteins_from_cache(cache_file, protein_rules=None):
+    """
+    Derive the protein names of a file from its PSM cache entry instead of
+    downloading and parsing it. Runs inside a parser worker process.
+    """
+    with telemetry.span('parse', file=os.path.basename(cache_file), parser='psm_cache',
+                        bytes=os.path.getsize(cache_file)) as event:
+        proteins = read_protein_set(cache_file, **(protein_rules or {}))
+        event['proteins'] = len(proteins)
+        return proteins
+
+def keyword_dirs(keyword):
+    """
+    The working files of one keyword: where its downloads, extracted
+    problematic files, txt protein lists and problematic file list go.
+    """
+    return {
+        'download_dir': f'downloaded_files_{keyword}',
+        'extracted_dir': f'extracted_files_{keyword}',
+        'protein_list_dir': f'{keyword}_protein_list',
+        'problematic_list_file': f'{keyword}_problematic_files.txt',
+    }
+
+def read_manifest(manifest_file):
+    """
+    Yield the rows of a manifest CSV as dicts.
+    """
+    with open(manifest_file, 'r', newline='') as csvfile:
+        yield from csv.DictReader(csvfile)
+
+def iter_manifest_jobs(rows, store, keyword=None, job_state=None, shard=None):
+    """
+    Yield one job dict per manifest row that still needs processing.
+    rows are manifest rows (see read_manifest); their keyword is the keyword
+    argument or, if that is None, the row's own 'keyword' field. A None row
+    means the source has nothing ready yet and is passed on as None. With a
+    shard (i, N), only the rows of that shard are used (see sharding).
+
+    Rows already in the protein store are skipped so that an interrupted run
+    can be resumed; protein lists left by older runs are moved into the store
+    (and recorded as parsed in job_state) instead of being processed again.
+    """
+    known_keywords = set()
+    for row in rows:
+        if row is None:
+            yield None
+            continue
+
+        row_keyword = keyword or row['keyword']
+        dirs = keyword_dirs(row_keyword)
+        if row_keyword not in known_keywords:
+            os.makedirs(dirs['download_dir'], exist_ok=True)
+            os.makedirs(dirs['extracted_dir'], exist_ok=True)
+            known_keywords.add(row_keyword)
+
+        ids = manifest_file_id(row)
+        if ids is None:
+            print("No 'File Download Link' found; skipping row.")
+            continue
+        file_name, file_id = ids
+        file_url = row.get('File Download Link') or row.get('download_url')
+        base_name = os.path.splitext(file_name)[0]  # removes extension (e.g., .mzid.gz)
+        if not in_shard(file_id, shard):
+            continue
+
+        file_size = row.get('file_size')
+        job = {
+            'file_id': file_id,
+            'file_name': file_name,
+            'file_url': file_url,
+            'keyword': row_keyword,
+            'study': row.get('pdc_study_id', ''),
+            'stage': row.get('tumor_stage', ''),
+            'file_size': int(file_size) if file_size else None,
+            'md5sum': row.get('md5sum') or None,
+            'gz_path': os.path.join(dirs['download_dir'], file_name),
+            'protein_list_file': os.path.join(dirs['protein_list_dir'], base_name + '.txt'),
+            'extracted_dir': dirs['extracted_dir'],
+            'problematic_list_file': shard_path(dirs['problematic_list_file'], shard),
+        }
+
+        # Check if the file was already processed (to avoid redoing work).
+        if file_id in store:
+            print(f"Proteins of {file_name} already stored; skipping processing.")
+            continue
+        if os.path.exists(job['protein_list_file']):
+            with open(job['protein_list_file'], 'r') as f:
+                protein_names = [line.rstrip('\n') for line in f if line.strip()]
+            store_proteins(store, job, protein_names)
+            if job_state is not None:
+                job_state.mark_parsed(job, len(protein_names))
+            print(f"Protein list for {file_name} already exists; moved it into the store.")
+            continue
+
+        yield job
+
+def store_proteins(store, job, protein_names):
+    """
+    Append the protein names of a processed job to the protein store.
+    """
+    store.append(
+        job['file_id'],
+        protein_names,
+        file_name=job['file_name'],
+        keyword=job['keyword'],
+        study=job['study'],
+        stage=job['stage'],
+    )
+
+def finish_job(job, protein_names, store, delete_downloaded_files=False, write_protein_lists=False):
+    """
+    Store the protein names of a parsed file, report it if it is problematic
+    and clean up the downloaded file. Problematic files are extracted into
+    the job's extracted_dir for review. With write_protein_lists=True the
+    names are also written to a per-file txt list, as older versions did.
+    Returns False if the names could not be stored.
+    """
+    file_name = job['file_name']
+    gz_path = job['gz_path']
+    protein_list_file = job['protein_list_file']
+    extracted_folder = job['extracted_dir']
+
+    protein_count = len(protein_names)
+    print(f"Extracted {len(protein_names)} proteins from {file_name}")
+
+    try:
+        store_proteins(store, job, protein_names)
+    except Exception as e:
+        print(f"Error storing proteins of {file_name}: {e}")
+        return False
+
+    # Save protein names to protein_list_file (one per line).
+    if write_protein_lists:
+        try:
+            os.makedirs(os.path.dirname(protein_list_file), exist_ok=True)
+            write_atomic(protein_list_file, ''.join(protein + '\n' for protein in protein_names))
+        except Exception as e:
+            print(f"Error writing to {protein_list_file}: {e}")
+
+    # Files with few proteins are problematic; run_jobs lists them at the end.
+    is_problematic = protein_count < PROBLEMATIC_PROTEIN_COUNT
+    if is_problematic:
+        print(f"Problematic file detected: {file_name} has only {protein_count} proteins.")
+
+    # Keep a decompressed copy of problematic files for review.
+    if is_problematic and os.path.exists(gz_path):
+        try:
+            extracted_path = extract_gz_file(gz_path, extracted_folder)
+            print(f"Kept extracted file {extracted_path} for review (problematic file).")
+        except Exception as e:
+            print(f"Failed to extract {gz_path}: {e}")
+
+    # Delete the downloaded file.
+    try:
+        if delete_downloaded_files and os.path.exists(gz_path):
+            os.remove(gz_path)
+            print(f"Deleted downloaded file {gz_path}")
+    except Exception as e:
+        print(f"Error deleting files: {e}")
+
+    print("-" * 40)
+    return True
+
+def write_problematic_list(job_state, keyword, problematic_list_file):
+    """
+    Write the problematic files of keyword, fewest proteins first, from the
+    job table. Covers the files of earlier runs too.
+    """
+    problematic_files = job_state.problematic(keyword, PROBLEMATIC_PROTEIN_COUNT)
+    write_atomic(problematic_list_file, ''.join(
+        f"{fname}: {count}\n, URL: {url}\n" for fname, count, url in problematic_files
+    ))
+    if problematic_files:
+        print(f"{len(problematic_files)} problematic {keyword} files, listed in {problematic_list_file}")
+
+def timed(function, *args, **kwargs):
+    """
+    Call function and return (seconds taken, result).
+    """
+    start = time.monotonic()
+    result = function(*args, **kwargs)
+    return time.monotonic() - start, result
+
+def run_jobs(jobs, store, job_state, delete_downloaded_files=False, download_workers=4, parse_workers=None,
+             parser='iterparse', stream_downloads=False, write_protein_lists=False, total=None, progress=False,
+             psm_cache=None, protein_rules=None, memory_budget=None, max_tasks_per_child=None):
+    """
+    Download and parse the files of jobs (see iter_manifest_jobs) and append
+    their proteins to store. Each job is claimed in job_state (see
+    job_state.JobState) before it starts, and its progress, timings, size and
+    protein count are recorded there; jobs that are parsed or claimed by
+    another worker are skipped. At the end the problematic file list of each
+    keyword is written from the job table.
+
+    Downloads run in a pool of download_workers threads and feed a pool of
+    parse_workers processes (default: one per CPU), so the network, the disk
+    and the CPUs are kept busy at the same time. At most
+    download_workers + 2 * parse_workers files are in flight at once, which
+    bounds the disk space used by downloaded but not yet parsed files. jobs
+    is only advanced while there is room, so a lazy source is throttled too;
+    a None job means the source has nothing ready yet and is asked again
+    shortly.
+
+    Files ready to be parsed wait in a queue and the largest is parsed
+    first. With a memory_budget (bytes), a parse only starts while the
+    estimated peak memory of all running parses (see parse_memory) stays
+    within the budget; a file too large for it is parsed alone. Its size is
+    the downloaded size, else the manifest's file_size; without either, a
+    parse is estimated at memory_budget / parse_workers.
+
+    With max_tasks_per_child, the pool of parser processes is replaced by a
+    fresh one after parse_workers * max_tasks_per_child parses; the old
+    processes exit once their running parses finish. (The pool's own
+    max_tasks_per_child cannot be combined with forking, and can stall the
+    pool in Python 3.11.)
+
+    parser selects mzid_extract's iterparse extractor (default) or the
+    original pyteomics reader. With stream_downloads=True the parse workers
+    read each file straight from its HTTP response and nothing is downloaded;
+    problematic files are then only recorded, not kept.
+
+    With a psm_cache (see psm_cache.PsmCache), the iterparse parser writes
+    the PSMs of every file whose MD5 was checked to the cache, and files
+    already in the cache (same file_id and md5sum) are neither downloaded
+    nor parsed: their protein names are derived from the cache entry. The
+    pyteomics parser neither reads nor writes the cache. protein_rules
+    ({'all_evidence': ..., 'max_q_value': ...}) select the names.
+
+    Progress (jobs done of total, throughput, ETA, the downloads and parses
+    in flight, the parses waiting and the memory reserved for the running
+    ones) is recorded as telemetry events, and printed every 30 seconds with
+    progress=True.
+    """
+    if parse_workers is None:
+        parse_workers = os.cpu_count() or 1
+    max_in_flight = download_workers + 2 * parse_workers
+
+    jobs = iter(jobs)
+    keywords = {}  # keyword -> problematic list file
+    refresh_signed_url = SignedUrlRefresher()
+    tracker = telemetry.Progress('jobs', total=total, live=progress)
+
+    parses_per_pool = parse_workers * max_tasks_per_child if max_tasks_per_child else None
+    pool_parses = 0
+
+    with ThreadPoolExecutor(max_workers=download_workers) as downloaders, contextlib.ExitStack() as pools:
+        parsers = ProcessPoolExecutor(max_workers=parse_workers)
+        # whichever parser pool is in use at the end
+        pools.callback(lambda: parsers.shutdown())
+        # future -> ('download' | 'parse', job)
+        pending = {}
+        # parses waiting for a parser and memory: (-memory, order, job, function, args)
+        ready = []
+        order = itertools.count()
+        # running parse future -> its estimated memory
+        reserved = {}
+        exhausted = False
+
+        def submit_downloads():
+            nonlocal exhausted
+            while not exhausted and len(pending) + len(ready) < max_in_flight:
+                job = next(jobs, _END)
+                if job is _END:
+                    exhausted = True
+                    return
+                if job is None:
+                    return
+                keywords[job['keyword']] = job['problematic_list_file']
+                if not job_state.claim(job):
+                    print(f"{job['file_name']} is parsed already or in progress elsewhere; skipping.")
+                    tracker.update()
+                    continue
+                print(f"Processing file_name: {job['file_name']}")
+                # the cache holds what the iterparse parser reads, not pyteomics' protein sets
+                cached = None
+                if psm_cache is not None and parser == 'iterparse':
+                    cached = psm_cache.lookup(job['file_id'], job['md5sum'])
+                if cached is not None:
+                    queue_parse(job, parse_memory('psm_cache', os.path.getsize(cached)),
+                                proteins_from_cache, cached, protein_rules)
+                elif stream_downloads:
+                    queue_parse(job, estimate(job, job['file_size']),
+                                parse_mzid_url, job['file_url'], cache_file(job), protein_rules, job['md5sum'])
+                else:
+                    # signed URLs can expire before their download starts
+                    refresh_url = None
+                    if job['study'] and job['file_id']:
+                        refresh_url = functools.partial(refresh_signed_url, job['study'], job['file_id'])
+                    future = downloaders.submit(
+                        timed, download_file, job['file_url'], job['gz_path'],
+                        expected_size=job['file_size'], expected_md5=job['md5sum'],
+                        refresh_url=refresh_url,
+                    )
+                    pending[future] = ('download', job)
+
+        def cache_file(job):
+            # only files whose MD5 is checked (see download_file and parse_mzid_url) are cached
+            if psm_cache is None or parser != 'iterparse' or not job['md5sum']:
+                return None
+            return psm_cache.path_of(job['file_id'], job['md5sum'])
+
+        def estimate(job, size):
+            if size is None:
+                return memory_budget // parse_workers if memory_budget else PARSE_MEMORY_BASE
+            if parser == 'pyteomics':
+                return parse_memory('pyteomics', size)
+            if cache_file(job) is not None or protein_rules:
+                return parse_memory('psms', size)
+            return parse_memory('iterparse', size)
+
+        def queue_parse(job, memory, function, *args):
+            heapq.heappush(ready, (-memory, next(order), job, function, args))
+
+        def submit_parses():
+            nonlocal parsers, pool_parses
+            # a parse only starts when a parser is free, so that it runs
+            # within the memory reserved for it
+            while ready and len(reserved) < parse_workers:
+                memory = -ready[0][0]
+                if memory_budget and reserved and sum(reserved.values()) + memory > memory_budget:
+                    return
+                if pool_parses == parses_per_pool:
+                    parsers.shutdown(wait=False)
+                    parsers = ProcessPoolExecutor(max_workers=parse_workers)
+                    pool_parses = 0
+                _, _, job, function, args = heapq.heappop(ready)
+                future = parsers.submit(timed, function, *args)
+                pool_parses += 1
+                pending[future] = ('parse', job)
+                reserved[future] = memory
+
+        def in_flight():
+            stages = [stage for stage, _ in pending.values()]
+            return {
+                'downloads': stages.count('download'),
+                'parses': stages.count('parse'),
+                'waiting': len(ready),
+                'memory_mb': sum(reserved.values()) // 2 ** 20,
+            }
+
+        submit_downloads()
+        submit_parses()
+        while pending or ready or not exhausted:
+            # while the source may still produce jobs, wake up now and then to ask it;
+            # while reporting progress, wake up to report even if nothing finishes
+            timeout = 0.5 if not exhausted else tracker.interval if tracker.active else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, job = pending.pop(future)
+
+                if stage == 'download':
+                    try:
+                        seconds, _ = future.result()
+                    except Exception as e:
+                        print(f"Failed to download {job['file_url']}: {e}")
+                        job_state.failed(job['file_id'], e)
+                        tracker.update()
+                        continue
+                    size = os.path.getsize(job['gz_path'])
+                    job_state.downloaded(job['file_id'], seconds, size)
+                    tracker.update(0, size)
+                    queue_parse(job, estimate(job, size), parse_mzid_gz, job['gz_path'], job['extracted_dir'],
+                                parser, cache_file(job), protein_rules)
+                    continue
+
+                del reserved[future]
+                try:
+                    seconds, protein_names = future.result()
+                except Exception as e:
+                    print(f"Failed to parse {job['file_name']}: {e}")
+                    job_state.failed(job['file_id'], e)
+                    tracker.update()
+                    continue
+
+                stored = finish_job(
+                    job, protein_names, store,
+                    delete_downloaded_files=delete_downloaded_files,
+                    write_protein_lists=write_protein_lists,
+                )
+                if stored:
+                    job_state.parsed(job['file_id'], seconds, len(protein_names))
+                else:
+                    job_state.failed(job['file_id'], 'could not store proteins')
+                tracker.update()
+
+            submit_downloads()
+            submit_parses()
+            tracker.tick(**in_flight())
+
+    if tracker.active:
+        tracker.report(downloads=0, parses=0, waiting=0, memory_mb=0)
+
+    for keyword, problematic_list_file in keywords.items():
+        write_problematic_list(job_state, keyword, problematic_list_file)
+
+def open_job_state(store):
+    """
+    The job table kept next to the proteins of a writable store. The store
+    lock guarantees no other process works on it, so jobs a crashed run left
+    half done are put back in the queue.
+    """
+    job_state = JobState(os.path.join(store.path, 'jobs.sqlite3'))
+    requeued = job_state.recover()
+    if requeued:
+        print(f"Requeued {requeued} unfinished jobs of an earlier run.")
+    return job_state
+
+def process_keyword(keyword, delete_downloaded_files=False, download_workers=4, parse_workers=None,
+                    parser='iterparse', stream_downloads=False, store_path='protein_store',
+                    write_protein_lists=False, shard=None, progress=False,
+                    psm_cache_path=DEFAULT_CACHE, protein_rules=None, memory_budget=None,
+                    max_tasks_per_child=None):
+    """
+    Download and parse every file listed in data_{keyword}.csv (see run_jobs),
+    largest first.
+
+    Protein names go to the protein store at store_path (see protein_store),
+    shared by all keywords; write_protein_lists=True also writes the old
+    {keyword}_protein_list/<file>.txt lists. With a shard (i, N) only that
+    shard's files are processed, into the shard's own store (see sharding).
+    Parsed PSMs are cached in psm_cache_path (None: no cache), which all
+    shards and stores share.
+    """
+    with ProteinStore(shard_path(store_path, shard), writable=True) as store:
+        job_state = open_job_state(store)
+        rows = read_manifest(f'data_{keyword}.csv')
+        # listed up front, so that progress has a total to estimate from
+        jobs = largest_first(iter_manifest_jobs(rows, store, keyword, job_state=job_state, shard=shard))
+        run_jobs(
+            jobs, store, job_state,
+            delete_downloaded_files=delete_downloaded_files,
+            download_workers=download_workers,
+            parse_workers=parse_workers,
+            parser=parser,
+            stream_downloads=stream_downloads,
+            write_protein_lists=write_protein_lists,
+            total=len(jobs),
+            progress=progress,
+            psm_cache=PsmCache(psm_cache_path) if psm_cache_path else None,
+            protein_rules=protein_rules,
+            memory_budget=memory_budget,
+            max_tasks_per_child=max_tasks_per_child,
+        )
+
+def merge_shards(store_path, keywords, source_paths=None):
+    """
+    Merge the shard stores of store_path (or the stores at source_paths)
+    and their job tables into the store at store_path, and write the
+    problematic file lists of keywords for all shards together. Nothing is
+    downloaded or parsed again.
+    """
+    if source_paths is None:
+        source_paths = find_shard_paths(store_path)
+    with ProteinStore(store_path, writable=True) as store:
+        added = merge_stores(store, source_paths)
+        job_state = JobState(os.path.join(store.path, 'jobs.sqlite3'))
+        for source_path in source_paths:
+            jobs_path = os.path.join(source_path, 'jobs.sqlite3')
+            if os.path.exists(jobs_path):
+                job_state.merge(jobs_path)
+    print(f"Merged {added} files from {len(source_paths)} shard stores into {store_path}")
+    for keyword in keywords:
+        write_problematic_list(job_state, keyword, keyword_dirs(keyword)['problematic_list_file'])
+
+def run_local_shards(keywords, num_shards, options):
+    """
+    Simulate a sharded run on this machine: start one process per shard, as
+    a batch node would run `process_manifest_file.py --shard i/N`, wait for
+    all of them and merge their stores. options are the command line
+    options passed to every shard.
+    """
+    shards = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), *keywords,
+                          '--shard', f'{index}/{num_shards}', *options])
+        for index in range(num_shards)
+    ]
+    failed = [index for index, shard in enumerate(shards) if shard.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} of {num_shards} failed; rerun them before merging.")
+
+
 if __name__ == '__main__':
-    
-    for keyword in ['noninvasive', 'invasive']:
-        print(f"Processing keyword: {keyword}")
-        process_keyword(keyword, delete_downloaded_files=False)
+    parser = argparse.ArgumentParser(description='Download and extract protein lists for each manifest.')
+    parser.add_argument('keywords', nargs='*', default=['noninvasive', 'invasive'])
+    parser.add_argument('--download-workers', type=int, default=4,
+                        help='number of concurrent downloads (default: 4)')
+    parser.add_argument('--parse-workers', type=int, default=None,
+                        help='number of mzid parser processes (default: number of CPUs)')
+    parser.add_argument('--parser', choices=['iterparse', 'pyteomics'], default='iterparse',
+                        help='mzid parser to use (default: iterparse)')
+    parser.add_argument('--stream-downloads', action='store_true',
+                        help='parse files straight from the download stream without storing them')
+    parser.add_argument('--delete-downloaded-files', action='store_true')
+    parser.add_argument('--store', default='protein_store',
+                        help='protein store shared by all keywords (default: protein_store)')
+    parser.add_argument('--write-protein-lists', action='store_true',
+                        help='also write one {keyword}_protein_list/<file>.txt per file')
+    parser.add_argument('--shard', type=parse_shard, default=None, metavar='i/N',
+                        help='process only shard i of N (0 <= i < N), into the store <store>.shard<i>of<N>')
+    parser.add_argument('--local-shards', type=int, default=None, metavar='N',
+                        help='run N shards as separate processes on this machine and merge their stores')
+    parser.add_argument('--merge-shards', action='store_true',
+                        help='only merge the shard stores of --store, without processing anything')
+    parser.add_argument('--psm-cache', default=DEFAULT_CACHE, metavar='DIR',
+                        help='cache of the parsed PSMs of every file (default: psm_cache)')
+    parser.add_argument('--no-psm-cache', action='store_true',
+                        help='neither read nor write the PSM cache')
+    parser.add_argument('--all-evidence', action='store_true',
+                        help='list the proteins of every evidence, not only the first of each spectrum')
+    parser.add_argument('--max-q-value', type=float, default=None,
+                        help='list only the proteins of PSMs with at most this q-value')
+    parser.add_argument('--memory-budget', type=parse_size, default=None, metavar='SIZE',
+                        help='memory the parses running at once may use, e.g. 16G '
+                             '(default: 75%% of the physical memory)')
+    parser.add_argument('--max-tasks-per-child', type=int, default=DEFAULT_MAX_TASKS_PER_CHILD, metavar='N',
+                        help='replace each parser process after N files, 0 to never replace them '
+                             f'(default: {DEFAULT_MAX_TASKS_PER_CHILD})')
+    parser.add_argument('--progress', action='store_true',
+                        help='print a progress summary with an ETA every 30 seconds')
+    parser.add_argument('--telemetry', default=None, metavar='PATH',
+                        help='append JSON-lines telemetry events to PATH '
+                             '(summarize with python -m pdc_api.utils.telemetry PATH)')
+    args = parser.parse_args()
+
+    if args.telemetry:
+        # inherited by the parser processes and the local shards
+        telemetry.configure(args.telemetry)
+
+    protein_rules = {}
+    if args.all_evidence:
+        protein_rules['all_evidence'] = True
+    if args.max_q_value is not None:
+        protein_rules['max_q_value'] = args.max_q_value
+    if protein_rules and args.parser == 'pyteomics':
+        parser.error('--all-evidence and --max-q-value need the iterparse parser')
+    psm_cache_path = None if args.no_psm_cache else args.psm_cache
+    memory_budget = args.memory_budget or default_memory_budget()
+
+    if args.merge_shards:
+        merge_shards(args.store, args.keywords)
+    elif args.local_shards:
+        options = [
+            '--download-workers', str(args.download_workers),
+            # the shards share this machine's CPUs
+            '--parse-workers', str(args.parse_workers or max(1, (os.cpu_count() or 1) // args.local_shards)),
+            '--parser', args.parser,
+            '--store', args.store,
+            '--psm-cache', args.psm_cache,
+            '--max-tasks-per-child', str(args.max_tasks_per_child),
+        ]
+        if memory_budget:
+            # the shards share the memory budget too
+            options += ['--memory-budget', str(memory_budget // args.local_shards)]
+        if args.max_q_value is not None:
+            options += ['--max-q-value', str(args.max_q_value)]
+        for flag, enabled in [
+            ('--stream-downloads', args.stream_downloads),
+            ('--delete-downloaded-files', args.delete_downloaded_files),
+            ('--write-protein-lists', args.write_protein_lists),
+            ('--progress', args.progress),
+            ('--no-psm-cache', args.no_psm_cache),
+            ('--all-evidence', args.all_evidence),
+        ]:
+            if enabled:
+                options.append(flag)
+        run_local_shards(args.keywords, args.local_shards, options)
+        merge_shards(args.store, args.keywords)
+    else:
+        for keyword in args.keywords:
+            print(f"Processing keyword: {keyword}")
+            process_keyword(
+                keyword,
+                delete_downloaded_files=args.delete_downloaded_files,
+                download_workers=args.download_workers,
+                parse_workers=args.parse_workers,
+                parser=args.parser,
+                stream_downloads=args.stream_downloads,
+                store_path=args.store,
+                write_protein_lists=args.write_protein_lists,
+                shard=args.shard,
+                progress=args.progress,
+                psm_cache_path=psm_cache_path,
+                protein_rules=protein_rules,
+                memory_budget=memory_budget,
+                max_tasks_per_child=args.max_tasks_per_child,
+            )
@@ -0,0 +1,234 @@
+"""
+Columnar protein counting.
+
+Protein lists are read in parallel, protein IDs are interned to integer codes
+and the result is kept as a sparse file x protein presence matrix. Counts and
+fractions for any split of the files are then column sums over a row mask,
+so a new cohort definition does not need another pass over the lists.
+"""
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+protein_regex = r"\|([A-Z0-9_]+)_HUMAN"
+
+# First protein_regex match on each line.
+PROTEIN_LINE_PATTERN = re.compile(r"^.*?" + protein_regex, re.MULTILINE)
+
+
+def read_protein_ids(txt_file_path):
+    """
+    Return the set of protein IDs in one protein list file.
+    Unreadable files are reported and yield an empty set.
+    """
+    try:
+        with open(txt_file_path, 'r', encoding='utf-8') as f:
+            return set(PROTEIN_LINE_PATTERN.findall(f.read()))
+    except Exception as e:
+        print(f"error reading file {txt_file_path}: {e}")
+        return set()
+
+def _read_chunk(paths):
+    """
+    Read a chunk of protein lists and intern them locally.
+    Returns (vocabulary, codes, lengths): the codes of file i are
+    codes[sum(lengths[:i]):sum(lengths[:i + 1])], indexing into vocabulary.
+    """
+    vocabulary = {}
+    codes = []
+    lengths = []
+    for path in paths:
+        ids = read_protein_ids(path)
+        lengths.append(len(ids))
+        for protein in ids:
+            codes.append(vocabulary.setdefault(protein, len(vocabulary)))
+    return list(vocabulary), np.asarray(codes, dtype=np.int32), np.asarray(lengths, dtype=np.int64)
+
+def list_protein_files(txt_folder_path):
+    """
+    Return the paths of the .txt protein lists in a folder, sorted by name.
+    """
+    if not os.path.isdir(txt_folder_path):
+        raise NotADirectoryError(f"Error: Provided path '{txt_folder_path}' is not a directory.")
+    files = sorted(
+        f for f in os.listdir(txt_folder_path)
+        if f.endswith('.txt') and os.path.isfile(os.path.join(txt_folder_path, f))
+    )
+    if not files:
+        raise FileNotFoundError(f"No .txt files found in the directory: {txt_folder_path}")
+    return [os.path.join(txt_folder_path, f) for f in files]
+
+
+class ProteinMatrix:
+    """
+    Presence of proteins (columns) in files (rows).
+
+    files     -- row labels (file names)
+    groups    -- group label of each row, e.g. the cohort a list came from
+    proteins  -- column labels (protein IDs); a protein's code is its column
+    presence  -- scipy.sparse CSR matrix of 0/1, files x proteins
+    """
+
+    def __init__(self, files, groups, proteins, presence):
+        self.files = np.asarray(files, dtype=object)
+        self.groups = np.asarray(groups, dtype=object)
+        self.proteins = np.asarray(proteins, dtype=object)
+        self.presence = sparse.csr_matrix(presence, dtype=np.int8)
+
+    @property
+    def num_files(self):
+        return self.presence.shape[0]
+
+    def group_mask(self, group):
+        """
+        Boolean row mask of the files in the given group.
+        """
+        return self.groups == group
+
+    def _rows(self, rows):
+        if rows is None:
+            return self.presence
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        return self.presence[rows]
+
+    def counts(self, rows=None):
+        """
+        Number of files containing each protein, over the selected rows
+        (a boolean mask or row indices; all rows by default).
+        """
+        return np.asarray(self._rows(rows).sum(axis=0, dtype=np.int64)).ravel()
+
+    def fractions(self, rows=None):
+        """
+        Fraction of the selected files containing each protein.
+        """
+        presence = self._rows(rows)
+        total = presence.shape[0]
+        counts = np.asarray(presence.sum(axis=0, dtype=np.int64)).ravel()
+        return counts / total if total > 0 else np.zeros(len(counts))
+
+    def counts_dict(self, rows=None):
+        """
+        {protein: count} for the proteins present in the selected rows, the
+        shape returned by write_to_csv.process_txt.
+        """
+        counts = self.counts(rows)
+        present = np.flatnonzero(counts)
+        return dict(zip(self.proteins[present].tolist(), counts[present].tolist()))
+
+    def save(self, path):
+        """
+        Save the matrix as a compressed .npz file.
+        """
+        np.savez_compressed(
+            path,
+            files=self.files.astype(str),
+            groups=self.groups.astype(str),
+            proteins=self.proteins.astype(str),
+            indptr=self.presence.indptr,
+            indices=self.presence.indices,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a matrix written by save.
+        """
+        with np.load(path) as data:
+            indices = data['indices']
+            presence = sparse.csr_matrix(
+                (np.ones(len(indices), dtype=np.int8), indices, data['indptr']),
+                shape=(len(data['files']), len(data['proteins'])),
+            )
+            return cls(data['files'], data['groups'], data['proteins'], presence)
+
+
+def build_protein_matrix(folders, workers=None, chunk_size=64):
+    """
+    Read every protein list in folders ({group: folder path}) into a ProteinMatrix.
+    Files are read by a pool of workers processes (default: one per CPU), in
+    chunks of chunk_size files.
+    """
+    files = []
+    groups = []
+    paths = []
+    for group, folder in folders.items():
+        for path in list_protein_files(folder):
+            files.append(os.path.basename(path))
+            groups.append(group)
+            paths.append(path)
+
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map keeps the chunks in order, so rows stay aligned with files
+        return matrix_from_chunks(files, groups, executor.map(_read_chunk, chunks))
+
+
+def matrix_from_chunks(files, groups, chunks):
+    """
+    Assemble a ProteinMatrix from the (vocabulary, codes, lengths) results
+    of reading the files in chunks, in order (see _read_chunk).
+    """
+    proteins = {}
+    all_codes = []
+    all_lengths = []
+    for vocabulary, codes, lengths in chunks:
+        to_global = np.fromiter(
+            (proteins.setdefault(protein, len(proteins)) for protein in vocabulary),
+            dtype=np.int32,
+            count=len(vocabulary),
+        )
+        all_codes.append(to_global[codes] if len(codes) else codes)
+        all_lengths.append(lengths)
+
+    indices = np.concatenate(all_codes) if all_codes else np.zeros(0, dtype=np.int32)
+    lengths = np.concatenate(all_lengths) if all_lengths else np.zeros(0, dtype=np.int64)
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+
+    presence = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.int8), indices, indptr),
+        shape=(len(files), len(proteins)),
+    )
+    presence.sort_indices()
+
+    return ProteinMatrix(files, groups, list(proteins), presence)
+
+
+def concat_matrices(matrices):
+    """
+    Stack ProteinMatrix objects of different files (e.g. one per shard)
+    into one, aligning their protein columns by ID.
+    """
+    proteins = {}
+    files = []
+    groups = []
+    indices = []
+    lengths = []
+    for matrix in matrices:
+        to_global = np.fromiter(
+            (proteins.setdefault(protein, len(proteins)) for protein in matrix.proteins),
+            dtype=np.int32,
+            count=len(matrix.proteins),
+        )
+        files.extend(matrix.files)
+        groups.extend(matrix.groups)
+        indices.append(to_global[matrix.presence.indices])
+        lengths.append(np.diff(matrix.presence.indptr))
+
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32)
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+
+    presence = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.int8), indices, indptr),
+        shape=(len(files), len(proteins)),
+    )
+    presence.sort_indices()
+
+    return ProteinMatrix(files, groups, list(proteins), presence)
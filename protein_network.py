@@ -0,0 +1,294 @@
+"""
+Protein co-occurrence networks of the cohorts, for Step 5 (Cytoscape).
+
+Two proteins are linked when they are found in the same files. For the
+files x proteins presence matrix X of a cohort, the number of files that
+contain both of two proteins is an entry of the sparse product X^T X. The
+product is computed in blocks of protein columns, spread over a process
+pool; only the upper triangle of each block is computed, and it is
+thresholded before the block leaves its worker, so the full protein x
+protein matrix never exists.
+
+Each edge carries its co-occurrence count and two weights:
+
+    jaccard        files with both / files with either protein
+    p_value        hypergeometric probability of at least that many shared
+                   files, if the proteins occurred independently
+
+With --weight jaccard (the default) edges with a Jaccard index of at least
+--min-jaccard are kept; with --weight hypergeometric, edges with a p-value of
+at most --max-p (default: 0.05 Bonferroni-corrected for the number of
+protein pairs), weighted -log10(p). Edges are streamed to one file per
+cohort and format in the output folder:
+
+    sif       protein_a <tab> co-occurs <tab> protein_b, Cytoscape's plain
+              network format
+    graphml   nodes with their file count and fraction, edges with all weights
+    parquet   source, target, cooccurrence, jaccard, p_value and weight columns
+
+    python protein_network.py
+    python protein_network.py --weight hypergeometric --format graphml parquet
+    python protein_network.py --definitions cohorts.json --cohorts late_breast
+"""
+import os
+import sys
+import argparse
+from xml.sax.saxutils import quoteattr
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scipy import stats
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdc_discovery_scripts'))
+
+from pdc_api.utils import telemetry
+from cohorts import DEFAULT_COHORTS
+from cohorts import DEFAULT_TABLE
+from cohorts import cohort_masks
+from cohorts import output_name
+from cohorts import load_definitions
+from protein_store import load_matrix
+
+FORMATS = ['sif', 'graphml', 'parquet']
+
+EDGE_SCHEMA = pa.schema([
+    ('source', pa.string()),
+    ('target', pa.string()),
+    ('cooccurrence', pa.int32()),
+    ('jaccard', pa.float64()),
+    ('p_value', pa.float64()),
+    ('weight', pa.float64()),
+])
+
+# the presence matrix of the cohort and its column sums, set once per worker process
+_presence = None
+_counts = None
+
+
+def _init_worker(presence, counts):
+    global _presence, _counts
+    _presence = presence
+    _counts = counts
+
+def _block_edges(start, stop, weight, min_cooccurrence, threshold):
+    """
+    The edges between proteins start..stop - 1 and the proteins before
+    them, thresholded: (rows, columns, cooccurrence, jaccard, p_value).
+    """
+    num_files = _presence.shape[0]
+    product = (_presence[:, :stop].T @ _presence[:, start:stop]).tocoo()
+    rows = product.row
+    columns = product.col + start
+    shared = product.data
+
+    keep = (rows < columns) & (shared >= min_cooccurrence)
+    rows, columns, shared = rows[keep], columns[keep], shared[keep]
+
+    count_a = _counts[rows]
+    count_b = _counts[columns]
+    jaccard = shared / (count_a + count_b - shared)
+    if weight == 'jaccard':
+        keep = jaccard >= threshold
+        rows, columns, shared, jaccard = rows[keep], columns[keep], shared[keep], jaccard[keep]
+        count_a, count_b = count_a[keep], count_b[keep]
+    p_value = stats.hypergeom.sf(shared - 1, num_files, count_a, count_b)
+    if weight == 'hypergeometric':
+        keep = p_value <= threshold
+        rows, columns, shared, jaccard, p_value = \
+            rows[keep], columns[keep], shared[keep], jaccard[keep], p_value[keep]
+    return rows, columns, shared, jaccard, p_value
+
+def cooccurrence_edges(presence, weight='jaccard', threshold=0.5, min_cooccurrence=2,
+                       block_size=256, workers=None):
+    """
+    Yield the thresholded co-occurrence edges of a files x proteins presence
+    matrix, block by block, as (rows, columns, cooccurrence, jaccard,
+    p_value) arrays of protein column indices and weights.
+    """
+    presence = presence.tocsc().astype(np.int32)
+    counts = np.asarray(presence.sum(axis=0)).ravel()
+    num_proteins = presence.shape[1]
+    blocks = [(start, min(start + block_size, num_proteins)) for start in range(0, num_proteins, block_size)]
+    arguments = [
+        [block[0] for block in blocks],
+        [block[1] for block in blocks],
+        [weight] * len(blocks),
+        [min_cooccurrence] * len(blocks),
+        [threshold] * len(blocks),
+    ]
+
+    if workers == 1 or len(blocks) <= 1:
+        _init_worker(presence, counts)
+        yield from map(_block_edges, *arguments)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(presence, counts)) as executor:
+        # map keeps the blocks in order, so the output is the same for any number of workers
+        yield from executor.map(_block_edges, *arguments)
+
+
+class SifWriter:
+    """
+    Edges as a Simple Interaction Format file.
+    """
+
+    def __init__(self, path, proteins, counts, num_files):
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def write(self, source, target, columns):
+        self.file.writelines(f"{a}\tco-occurs\t{b}\n" for a, b in zip(source, target))
+
+    def close(self):
+        self.file.close()
+
+class GraphmlWriter:
+    """
+    An undirected GraphML graph: the proteins as nodes, then the edges.
+    """
+
+    def __init__(self, path, proteins, counts, num_files):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.file.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+            '  <key id="files" for="node" attr.name="files" attr.type="int"/>\n'
+            '  <key id="fraction" for="node" attr.name="fraction" attr.type="double"/>\n'
+            '  <key id="cooccurrence" for="edge" attr.name="cooccurrence" attr.type="int"/>\n'
+            '  <key id="jaccard" for="edge" attr.name="jaccard" attr.type="double"/>\n'
+            '  <key id="p_value" for="edge" attr.name="p_value" attr.type="double"/>\n'
+            '  <key id="weight" for="edge" attr.name="weight" attr.type="double"/>\n'
+            '  <graph id="G" edgedefault="undirected">\n'
+        )
+        self.file.writelines(
+            f'    <node id={quoteattr(str(protein))}><data key="files">{count}</data>'
+            f'<data key="fraction">{count / num_files:.6g}</data></node>\n'
+            for protein, count in zip(proteins, counts)
+        )
+
+    def write(self, source, target, columns):
+        keys = list(columns)
+        for a, b, *values in zip(source, target, *(column.tolist() for column in columns.values())):
+            data = ''.join(f'<data key="{key}">{value!r}</data>' for key, value in zip(keys, values))
+            self.file.write(f'    <edge source={quoteattr(str(a))} target={quoteattr(str(b))}>{data}</edge>\n')
+
+    def close(self):
+        self.file.write('  </graph>\n</graphml>\n')
+        self.file.close()
+
+class ParquetWriter:
+    """
+    Edges as a Parquet table, one row group per block.
+    """
+
+    def __init__(self, path, proteins, counts, num_files):
+        self.writer = pq.ParquetWriter(path, EDGE_SCHEMA)
+
+    def write(self, source, target, columns):
+        self.writer.write_table(pa.table({'source': source, 'target': target, **columns}, schema=EDGE_SCHEMA))
+
+    def close(self):
+        self.writer.close()
+
+WRITERS = {'sif': SifWriter, 'graphml': GraphmlWriter, 'parquet': ParquetWriter}
+
+
+def write_network(matrix, rows, path_prefix, formats=('sif',), weight='jaccard', threshold=None,
+                  min_files=2, min_cooccurrence=2, block_size=256, workers=None):
+    """
+    Build the co-occurrence network of the selected rows (files) of a
+    ProteinMatrix and stream it to path_prefix + '.' + format for each of
+    formats. Proteins in fewer than min_files of the files are left out.
+    Returns the number of proteins and of edges.
+    """
+    presence = matrix.presence[np.flatnonzero(rows)] if rows is not None and not rows.all() else matrix.presence
+    counts = np.asarray(presence.sum(axis=0, dtype=np.int64)).ravel()
+    kept = np.flatnonzero(counts >= max(min_files, 1))
+    presence = presence[:, kept]
+    proteins = matrix.proteins[kept]
+    counts = counts[kept]
+    num_files = presence.shape[0]
+
+    if threshold is None:
+        num_pairs = len(kept) * (len(kept) - 1) // 2
+        threshold = 0.5 if weight == 'jaccard' else 0.05 / max(num_pairs, 1)
+
+    writers = [WRITERS[format](f"{path_prefix}.{format}", proteins, counts, num_files) for format in formats]
+    num_edges = 0
+    try:
+        for block_rows, block_columns, shared, jaccard, p_value in cooccurrence_edges(
+            presence, weight, threshold, min_cooccurrence, block_size, workers,
+        ):
+            if weight == 'jaccard':
+                edge_weight = jaccard
+            else:
+                edge_weight = -np.log10(np.maximum(p_value, np.finfo(float).tiny))
+            source = proteins[block_rows].astype(str)
+            target = proteins[block_columns].astype(str)
+            columns = {
+                'cooccurrence': shared.astype(np.int32),
+                'jaccard': jaccard,
+                'p_value': p_value,
+                'weight': edge_weight,
+            }
+            for writer in writers:
+                writer.write(source, target, columns)
+            num_edges += len(source)
+    finally:
+        for writer in writers:
+            writer.close()
+    return len(proteins), num_edges
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build protein co-occurrence networks of the cohorts.')
+    parser.add_argument('--store', default='protein_store')
+    parser.add_argument('--table', default=DEFAULT_TABLE)
+    parser.add_argument('--definitions', default=None,
+                        help='JSON list of cohort definitions (default: noninvasive and invasive)')
+    parser.add_argument('--cohorts', nargs='+', default=None, metavar='NAME',
+                        help='build only these cohorts; "all" is every file in the store')
+    parser.add_argument('--weight', choices=['jaccard', 'hypergeometric'], default='jaccard')
+    parser.add_argument('--min-jaccard', type=float, default=0.5)
+    parser.add_argument('--max-p', type=float, default=None,
+                        help='largest p-value of an edge (default: 0.05 / number of protein pairs)')
+    parser.add_argument('--min-cooccurrence', type=int, default=2,
+                        help='fewest files two proteins must share to be linked')
+    parser.add_argument('--min-files', type=int, default=2,
+                        help='leave out proteins found in fewer files of the cohort')
+    parser.add_argument('--format', nargs='+', choices=FORMATS, default=['sif'])
+    parser.add_argument('--block-size', type=int, default=256,
+                        help='proteins per block of the product')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes for the blocks (default: number of CPUs)')
+    parser.add_argument('--output', default='networks')
+    args = parser.parse_args()
+
+    matrix, file_ids = load_matrix(args.store)
+    if matrix is None:
+        raise SystemExit(f"No protein store at {args.store}")
+
+    definitions = load_definitions(args.definitions) if args.definitions else DEFAULT_COHORTS
+    masks = cohort_masks(matrix, file_ids, definitions, args.table)
+    names = args.cohorts or [definition['name'] for definition in definitions]
+    unknown = [name for name in names if name not in masks]
+    if unknown:
+        raise SystemExit(f"No cohort named {', '.join(unknown)}")
+
+    threshold = args.min_jaccard if args.weight == 'jaccard' else args.max_p
+    os.makedirs(args.output, exist_ok=True)
+    for name in names:
+        rows = masks[name]
+        num_files = int(rows.sum())
+        if num_files == 0:
+            print(f"{name}: no files in the store, skipped")
+            continue
+        with telemetry.span('network', cohort=name, files=num_files) as event:
+            num_proteins, num_edges = write_network(
+                matrix, rows, os.path.join(args.output, output_name(name)), args.format,
+                weight=args.weight, threshold=threshold, min_files=args.min_files,
+                min_cooccurrence=args.min_cooccurrence, block_size=args.block_size, workers=args.workers,
+            )
+            event.update(proteins=num_proteins, edges=num_edges)
+        print(f"{name}: {num_files} files, {num_proteins} proteins, {num_edges} edges")
+    print(f"Networks written to {args.output}")
@@ -0,0 +1,364 @@
+"""
+A single on-disk store for the protein lists of all processed files.
+
+Instead of one {keyword}_protein_list/<file>.txt per mzid file, the
+extraction stage appends every file to one store directory:
+
+    proteins.txt  shared dictionary, one protein name per line; the line
+                  number is the protein's code
+    codes.u32     the sorted protein codes of every file, back to back,
+                  as little-endian uint32
+    files.tsv     one row per file: file_id, file_name, keyword, study,
+                  stage, and the offset/count of its codes in codes.u32
+
+A file's row in files.tsv is written last, so a crash mid-append leaves no
+half-written entry behind; the leftovers are trimmed when the store is next
+opened for writing. The counting stage memory-maps codes.u32 and needs no
+parsing beyond matching protein_regex once per dictionary entry.
+"""
+import os
+import re
+import csv
+import argparse
+
+import numpy as np
+from scipy import sparse
+
+from protein_matrix import ProteinMatrix
+from protein_matrix import concat_matrices
+from protein_matrix import list_protein_files
+from protein_matrix import protein_regex
+from sharding import find_shard_paths
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locking
+    fcntl = None
+
+INDEX_COLUMNS = ['file_id', 'file_name', 'keyword', 'study', 'stage', 'offset', 'count']
+CODE_DTYPE = np.dtype('<u4')
+
+
+def _clean(value):
+    return str(value or '').replace('\t', ' ').replace('\n', ' ')
+
+def _trim_to_last_newline(path):
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end != len(data):
+            f.truncate(end)
+
+
+class ProteinStore:
+    """
+    The protein store at path. Opening it with writable=True takes an
+    exclusive lock, so only one process appends to a store at a time;
+    readers need no lock.
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        self._lock_file = None
+
+        self.proteins_path = os.path.join(path, 'proteins.txt')
+        self.codes_path = os.path.join(path, 'codes.u32')
+        self.index_path = os.path.join(path, 'files.tsv')
+
+        if writable:
+            os.makedirs(path, exist_ok=True)
+            self._lock()
+            for p in (self.proteins_path, self.codes_path):
+                open(p, 'ab').close()
+            if not os.path.exists(self.index_path):
+                with open(self.index_path, 'w', encoding='utf-8', newline='') as f:
+                    f.write('\t'.join(INDEX_COLUMNS) + '\n')
+            _trim_to_last_newline(self.proteins_path)
+            _trim_to_last_newline(self.index_path)
+
+        # the index is read first: every name it refers to was written before it
+        self.index = []
+        self.file_ids = set()
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8', newline='') as f:
+                for row in csv.DictReader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+                    row['offset'] = int(row['offset'])
+                    row['count'] = int(row['count'])
+                    self.index.append(row)
+                    self.file_ids.add(row['file_id'])
+
+        self.proteins = []
+        self.codes = {}
+        if os.path.exists(self.proteins_path):
+            # only '\n' ends a name; a '\r' in one must not split it and shift the codes after it
+            with open(self.proteins_path, 'r', encoding='utf-8', newline='\n') as f:
+                for line in f:
+                    self._add_protein(line.rstrip('\n'))
+
+        self.num_codes = sum(row['count'] for row in self.index)
+        if writable:
+            # drop codes of an append that never got its index row
+            with open(self.codes_path, 'rb+') as f:
+                f.truncate(self.num_codes * CODE_DTYPE.itemsize)
+
+    def _lock(self):
+        self._lock_file = open(os.path.join(self.path, '.lock'), 'w')
+        if fcntl is None:
+            return
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise RuntimeError(f"Protein store {self.path} is already open for writing by another process.")
+
+    def close(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __contains__(self, file_id):
+        return file_id in self.file_ids
+
+    def __len__(self):
+        return len(self.index)
+
+    def _add_protein(self, name):
+        code = self.codes.get(name)
+        if code is None:
+            code = len(self.proteins)
+            self.codes[name] = code
+            self.proteins.append(name)
+        return code
+
+    def append(self, file_id, proteins, file_name='', keyword='', study='', stage=''):
+        """
+        Add the protein names of one file. Files already in the store are ignored.
+        """
+        if not self.writable:
+            raise RuntimeError(f"Protein store {self.path} was not opened for writing.")
+        file_id = _clean(file_id)
+        if file_id in self.file_ids:
+            return
+
+        num_known = len(self.proteins)
+        codes = np.unique(np.fromiter(
+            (self._add_protein(name.replace('\n', ' ')) for name in proteins),
+            dtype=CODE_DTYPE,
+        ))
+
+        new_names = self.proteins[num_known:]
+        if new_names:
+            with open(self.proteins_path, 'a', encoding='utf-8', newline='\n') as f:
+                f.write(''.join(name + '\n' for name in new_names))
+                f.flush()
+                os.fsync(f.fileno())
+
+        with open(self.codes_path, 'ab') as f:
+            f.write(codes.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        row = {
+            'file_id': file_id,
+            'file_name': _clean(file_name),
+            'keyword': _clean(keyword),
+            'study': _clean(study),
+            'stage': _clean(stage),
+            'offset': self.num_codes,
+            'count': len(codes),
+        }
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            f.write('\t'.join(str(row[column]) for column in INDEX_COLUMNS) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.index.append(row)
+        self.file_ids.add(file_id)
+        self.num_codes += len(codes)
+
+    def file_codes(self):
+        """
+        Memory-mapped array of all protein codes; the codes of the i-th file
+        are file_codes()[index[i]['offset']:][:index[i]['count']].
+        """
+        if self.num_codes == 0:
+            return np.zeros(0, dtype=CODE_DTYPE)
+        return np.memmap(self.codes_path, dtype=CODE_DTYPE, mode='r', shape=(self.num_codes,))
+
+    def proteins_of(self, file_id):
+        """
+        The protein names stored for one file.
+        """
+        for row in self.index:
+            if row['file_id'] == file_id:
+                codes = self.file_codes()[row['offset']:row['offset'] + row['count']]
+                return [self.proteins[code] for code in codes]
+        raise KeyError(file_id)
+
+    def to_matrix(self, group_by='keyword', pattern=protein_regex):
+        """
+        Build a ProteinMatrix of protein IDs (the first group of pattern in
+        each protein name) per file; names without an ID are left out. Row
+        groups are taken from the group_by column of the index.
+        """
+        compiled = re.compile(pattern)
+        ids = {}
+        to_id = np.full(len(self.proteins), -1, dtype=np.int64)
+        for code, name in enumerate(self.proteins):
+            match = compiled.search(name)
+            if match:
+                to_id[code] = ids.setdefault(match.group(1), len(ids))
+
+        counts = np.array([row['count'] for row in self.index], dtype=np.int64)
+        rows = np.repeat(np.arange(len(self.index)), counts)
+        columns = to_id[self.file_codes()] if len(rows) else np.zeros(0, dtype=np.int64)
+
+        keep = columns >= 0
+        presence = sparse.csr_matrix(
+            (np.ones(int(keep.sum()), dtype=np.int8), (rows[keep], columns[keep])),
+            shape=(len(self.index), len(ids)),
+        )
+        # several names can share an ID; presence stays 0/1
+        presence.sum_duplicates()
+        presence.data[:] = 1
+
+        return ProteinMatrix(
+            [row['file_name'] or row['file_id'] for row in self.index],
+            [row[group_by] for row in self.index],
+            list(ids),
+            presence,
+        )
+
+
+def open_stores(store_path):
+    """
+    The store at store_path for reading, or its shard stores if a sharded
+    run was not merged yet; an empty list if there is neither.
+    """
+    store_paths = [store_path] if os.path.isdir(store_path) else find_shard_paths(store_path)
+    return [ProteinStore(path) for path in store_paths]
+
+def load_matrix(store_path, group_by='keyword'):
+    """
+    The ProteinMatrix of the store at store_path, or of its shard stores if
+    a sharded run was not merged yet, and the file_id of each matrix row.
+    Returns (None, None) if there is neither.
+    """
+    stores = open_stores(store_path)
+    if not stores:
+        return None, None
+    matrix = concat_matrices([store.to_matrix(group_by=group_by) for store in stores])
+    file_ids = [row['file_id'] for store in stores for row in store.index]
+    return matrix, file_ids
+
+def manifest_file_id(row):
+    """
+    (file_name, file_id) of a manifest row, the keys process_manifest_file.py
+    stores the file under, or None if the row has no download URL. The
+    file_id falls back to the file name without its extension, which is also
+    the name of the file's old .txt protein list.
+    """
+    # PDC manifests call the URL 'File Download Link', main.py calls it 'download_url'.
+    file_url = row.get('File Download Link') or row.get('download_url')
+    if not file_url:
+        return None
+    file_name = row.get('file_name') or os.path.basename(file_url.split('?')[0])
+    return file_name, row.get('file_id') or os.path.splitext(file_name)[0]
+
+def import_protein_lists(store, txt_folder_path, keyword, manifest_file=None):
+    """
+    Append the .txt protein lists of a folder (the old per-file output) to a
+    writable store. Each list is stored under the file_id its manifest row
+    (from manifest_file, if given) gives it, the same one
+    process_manifest_file.py uses, else under its name without .txt; lists
+    whose file_id or file name is already stored are skipped. Returns the
+    number of files added.
+    """
+    rows = {}
+    if manifest_file is not None:
+        with open(manifest_file, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                ids = manifest_file_id(row)
+                if ids is not None:
+                    rows[os.path.splitext(ids[0])[0]] = (row, *ids)
+
+    stored_names = {row['file_name'] for row in store.index}
+    added = 0
+    for path in list_protein_files(txt_folder_path):
+        base_name = os.path.splitext(os.path.basename(path))[0]
+        row, file_name, file_id = rows.get(base_name, ({}, base_name, base_name))
+        if file_id in store or file_name in stored_names:
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            proteins = [line.rstrip('\n') for line in f if line.strip()]
+        store.append(file_id, proteins, file_name=file_name, keyword=keyword,
+                     study=row.get('pdc_study_id', ''), stage=row.get('tumor_stage', ''))
+        stored_names.add(file_name)
+        added += 1
+    return added
+
+def merge_stores(store, source_paths):
+    """
+    Append the files of the stores at source_paths (e.g. the shard stores of
+    a sharded run) that a writable store does not have yet. Protein codes
+    are translated through their names, so stores with different
+    dictionaries can be merged. Returns the number of files added.
+    """
+    added = 0
+    for source_path in source_paths:
+        source = ProteinStore(source_path)
+        names = np.asarray(source.proteins, dtype=object)
+        codes = source.file_codes()
+        for row in source.index:
+            if row['file_id'] in store:
+                continue
+            file_codes = codes[row['offset']:row['offset'] + row['count']]
+            store.append(
+                row['file_id'],
+                names[file_codes].tolist(),
+                file_name=row['file_name'],
+                keyword=row['keyword'],
+                study=row['study'],
+                stage=row['stage'],
+            )
+            added += 1
+    return added
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect a protein store or import txt protein lists into it.')
+    parser.add_argument('--store', default='protein_store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('info')
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('folder')
+    import_parser.add_argument('keyword')
+    import_parser.add_argument('--manifest', default=None,
+                               help='manifest of the files, to store the lists under their file_id')
+    merge_parser = subparsers.add_parser('merge', help='merge other stores, e.g. shard stores, into --store')
+    merge_parser.add_argument('sources', nargs='*',
+                              help='stores to merge (default: the shard stores of --store)')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        with ProteinStore(args.store, writable=True) as store:
+            added = import_protein_lists(store, args.folder, args.keyword, args.manifest)
+        print(f"Imported {added} protein lists from {args.folder} into {args.store}")
+    elif args.command == 'merge':
+        sources = args.sources or find_shard_paths(args.store)
+        with ProteinStore(args.store, writable=True) as store:
+            added = merge_stores(store, sources)
+        print(f"Merged {added} files from {len(sources)} stores into {args.store}")
+    else:
+        store = ProteinStore(args.store)
+        keywords = sorted({row['keyword'] for row in store.index})
+        print(f"{len(store)} files, {len(store.proteins)} distinct protein names, {store.num_codes} entries")
+        for keyword in keywords:
+            print(f"\t{keyword}: {sum(row['keyword'] == keyword for row in store.index)} files")
@@ -0,0 +1,247 @@
+"""
+A content-addressed cache of the parsed PSMs of every mzid file.
+
+Downloading and parsing are by far the most expensive part of Step 3. The
+first parse of a file writes everything mzid_extract.read_psms finds, every
+peptide-spectrum match (PSM) with its peptide, protein, rank, score and
+q-value, to
+
+    psm_cache/<file_id[:2]>/<file_id>.<md5sum>.parquet
+
+keyed by the file's PDC file_id and md5sum, so a file that changes on PDC
+gets a new entry instead of a stale hit. The protein and peptide columns
+are dictionary-encoded and the file is compressed with zstd. Entries
+written in another FORMAT_VERSION count as misses and are parsed again.
+
+Protein lists are derived from an entry by the protein list rules: the
+first evidence of each spectrum (the default, like
+process_manifest_file.extract_proteins) or every evidence, and an optional
+q-value threshold. Files with an entry are never downloaded or parsed
+again; a rule change costs a scan of the cache:
+
+    python process_manifest_file.py --store protein_store_all --all-evidence
+    python write_to_csv.py --psm-cache psm_cache --all-evidence
+    python psm_cache.py info
+"""
+import os
+import re
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from mzid_extract import PsmEvidence
+from mzid_extract import protein_codes
+from protein_matrix import matrix_from_chunks
+from protein_matrix import protein_regex
+
+DEFAULT_CACHE = 'psm_cache'
+
+# the key part of entries of files without a known md5sum
+UNKNOWN_CHECKSUM = 'unknown'
+
+# bumped when the columns change, so older entries are not misread
+FORMAT_VERSION = '1'
+
+
+def _dictionary_column(codes, values):
+    # negative codes (e.g. a peptide without a sequence) are stored as nulls
+    return pa.DictionaryArray.from_arrays(
+        pa.array(codes, type=pa.int32(), mask=codes < 0), pa.array(values.tolist(), type=pa.string()))
+
+def _codes_and_values(column):
+    """
+    (codes, values) of a dictionary-encoded column read back from Parquet.
+    """
+    column = column.unify_dictionaries()
+    if column.num_chunks == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=object)
+    codes = np.concatenate([chunk.indices.fill_null(-1).to_numpy() for chunk in column.chunks])
+    values = np.asarray(column.chunk(0).dictionary.to_pylist(), dtype=object)
+    return codes.astype(np.int32), values
+
+def write_psm_file(path, psms, **metadata):
+    """
+    Write a PsmEvidence to path as Parquet, with metadata (e.g. file_id and
+    md5sum) in the file's key-value metadata. The entry appears atomically.
+    """
+    table = pa.table({
+        'spectrum': psms.spectrum,
+        'item': psms.item,
+        'rank': psms.rank,
+        'protein': _dictionary_column(psms.protein, psms.proteins),
+        'peptide': _dictionary_column(psms.peptide, psms.peptides),
+        'score': psms.score,
+        'q_value': psms.q_value,
+        'first': psms.first,
+    })
+    metadata = {'psm_cache_version': FORMAT_VERSION, **metadata}
+    table = table.replace_schema_metadata({key: str(value) for key, value in metadata.items()})
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+
+def is_current(path):
+    """
+    Whether the entry at path was written in this FORMAT_VERSION; reads only
+    the Parquet footer.
+    """
+    try:
+        metadata = pq.read_schema(path).metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return False
+    return metadata.get(b'psm_cache_version') == FORMAT_VERSION.encode()
+
+def read_psm_file(path):
+    """
+    Read an entry written by write_psm_file back into a PsmEvidence.
+    """
+    table = pq.read_table(path)
+    protein, proteins = _codes_and_values(table.column('protein'))
+    peptide, peptides = _codes_and_values(table.column('peptide'))
+    return PsmEvidence(
+        proteins, peptides,
+        **{column: table.column(column).to_numpy() for column in ('spectrum', 'item', 'rank')},
+        protein=protein,
+        peptide=peptide,
+        score=table.column('score').to_numpy(),
+        q_value=table.column('q_value').to_numpy(),
+        first=table.column('first').to_numpy(),
+    )
+
+def read_protein_set(path, all_evidence=False, max_q_value=None):
+    """
+    The protein names of an entry under the protein list rules, reading
+    only the columns they need.
+    """
+    table = pq.read_table(path, columns=['protein', 'first', 'q_value'])
+    protein, proteins = _codes_and_values(table.column('protein'))
+    codes = protein_codes(
+        protein, table.column('first').to_numpy(), table.column('q_value').to_numpy(),
+        all_evidence, max_q_value,
+    )
+    return set(proteins[codes].tolist())
+
+
+class PsmCache:
+    """
+    The cache directory at path; entries are written by the parser workers
+    and need no lock.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE):
+        self.path = path
+
+    def path_of(self, file_id, md5sum=None):
+        """
+        Where the entry of a file is (or would be) stored.
+        """
+        file_id = str(file_id).replace('/', '_').replace(os.sep, '_')
+        return os.path.join(self.path, file_id[:2], f'{file_id}.{md5sum or UNKNOWN_CHECKSUM}.parquet')
+
+    def lookup(self, file_id, md5sum=None):
+        """
+        The path of the entry of a file, or None if it is not cached (or
+        only in another FORMAT_VERSION).
+        """
+        path = self.path_of(file_id, md5sum)
+        return path if os.path.exists(path) and is_current(path) else None
+
+    def entries(self):
+        """
+        {file_id: path} of every cached file; of several versions of one
+        file, the newest. To read the entry of a known file, use lookup with
+        its md5sum instead.
+        """
+        newest = {}
+        if not os.path.isdir(self.path):
+            return {}
+        for folder in os.scandir(self.path):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if not entry.name.endswith('.parquet') or not is_current(entry.path):
+                    continue
+                file_id = entry.name[:-len('.parquet')].rsplit('.', 1)[0]
+                mtime = entry.stat().st_mtime
+                if file_id not in newest or mtime > newest[file_id][0]:
+                    newest[file_id] = (mtime, entry.path)
+        return {file_id: path for file_id, (_, path) in newest.items()}
+
+    def __len__(self):
+        return len(self.entries())
+
+
+def _read_chunk(paths, all_evidence=False, max_q_value=None, pattern=protein_regex):
+    """
+    The protein IDs (first group of pattern in each name) of a chunk of
+    entries, interned locally like protein_matrix._read_chunk.
+    """
+    compiled = re.compile(pattern)
+    vocabulary = {}
+    codes = []
+    lengths = []
+    for path in paths:
+        ids = set()
+        for name in read_protein_set(path, all_evidence, max_q_value):
+            match = compiled.search(name)
+            if match:
+                ids.add(match.group(1))
+        lengths.append(len(ids))
+        codes.extend(vocabulary.setdefault(protein, len(vocabulary)) for protein in ids)
+    return list(vocabulary), np.asarray(codes, dtype=np.int32), np.asarray(lengths, dtype=np.int64)
+
+def build_matrix(cache, file_ids, groups=None, md5sums=None, all_evidence=False, max_q_value=None,
+                 workers=None, chunk_size=64):
+    """
+    A ProteinMatrix of the protein IDs of the cached files among file_ids,
+    derived under the protein list rules by a pool of workers processes, and
+    the file_id of each row. groups are the row groups of file_ids (e.g.
+    their keywords) and md5sums their expected md5sums (None: unknown);
+    files without an entry for that md5sum are left out.
+    """
+    groups = [''] * len(file_ids) if groups is None else groups
+    md5sums = [None] * len(file_ids) if md5sums is None else md5sums
+    found = []
+    paths = []
+    for file_id, group, md5sum in zip(file_ids, groups, md5sums):
+        path = cache.lookup(file_id, md5sum)
+        if path is not None:
+            found.append((file_id, group))
+            paths.append(path)
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    read_chunk = functools.partial(_read_chunk, all_evidence=all_evidence, max_q_value=max_q_value)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        matrix = matrix_from_chunks(
+            [file_id for file_id, _ in found], [group for _, group in found], executor.map(read_chunk, chunks))
+    return matrix, [file_id for file_id, _ in found]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect the PSM cache.')
+    parser.add_argument('--cache', default=DEFAULT_CACHE)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('info', help='summarize the cache')
+    show_parser = subparsers.add_parser('show', help='print the spectral counts of one cached file')
+    show_parser.add_argument('file_id')
+    show_parser.add_argument('--max-q-value', type=float, default=None)
+    args = parser.parse_args()
+
+    cache = PsmCache(args.cache)
+    entries = cache.entries()
+    if args.command == 'info':
+        size = sum(os.path.getsize(path) for path in entries.values())
+        rows = sum(pq.ParquetFile(path).metadata.num_rows for path in entries.values())
+        print(f"{args.cache}: {len(entries)} files, {rows} PSM evidences, {size / 1e6:.1f} MB")
+    else:
+        from mzid_extract import protein_table
+
+        if args.file_id not in entries:
+            raise SystemExit(f"{args.file_id} is not cached in {args.cache}")
+        print(protein_table(read_psm_file(entries[args.file_id]), max_q_value=args.max_q_value).to_string())
@@ -0,0 +1,75 @@
+"""
+Deterministic partitioning of the manifest files into shards.
+
+A file belongs to shard i of N if the SHA-1 of its file_id is i modulo N,
+so every node that runs `process_manifest_file.py --shard i/N` on the same
+manifest picks the same files, without coordinating with the others. Each
+shard writes its own protein store, "<store>.shard<i>of<N>"; the shard
+stores are merged afterwards (protein_store.py merge) or counted together
+directly by write_to_csv.py.
+"""
+import os
+import re
+import glob
+import argparse
+import hashlib
+
+
+def parse_shard(text):
+    """
+    Parse "i/N" into (i, N), shards being numbered 0 to N - 1. Meant as an
+    argparse type, so errors are argparse.ArgumentTypeError.
+    """
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard must look like i/N, e.g. 0/4, not {text!r}") from None
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard {text!r} out of range: i must be between 0 and N - 1")
+    return index, count
+
+def shard_of(file_id, num_shards):
+    """
+    The shard (0 to num_shards - 1) file_id belongs to.
+    """
+    digest = hashlib.sha1(str(file_id).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % num_shards
+
+def in_shard(file_id, shard):
+    """
+    Whether file_id belongs to shard, an (i, N) pair; None means no sharding.
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return shard_of(file_id, count) == index
+
+def shard_path(path, shard):
+    """
+    The shard's own version of an output path, e.g. protein_store.shard0of4.
+    """
+    if shard is None:
+        return path
+    index, count = shard
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}of{count}{ext}"
+
+def find_shard_paths(path):
+    """
+    The shard versions of path that exist, sorted. All of them must belong
+    to one shard count N: the shards of runs with different N overlap, so
+    reading them together would count files twice.
+    """
+    root, ext = os.path.splitext(path)
+    pattern = re.compile(rf"{re.escape(root)}\.shard\d+of(\d+){re.escape(ext)}")
+    paths = sorted(
+        candidate
+        for candidate in glob.glob(f"{glob.escape(root)}.shard*of*{glob.escape(ext)}")
+        if pattern.fullmatch(candidate)
+    )
+    counts = sorted({int(pattern.fullmatch(candidate).group(1)) for candidate in paths})
+    if len(counts) > 1:
+        raise ValueError(
+            f"Shard stores of {path} from runs with different shard counts {counts}; "
+            "remove the stale ones before reading or merging them")
+    return paths
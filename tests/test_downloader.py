@@ -0,0 +1,53 @@
+import os
+import re
+import sys
+import json
+import tempfile
+import threading
+
+import httpx
+
+# the query cache is placed on import, so it must not be the user's
+os.environ['PDC_CACHE_DIR'] = tempfile.mkdtemp()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from downloader import SignedUrlRefresher
+from pdc_api.utils import make_query
+
+
+def test_studies_refresh_at_once(monkeypatch):
+    # both refreshes must be waiting for the API at the same time
+    barrier = threading.Barrier(2, timeout=10)
+    studies = []
+
+    def handler(request):
+        pdc_study_id = re.search(r'pdc_study_id: "(\w+)"', json.loads(request.content)['query']).group(1)
+        studies.append(pdc_study_id)
+        barrier.wait()
+        files = [{'file_id': f'{pdc_study_id}-file', 'signedUrl': {'url': f'https://example.org/{pdc_study_id}'}}]
+        return httpx.Response(200, json={'data': {'filesPerStudy': files}})
+
+    monkeypatch.setattr(httpx, 'AsyncHTTPTransport', lambda **kwargs: httpx.MockTransport(handler))
+
+    refresh = SignedUrlRefresher()
+    urls = {}
+    errors = []
+
+    def refresh_study(pdc_study_id):
+        try:
+            urls[pdc_study_id] = refresh(pdc_study_id, f'{pdc_study_id}-file')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=refresh_study, args=(pdc_study_id,)) for pdc_study_id in ['PDC1', 'PDC2']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert sorted(studies) == ['PDC1', 'PDC2']
+    assert urls == {'PDC1': 'https://example.org/PDC1', 'PDC2': 'https://example.org/PDC2'}
+    # the refreshes ran in their own event loops and left the shared memo alone
+    assert not make_query._memo.entries
+    assert not make_query._memo.in_flight
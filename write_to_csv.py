@@ -1,85 +1,124 @@
 import os
-import re
-import csv
-from collections import defaultdict
+import sys
+import argparse
 
-protein_regex = r"\|([A-Z0-9_]+)_HUMAN"
+import numpy as np
+import pandas as pd
 
-def process_txt(txt_folder_path):
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdc_discovery_scripts'))
 
-    if not os.path.isdir(txt_folder_path):
-        raise NotADirectoryError(f"Error: Provided path '{txt_folder_path}' is not a directory.") 
-    files = [f for f in os.listdir(txt_folder_path) if f.endswith('.txt') and os.path.isfile(os.path.join(txt_folder_path, f))]
-    if not files:
-        raise FileNotFoundError(f"No .txt files found in the directory: {txt_folder_path}")
-    
-    proteins_counts = defaultdict(int)
-    tracking_total_files = 0
-    
-    for filename in files:
-        txt_file_path = os.path.join(txt_folder_path, filename)
+from pdc_api.utils import telemetry
+from protein_matrix import build_protein_matrix
+from protein_store import load_matrix
+from protein_store import open_stores
+from psm_cache import PsmCache
+from psm_cache import build_matrix
+from cohorts import CohortTable
+from cohorts import DEFAULT_TABLE
+from cohorts import DEFAULT_SOURCE
+from cohorts import cohort_masks
 
-        print(f"Processing file: {txt_file_path}")
-        tracking_total_files += 1
-            
-        try:
-            with open(txt_file_path, 'r', encoding='utf-8') as f:
-                proteins_inthe_file = set()
-                for pline in f:
-                    match = re.search(protein_regex, pline.strip())
-                    if match:
-                        protein_id = match.group(1)
-                        proteins_inthe_file.add(protein_id)     
-        except Exception as e:
-            print(f"error reading file {txt_file_path}: {e}")
-            continue
-        
-        for protein in proteins_inthe_file:
-            proteins_counts[protein] +=1 
-            
-    print(f"Total files processed: {tracking_total_files}")
-    return proteins_counts, tracking_total_files 
+def process_txt(txt_folder_path, workers=None):
+    """
+    Count in how many protein lists of txt_folder_path each protein appears.
+    Returns ({protein: count}, number of files).
+    """
+    with telemetry.span('process_txt', folder=os.path.basename(os.path.normpath(txt_folder_path))) as event:
+        matrix = build_protein_matrix({txt_folder_path: txt_folder_path}, workers=workers)
+        counts = matrix.counts_dict()
+        event.update(files=matrix.num_files, proteins=len(counts))
+    print(f"Total files processed: {matrix.num_files}")
+    return counts, matrix.num_files
 
 
-def write_to_csv(inv_counts, invasive_total, non_inv_counts, non_invasive_total, output_file):
-    all_proteins = set(inv_counts.keys()).union(set(non_inv_counts.keys()))
-    with open(output_file, 'w', newline='') as csvfile:
-        writer_to_csv = csv.writer(csvfile)
-        writer_to_csv.writerow([
-            "protein name", 
-            # "total count", "total fraction", 
-            "invasive counts", "invasive fraction", 
-            "non-invasive counts", "non-invasive fraction"
-        ])
+def expected_md5sums(file_ids):
+    """
+    The md5sum PDC reports for each of file_ids, from the file table or the
+    stage 5 CSV; None where it is not known.
+    """
+    if os.path.exists(DEFAULT_TABLE):
+        cohort_table = CohortTable(DEFAULT_TABLE)
+        md5sums = cohort_table.column('md5sum').to_numpy(dtype=object)
+        positions = cohort_table.positions(file_ids)
+    elif os.path.exists(DEFAULT_SOURCE):
+        table = pd.read_csv(DEFAULT_SOURCE, usecols=['file_id', 'md5sum'], dtype=str)
+        md5sums = table['md5sum'].to_numpy(dtype=object)
+        positions = pd.Index(table['file_id']).get_indexer(pd.Index(file_ids))
+    else:
+        return [None] * len(file_ids)
+    return [
+        md5sums[position] if position >= 0 and isinstance(md5sums[position], str) else None
+        for position in positions
+    ]
+
 
-        for protein in all_proteins:
-          
-            invasive_count = inv_counts.get(protein, 0)
-            non_invasive_count = non_inv_counts.get(protein, 0)
-            total_count = invasive_count + non_invasive_count
-            total_files = invasive_total + non_invasive_total  # All files combined
+def write_to_csv(inv_counts, invasive_total, non_inv_counts, non_invasive_total, output_file):
+    """
+    Write the count and fraction of files containing each protein in the
+    invasive and non-invasive cohorts, one row per protein found in either.
+    Counts are aligned and divided as whole columns; cohort_stats.py does
+    the same for any number of cohorts, with significance tests.
+    """
+    counts = pd.DataFrame({
+        'invasive counts': pd.Series(inv_counts, dtype=np.int64),
+        'non-invasive counts': pd.Series(non_inv_counts, dtype=np.int64),
+    }).fillna(0).astype(np.int64)
 
-            total_fraction = total_count / total_files if total_files > 0 else 0
-            invasive_fraction = invasive_count / invasive_total if invasive_total > 0 else 0
-            non_invasive_fraction = non_invasive_count / non_invasive_total if non_invasive_total > 0 else 0
+    summary = pd.DataFrame(index=counts.index)
+    for column, total in [('invasive', invasive_total), ('non-invasive', non_invasive_total)]:
+        summary[f'{column} counts'] = counts[f'{column} counts']
+        fractions = counts[f'{column} counts'] / total if total > 0 else 0
+        summary[f'{column} fraction'] = np.round(fractions, 5)
 
-            writer_to_csv.writerow([
-                protein, 
-                # total_count, round(total_fraction, 5), 
-                invasive_count, round(invasive_fraction, 5), 
-                non_invasive_count, round(non_invasive_fraction, 5)
-            ])
+    summary.to_csv(output_file, index_label='protein name')
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count the proteins of the invasive and non-invasive cohorts.')
+    parser.add_argument('--psm-cache', default=None, metavar='DIR',
+                        help='derive the protein lists of the stored files from this PSM cache')
+    parser.add_argument('--all-evidence', action='store_true',
+                        help='with --psm-cache: count the proteins of every evidence')
+    parser.add_argument('--max-q-value', type=float, default=None,
+                        help='with --psm-cache: count only the proteins of PSMs with at most this q-value')
+    args = parser.parse_args()
+
     stageIII_folder = "./invasive_protein_list"
     stageI_folder = "./noninvasive_protein_list"
+    store_path = "./protein_store"
     output_csv = "./protein_summary.csv"
     
     try:
-        inv_counts, invasive_total = process_txt(stageIII_folder)
-        non_inv_counts, non_invasive_total = process_txt(stageI_folder)
-        write_to_csv(inv_counts, invasive_total, non_inv_counts, non_invasive_total, output_csv)
+        # Each cohort is a row mask of the same matrix, read from the protein
+        # store if process_manifest_file wrote one (or from the stores of
+        # a sharded run, not merged yet), else from the txt lists. With a
+        # PSM cache, the lists of the stored files are derived from the
+        # cache under the given rules instead.
+        if args.psm_cache:
+            index = [row for store in open_stores(store_path) for row in store.index]
+            stored_ids = [row['file_id'] for row in index]
+            matrix, file_ids = build_matrix(
+                PsmCache(args.psm_cache),
+                stored_ids, [row['keyword'] for row in index], expected_md5sums(stored_ids),
+                all_evidence=args.all_evidence, max_q_value=args.max_q_value,
+            )
+            print(f"Derived the protein lists of {len(file_ids)} of {len(index)} stored files from {args.psm_cache}")
+        else:
+            matrix, file_ids = load_matrix(store_path)
+        if matrix is None:
+            matrix = build_protein_matrix({'invasive': stageIII_folder, 'noninvasive': stageI_folder})
+
+        # cohorts come from the file table if there is one, else from the download keywords
+        masks = cohort_masks(matrix, file_ids)
+        invasive = masks['invasive']
+        non_invasive = masks['noninvasive']
+        print(f"Total files processed: {matrix.num_files}")
+
+        write_to_csv(
+            matrix.counts_dict(invasive), int(invasive.sum()),
+            matrix.counts_dict(non_invasive), int(non_invasive.sum()),
+            output_csv,
+        )
         print(f"Csv output '{output_csv}' written successfully.")
     except Exception as e:
         print(f"Error: {e}")